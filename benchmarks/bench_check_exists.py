@@ -0,0 +1,60 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cost of ``_check_exists`` against the number of vdisks on the vPool.
+
+    python benchmarks/bench_check_exists.py [rounds]
+"""
+import os
+import sys
+import timeit
+
+from openvstorage_flocker_plugin.testtools import (
+    FakeStorageRouterClient, fake_blockdevice_api
+)
+
+SIZES = (100, 1000, 10000, 50000)
+
+
+def legacy_check_exists(client, blockdevice_id):
+    all_volumes = [os.path.splitext(x)[0].lstrip("/")
+                   for x in client.list_volumes_by_path()]
+    return blockdevice_id in all_volumes
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print "%8s %14s %14s %8s" % ("vdisks", "legacy (us)", "lookup (us)",
+                                 "rpcs")
+    for size in SIZES:
+        client = FakeStorageRouterClient()
+        client.populate(size, flocker=1)
+        api = fake_blockdevice_api(client, inventory_ttl=0, lock_dir=None)
+        blockdevice_id = [os.path.splitext(p)[0].lstrip("/")
+                          for p in client.list_volumes_by_path()
+                          if p.startswith("/flocker-")][0]
+        legacy = timeit.timeit(
+            lambda: legacy_check_exists(client, blockdevice_id),
+            number=max(1, rounds // 20)) / max(1, rounds // 20)
+        client.reset_calls()
+        lookup = timeit.timeit(
+            lambda: api._check_exists(blockdevice_id),
+            number=rounds) / rounds
+        rpcs = sum(client.calls.values()) / float(rounds)
+        print "%8d %14.1f %14.1f %8.1f" % (size, legacy * 1e6, lookup * 1e6,
+                                           rpcs)
+
+
+if __name__ == '__main__':
+    main()
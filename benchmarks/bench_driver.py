@@ -0,0 +1,112 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Latency, storagerouter RPCs and tap-ctl forks of the driver operations
+against the in-process stand-ins, at several vPool sizes.
+
+    python benchmarks/bench_driver.py [--sizes 10,100,1000,10000]
+        [--attached 50] [--latency 0.001] [--check]
+
+With ``--check`` the exit status is non-zero when an operation makes more
+RPCs or forks than its budget, so call count regressions fail CI.
+"""
+import argparse
+import sys
+import time
+
+from openvstorage_flocker_plugin.testtools import (
+    FakeStorageRouterClient, FakeTapCtl, fake_blockdevice_api
+)
+
+# Maximum (rpcs, forks) per operation, as a function of the number of
+# volumes ``n`` and of attached volumes ``a``.
+BUDGETS = {
+    'list_volumes (cold)': lambda n, a: (2 * n + 1, 1),
+    'list_volumes (warm)': lambda n, a: (1, 1),
+    'get_device_path': lambda n, a: (1, 1),
+    'attach_volume': lambda n, a: (2, 2),
+    'detach_volume': lambda n, a: (1, 2),
+    'destroy_all_flocker_volumes': lambda n, a: (n + 1, a + 1),
+}
+
+
+def measure(results, name, function, client, tapctl):
+    rpcs, forks = client.rpcs, tapctl.forks
+    started = time.time()
+    function()
+    elapsed = time.time() - started
+    results.append((name, elapsed, client.rpcs - rpcs, tapctl.forks - forks))
+
+
+def run(size, attached, latency):
+    results = []
+    with FakeTapCtl() as tapctl:
+        client = FakeStorageRouterClient(latency=latency)
+        client.populate(size * 4, flocker=size)
+        api = fake_blockdevice_api(client, lock_dir=None)
+        ids = [p[1:-len(".raw")] for p in client.list_volumes_by_path()
+               if p.startswith("/flocker-")]
+        attached, free = ids[:min(attached, size - 1)], ids[-1]
+        tapctl.seed(attached)
+        instance_id = api.compute_instance_id()
+
+        measure(results, 'list_volumes (cold)', api.list_volumes,
+                client, tapctl)
+        measure(results, 'list_volumes (warm)', api.list_volumes,
+                client, tapctl)
+        if attached:
+            measure(results, 'get_device_path',
+                    lambda: api.get_device_path(attached[0]), client, tapctl)
+        if free not in attached:
+            measure(results, 'attach_volume',
+                    lambda: api.attach_volume(free, instance_id),
+                    client, tapctl)
+            measure(results, 'detach_volume',
+                    lambda: api.detach_volume(free), client, tapctl)
+        measure(results, 'destroy_all_flocker_volumes',
+                api.destroy_all_flocker_volumes, client, tapctl)
+    return len(attached), results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--attached', type=int, default=50,
+                        help='volumes attached before measuring')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per storagerouter call')
+    parser.add_argument('--check', action='store_true',
+                        help='fail when an operation exceeds its budget')
+    options = parser.parse_args(argv)
+
+    failures = []
+    print "%7s %-30s %11s %7s %6s" % ("volumes", "operation", "time (ms)",
+                                      "rpcs", "forks")
+    for size in [int(s) for s in options.sizes.split(',')]:
+        attached, results = run(size, options.attached, options.latency)
+        for name, elapsed, rpcs, forks in results:
+            max_rpcs, max_forks = BUDGETS[name](size, attached)
+            flag = ''
+            if rpcs > max_rpcs or forks > max_forks:
+                flag = ' over budget (%d, %d)' % (max_rpcs, max_forks)
+                failures.append((size, name))
+            print "%7d %-30s %11.1f %7d %6d%s" % (size, name, elapsed * 1e3,
+                                                  rpcs, forks, flag)
+    if options.check and failures:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
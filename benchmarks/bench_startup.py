@@ -0,0 +1,98 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Start-up cost of the plugin, each run in a fresh interpreter: discovering
+``FLOCKER_BACKEND`` the way the agent probes backends, and building the
+driver through ``api_factory``.
+
+    python benchmarks/bench_startup.py [--runs 10] [--check]
+
+With ``--check`` the exit status is non-zero when a phase loads one of
+the modules it must not need, or takes longer than its budget.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# What one interpreter runs: time the phases, report the modules loaded.
+PROBE = r'''
+import json, sys, time
+started = time.time()
+import openvstorage_flocker_plugin
+backend = openvstorage_flocker_plugin.FLOCKER_BACKEND
+discovered = time.time()
+discovery_modules = set(sys.modules)
+api = backend.api_factory(cluster_id=None, vpool_conf_file=sys.argv[1],
+                          lock_dir=None)
+built = time.time()
+json.dump({"discovery": discovered - started,
+           "api_factory": built - discovered,
+           "discovery_modules": sorted(m for m in discovery_modules
+                                       if sys.modules.get(m) is not None),
+           "modules": sorted(m for m in sys.modules
+                             if sys.modules.get(m) is not None)},
+          sys.stdout)
+'''
+
+# Modules a phase must not load, and its budget in seconds.
+BUDGETS = {
+    "discovery": (("openvstorage_flocker_plugin.openvstorage_blockdevice",
+                   "volumedriver.storagerouter.storagerouterclient",
+                   "requests", "bitmath"), 2.0),
+    "api_factory": (("volumedriver.storagerouter.storagerouterclient",
+                     "requests", "bitmath"), 2.0),
+}
+
+
+def probe(vpool_conf_file):
+    out = subprocess.check_output([sys.executable, "-c", PROBE,
+                                   vpool_conf_file])
+    return json.loads(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--vpool-conf-file",
+                        default="/nonexistent/vpool.json",
+                        help="never read, clients connect on first use")
+    parser.add_argument("--check", action="store_true")
+    options = parser.parse_args(argv)
+
+    results = [probe(options.vpool_conf_file) for _ in range(options.runs)]
+    failures = []
+    print "%-12s %10s %10s %8s" % ("phase", "p50 (ms)", "max (ms)",
+                                   "modules")
+    for phase, modules_key in (("discovery", "discovery_modules"),
+                               ("api_factory", "modules")):
+        times = sorted(result[phase] for result in results)
+        loaded = set(results[-1][modules_key])
+        forbidden, budget = BUDGETS[phase]
+        print "%-12s %10.1f %10.1f %8d" % (phase, times[len(times) // 2] *
+                                           1000, times[-1] * 1000,
+                                           len(loaded))
+        for module in forbidden:
+            if module in loaded:
+                failures.append("%s loads %s" % (phase, module))
+        if times[len(times) // 2] > budget:
+            failures.append("%s takes %.2fs, budget %.2fs" %
+                            (phase, times[len(times) // 2], budget))
+    for failure in failures:
+        print "FAIL: %s" % (failure,)
+    return 1 if options.check and failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
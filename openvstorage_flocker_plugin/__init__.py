@@ -12,9 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from flocker.node import BackendDescription, DeployerType
-from openvstorage_flocker_plugin.openvstorage_blockdevice import (
-    openvstorage_from_configuration
-)
 
 __author__ = "Chrysostomos Nanakos"
 __copyright__ = "Copyright 2015, iNuron NV"
@@ -25,12 +22,92 @@ __status__ = "Development"
 
 
 def api_factory(cluster_id, **kwargs):
+    # Imported here so probing the backend does not load the driver.
+    from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+        openvstorage_from_configuration, DEFAULT_INVENTORY_TTL,
+        DEFAULT_WATCH_INTERVAL, DEFAULT_METADATA_WORKERS, DEFAULT_BULK_WORKERS,
+        DEFAULT_QUIESCE_TIMEOUT
+    )
+    from openvstorage_flocker_plugin.locks import DEFAULT_LOCK_DIR
 
+    vpool_conf_files = list(kwargs.get("vpool_conf_files") or [])
     if "vpool_conf_file" in kwargs:
         vpool_conf_file = kwargs["vpool_conf_file"]
+    elif vpool_conf_files:
+        vpool_conf_file = vpool_conf_files[0]
     else:
         raise Exception('No vPool configuration file')
-    return openvstorage_from_configuration(vpool_conf_file=vpool_conf_file)
+    inventory_ttl = int(kwargs.get("inventory_ttl", DEFAULT_INVENTORY_TTL))
+    tapdisk_watcher = bool(kwargs.get("tapdisk_watcher", False))
+    watch_interval = int(kwargs.get("watch_interval", DEFAULT_WATCH_INTERVAL))
+    metadata_workers = int(kwargs.get("metadata_workers",
+                                      DEFAULT_METADATA_WORKERS))
+    tap_ctl_timeout = kwargs.get("tap_ctl_timeout")
+    if tap_ctl_timeout is not None:
+        tap_ctl_timeout = float(tap_ctl_timeout)
+    bulk_workers = int(kwargs.get("bulk_workers", DEFAULT_BULK_WORKERS))
+    timing_stats = bool(kwargs.get("timing_stats", False))
+    iostats = dict((key, kwargs[key]) for key in
+                   ("iostats_interval", "iostats_history",
+                    "iostats_textfile", "iostats_port") if key in kwargs)
+    profiles = kwargs.get("profiles")
+    placement = kwargs.get("placement", "round_robin")
+    template = kwargs.get("template")
+    template_snapshot = kwargs.get("template_snapshot")
+    tapdisk_pool = int(kwargs.get("tapdisk_pool", 0))
+    queue_tuning = kwargs.get("queue_tuning")
+    lock_dir = kwargs.get("lock_dir", DEFAULT_LOCK_DIR)
+    namespace = kwargs.get("namespace")
+    vpool_mountpoints = kwargs.get("vpool_mountpoints")
+    allocation_unit = kwargs.get("allocation_unit")
+    if allocation_unit is not None:
+        allocation_unit = int(allocation_unit)
+    readonly_datasets = kwargs.get("readonly_datasets")
+    detach_mode = kwargs.get("detach_mode", "destroy")
+    quiesce_timeout = float(kwargs.get("quiesce_timeout",
+                                       DEFAULT_QUIESCE_TIMEOUT))
+    reconcile = dict(
+        reconcile_dry_run=bool(kwargs.get("reconcile_dry_run", False)))
+    if kwargs.get("reconcile_interval") is not None:
+        reconcile["reconcile_interval"] = float(kwargs["reconcile_interval"])
+    if kwargs.get("reconcile_batch") is not None:
+        reconcile["reconcile_batch"] = int(kwargs["reconcile_batch"])
+    resilience = dict()
+    if kwargs.get("storagerouter_deadlines") is not None:
+        resilience["storagerouter_deadlines"] = dict(
+            (key, float(value)) for key, value
+            in dict(kwargs["storagerouter_deadlines"]).items())
+    for key, parse in (("storagerouter_retries", int),
+                       ("storagerouter_backoff", float),
+                       ("breaker_threshold", int),
+                       ("breaker_reset", float)):
+        if kwargs.get(key) is not None:
+            resilience[key] = parse(kwargs[key])
+    settings = dict(iostats, **reconcile)
+    settings.update(resilience)
+    return openvstorage_from_configuration(vpool_conf_file=vpool_conf_file,
+                                           inventory_ttl=inventory_ttl,
+                                           tapdisk_watcher=tapdisk_watcher,
+                                           watch_interval=watch_interval,
+                                           metadata_workers=metadata_workers,
+                                           tap_ctl_timeout=tap_ctl_timeout,
+                                           bulk_workers=bulk_workers,
+                                           timing_stats=timing_stats,
+                                           profiles=profiles,
+                                           vpool_conf_files=vpool_conf_files,
+                                           placement=placement,
+                                           template=template,
+                                           template_snapshot=template_snapshot,
+                                           tapdisk_pool=tapdisk_pool,
+                                           queue_tuning=queue_tuning,
+                                           lock_dir=lock_dir,
+                                           namespace=namespace,
+                                           vpool_mountpoints=vpool_mountpoints,
+                                           allocation_unit=allocation_unit,
+                                           detach_mode=detach_mode,
+                                           quiesce_timeout=quiesce_timeout,
+                                           readonly_datasets=readonly_datasets,
+                                           **settings)
 
 FLOCKER_BACKEND = BackendDescription(
     name=u"openvstorage_flocker_driver",
@@ -0,0 +1,269 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+
+import blktap as Blktap
+
+from eliot import Logger
+from eliot.twisted import DeferredContext
+from zope.interface import implementer
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed
+)
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, IBlockDeviceAsyncAPI, BlockDeviceVolume
+)
+
+from openvstorage_flocker_plugin.instrumentation import (
+    TAP_CTL_CALL, TIMINGS
+)
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    OpenvStorageBlockDeviceAPI, _dataset_id
+)
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+_logger = Logger()
+
+# Default number of threads running storagerouter calls.
+DEFAULT_THREADS = 10
+
+
+class _TapCtlProcess(ProcessProtocol):
+    """
+    Collects the output of one ``tap-ctl`` run and fires ``ended`` with
+    ``(out, err, rc, timed_out)`` once it exited, killing it if it is still
+    running after ``timeout`` seconds.
+    """
+
+    def __init__(self, reactor, timeout):
+        self.ended = Deferred()
+        self._reactor = reactor
+        self._timeout = timeout
+        self._timer = None
+        self._out = []
+        self._err = []
+        self._timed_out = False
+
+    def connectionMade(self):
+        if self._timeout:
+            self._timer = self._reactor.callLater(self._timeout, self._kill)
+
+    def _kill(self):
+        self._timer = None
+        self._timed_out = True
+        try:
+            self.transport.signalProcess('KILL')
+        except ProcessExitedAlready:
+            pass
+
+    def outReceived(self, data):
+        self._out.append(data)
+
+    def errReceived(self, data):
+        self._err.append(data)
+
+    def processExited(self, reason):
+        # A killed tap-ctl may leave children holding its pipes open
+        if self._timed_out:
+            self.processEnded(reason)
+
+    def processEnded(self, reason):
+        if self.ended.called:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rc = reason.value.exitCode
+        if rc is None:
+            rc = -(reason.value.signal or 0)
+        self.ended.callback(("".join(self._out), "".join(self._err), rc,
+                             self._timed_out))
+
+
+@implementer(IBlockDeviceAsyncAPI)
+class OpenvStorageAsyncBlockDeviceAPI(object):
+    """
+    A ``IBlockDeviceAsyncAPI`` which uses OpenvStorage Block Devices.
+
+    Storagerouter calls run on a dedicated thread pool and ``tap-ctl`` runs
+    through the reactor's process support, so neither blocks the reactor
+    and independent volumes make progress at the same time.
+    """
+
+    def __init__(self, reactor, api, threads=DEFAULT_THREADS):
+        """
+        :param reactor: The reactor to run ``tap-ctl`` and the thread pool
+            on.
+        :param OpenvStorageBlockDeviceAPI api: The synchronous API doing the
+            storagerouter calls.
+        :param int threads: Maximum number of concurrent storagerouter calls.
+        """
+        self._reactor = reactor
+        self._api = api
+        self._threadpool = ThreadPool(minthreads=0, maxthreads=threads,
+                                      name="openvstorage-flocker")
+        self._threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self._threadpool.stop)
+
+    def _thread(self, function, *args, **kwargs):
+        return deferToThreadPool(self._reactor, self._threadpool,
+                                 function, *args, **kwargs)
+
+    def _tap_ctl(self, *args, **kwargs):
+        """
+        Run ``tap-ctl args`` as a child process of the reactor.
+
+        :param timeout: Seconds before the command is killed, defaults to
+            ``Tapdisk.TIMEOUT`` like the synchronous driver.
+        :raises TapdiskTimeout: If it was killed.
+        :raises TapdiskException: If it failed.
+        """
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            timeout = Blktap.Tapdisk.TIMEOUT
+        started = time.time()
+        action = TAP_CTL_CALL(_logger, operation=args[0],
+                              volume=Blktap.Tapdisk.subject(args))
+
+        def check((out, err, rc, timed_out)):
+            # Once it ran, so a table listed meanwhile is not kept
+            Blktap.Tapdisk.invalidate(*args)
+            duration = time.time() - started
+            TIMINGS.record("tap-ctl:%s" % args[0], duration,
+                           bool(rc) or timed_out)
+            out, err = out.strip(), err.strip()
+            if timed_out:
+                raise Blktap.TapdiskTimeout('%s timed out after %.1fs (%s %s)'
+                                            % (args, duration, out, err))
+            if rc:
+                raise Blktap.TapdiskException('%s failed (%s %s %s)' %
+                                              (args, rc, out, err))
+            action.addSuccessFields(duration=duration)
+            return out
+
+        with action.context():
+            process = _TapCtlProcess(self._reactor, timeout)
+            self._reactor.spawnProcess(
+                process, Blktap.Tapdisk.TAP_CTL,
+                (Blktap.Tapdisk.TAP_CTL,) + args, env=os.environ)
+            d = DeferredContext(process.ended)
+            d.addCallback(check)
+            return d.addActionFinish()
+
+    @inlineCallbacks
+    def _snapshot(self):
+        if Blktap.Tapdisk.watcher is not None:
+            table = yield self._thread(Blktap.Tapdisk.snapshot)
+        else:
+            out = yield self._tap_ctl('list')
+            table = Blktap.TapdiskTable(Blktap.Tapdisk.parse_list(out))
+        returnValue(table)
+
+    def allocation_unit(self):
+        return succeed(self._api.allocation_unit())
+
+    def compute_instance_id(self):
+        return succeed(self._api.compute_instance_id())
+
+    def create_volume(self, dataset_id, size):
+        return self._thread(self._api.create_volume, dataset_id, size)
+
+    def destroy_volume(self, blockdevice_id):
+        return self._thread(self._api.destroy_volume, blockdevice_id)
+
+    @inlineCallbacks
+    def attach_volume(self, blockdevice_id, attach_to):
+        vpool = yield self._thread(self._api._owner, blockdevice_id.encode())
+        readonly = self._api._readonly(blockdevice_id, vpool)
+        if attach_to != self._api.compute_instance_id():
+            table = yield self._snapshot()
+            if not readonly and \
+                    self._api._is_already_mapped(blockdevice_id, table):
+                raise AlreadyAttachedVolume(blockdevice_id)
+            returnValue(None)
+
+        yield self._thread(self._api._locks.acquire, blockdevice_id)
+        try:
+            table = yield self._snapshot()
+            device = None
+            tapdisk = table.from_volume(blockdevice_id)
+            if tapdisk is not None:
+                self._api._shared(blockdevice_id, tapdisk, readonly)
+            else:
+                volume = self._api._tapdisk_volume(blockdevice_id)
+                timeout = vpool.attach_settings.get("tap_ctl_timeout")
+                if timeout is None:
+                    timeout = Blktap.Tapdisk.TIMEOUT
+                if Blktap.Tapdisk.pool is not None:
+                    device = yield self._thread(Blktap.Tapdisk.pool.open,
+                                                volume, readonly, timeout)
+                if device is None:
+                    device = yield self._tap_ctl(
+                        *Blktap.Tapdisk.create_args(volume, readonly),
+                        timeout=timeout)
+        finally:
+            self._api._locks.release(blockdevice_id)
+        yield self._thread(self._api._tune_queue, vpool, device)
+        _, size = yield self._thread(self._api._volume_metadata,
+                                     blockdevice_id, refresh=True)
+        returnValue(BlockDeviceVolume(blockdevice_id=blockdevice_id,
+                                      size=size,
+                                      attached_to=attach_to,
+                                      dataset_id=_dataset_id(blockdevice_id)))
+
+    @inlineCallbacks
+    def detach_volume(self, blockdevice_id):
+        yield self._thread(self._api._check_exists, blockdevice_id)
+        yield self._thread(self._api._locks.acquire, blockdevice_id)
+        try:
+            table = yield self._snapshot()
+            device_path = self._api._device_path(blockdevice_id, table).path
+            tapdisk = table.from_device(str(device_path))
+            if tapdisk is not None and self._api._quiesce is not None:
+                yield self._thread(self._api._quiesce_device, blockdevice_id,
+                                   str(device_path), table)
+            if tapdisk is not None:
+                yield self._tap_ctl(*Blktap.Tapdisk.destroy_args(tapdisk))
+            self._api._inventory.invalidate(blockdevice_id)
+        finally:
+            self._api._locks.release(blockdevice_id)
+
+    def list_volumes(self):
+        return self._thread(self._api.list_volumes)
+
+    @inlineCallbacks
+    def get_device_path(self, blockdevice_id):
+        yield self._thread(self._api._check_exists, blockdevice_id)
+        table = yield self._snapshot()
+        returnValue(self._api._device_path(blockdevice_id, table))
+
+
+def openvstorage_async_from_configuration(reactor, vpool_conf_file,
+                                          threads=DEFAULT_THREADS, **kwargs):
+    return OpenvStorageAsyncBlockDeviceAPI(
+        reactor, OpenvStorageBlockDeviceAPI(vpool_conf_file, **kwargs),
+        threads=threads)
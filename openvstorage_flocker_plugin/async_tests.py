@@ -0,0 +1,87 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.async_blockdevice``.
+"""
+import os
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import blktap
+from openvstorage_flocker_plugin.async_blockdevice import (
+    OpenvStorageAsyncBlockDeviceAPI
+)
+
+
+class TapCtlTests(TestCase):
+    """
+    Tests for ``OpenvStorageAsyncBlockDeviceAPI._tap_ctl``.
+    """
+
+    def tap_ctl(self, script):
+        """
+        Make ``tap-ctl`` a shell script running ``script``.
+        """
+        path = self.mktemp()
+        with open(path, "w") as fh:
+            fh.write("#!/bin/sh\n%s\n" % (script,))
+        os.chmod(path, 0755)
+        self.patch(blktap.Tapdisk, "TAP_CTL", path)
+        api = OpenvStorageAsyncBlockDeviceAPI(reactor, None, threads=1)
+        self.addCleanup(api._threadpool.stop)
+        return api
+
+    @inlineCallbacks
+    def test_output(self):
+        """
+        The stripped standard output of a successful run is returned.
+        """
+        api = self.tap_ctl('echo " minor=$2 "')
+        out = yield api._tap_ctl("list", "-m1")
+        self.assertEqual(out, "minor=-m1")
+
+    def test_failure(self):
+        """
+        A non-zero exit status fails with ``TapdiskException``.
+        """
+        api = self.tap_ctl("echo nope >&2; exit 3")
+        d = api._tap_ctl("list")
+        return self.assertFailure(d, blktap.TapdiskException)
+
+    @inlineCallbacks
+    def test_timeout(self):
+        """
+        A run taking longer than ``timeout`` is killed and fails with
+        ``TapdiskTimeout``.
+        """
+        api = self.tap_ctl("exec sleep 30")
+        started = time.time()
+        d = api._tap_ctl("create", "-aopenvstorage:vol", timeout=0.2)
+        yield self.assertFailure(d, blktap.TapdiskTimeout)
+        self.assertLess(time.time() - started, 5)
+
+    @inlineCallbacks
+    def test_default_timeout(self):
+        """
+        Without a ``timeout``, ``Tapdisk.TIMEOUT`` applies.
+        """
+        api = self.tap_ctl("exec sleep 30")
+        self.patch(blktap.Tapdisk, "TIMEOUT", 0.2)
+        started = time.time()
+        yield self.assertFailure(api._tap_ctl("list"),
+                                 blktap.TapdiskTimeout)
+        self.assertLess(time.time() - started, 5)
@@ -11,8 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import atexit
+import ctypes
+import ctypes.util
+import errno
+import json
 import os
+import select
 import subprocess
+import threading
+import time
+
+from cStringIO import StringIO
+
+from instrumentation import TAP_CTL_CALL, timed
 
 __author__ = "Chrysostomos Nanakos"
 __copyright__ = "Copyright 2015, iNuron NV"
@@ -30,14 +42,99 @@ def cmd_open(cmd, bufsize=-1, env=None):
     return inst
 
 
-def doexec(args, inputtext=None):
+class ExecResult(object):
+    '''Outcome of a command run by ``execute``.'''
+    __slots__ = ('args', 'rc', 'out', 'err', 'elapsed', 'timed_out')
+
+    def __init__(self, args, rc, out, err, elapsed, timed_out=False):
+        self.args = args
+        self.rc = rc
+        self.out = out
+        self.err = err
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    def __str__(self):
+        return 'args=%s rc=%s elapsed=%.3f timed_out=%s' \
+               % (self.args, self.rc, self.elapsed, self.timed_out)
+
+
+def _drain(proc, deadline):
+    '''Read stdout and stderr of ``proc`` until both are closed or the
+    deadline passes. Return ``(out, err, timed_out)``.'''
+    chunks = {proc.stdout.fileno(): [], proc.stderr.fileno(): []}
+    poller = select.poll()
+    for fd in chunks:
+        poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    pending = set(chunks)
+    timed_out = False
+    while pending:
+        wait = None
+        if deadline is not None:
+            wait = (deadline - time.time()) * 1000
+            if wait <= 0:
+                timed_out = True
+                break
+        try:
+            events = poller.poll(wait)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, _ in events:
+            data = os.read(fd, 65536)
+            if data:
+                chunks[fd].append(data)
+            else:
+                poller.unregister(fd)
+                pending.discard(fd)
+    return (''.join(chunks[proc.stdout.fileno()]),
+            ''.join(chunks[proc.stderr.fileno()]), timed_out)
+
+
+def _reap(proc, deadline):
+    '''Wait for ``proc`` until the deadline, kill it once it passed.
+    Return ``(rc, timed_out)``.'''
+    while deadline is not None and proc.poll() is None:
+        if time.time() >= deadline:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            return proc.wait(), True
+        time.sleep(0.005)
+    return proc.wait(), False
+
+
+def execute(args, inputtext=None, timeout=None):
+    '''Run ``args`` and collect its output while it runs, so a chatty
+    command cannot block on a full pipe. A command still running after
+    ``timeout`` seconds is killed and reaped.'''
+    started = time.time()
+    deadline = None if timeout is None else started + timeout
     proc = cmd_open(args)
-    if inputtext is not None:
-        proc.stdin.write(inputtext)
-    stdout = proc.stdout
-    stderr = proc.stderr
-    rc = proc.wait()
-    return (rc, stdout, stderr)
+    try:
+        try:
+            if inputtext is not None:
+                proc.stdin.write(inputtext)
+            proc.stdin.close()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+        out, err, timed_out = _drain(proc, deadline)
+        if timed_out:
+            deadline = time.time()
+        rc, killed = _reap(proc, deadline)
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+    return ExecResult(args, rc, out, err, time.time() - started,
+                      timed_out or killed)
+
+
+def doexec(args, inputtext=None):
+    result = execute(args, inputtext)
+    return (result.rc, StringIO(result.out), StringIO(result.err))
 
 
 class TDFlags:
@@ -57,12 +154,457 @@ class TapdiskException(Exception):
     pass
 
 
+class TapdiskTimeout(TapdiskException):
+    pass
+
+
+class INotify(object):
+    '''Minimal non-blocking inotify(7) binding. Only tells whether
+    anything happened since the last call to ``pending``.'''
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise TapdiskException('inotify is not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise TapdiskException('inotify_init1 failed: %s' %
+                                   os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise TapdiskException('cannot watch %s: %s' %
+                                   (path, os.strerror(ctypes.get_errno())))
+        return wd
+
+    def pending(self):
+        '''Consume all queued events, return ``True`` if there were any.'''
+        seen = False
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    return seen
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return seen
+                raise
+            seen = True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class TapdiskWatcher(object):
+    '''Keeps a ``TapdiskTable`` up to date from inotify events on the
+    tapdev directory. ``tap-ctl list`` only runs again when a tapdev
+    appeared or vanished, when the table was invalidated, or when the
+    previous listing is older than ``interval`` seconds.'''
+    MASK = INotify.IN_CREATE | INotify.IN_DELETE | INotify.IN_ATTRIB | \
+        INotify.IN_MOVED_FROM | INotify.IN_MOVED_TO | INotify.IN_DELETE_SELF
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._inotify = INotify()
+        try:
+            self._inotify.add_watch(os.path.dirname(Tapdisk.TAP_DEV),
+                                    self.MASK)
+        except TapdiskException:
+            self._inotify.close()
+            raise
+        self._lock = threading.Lock()
+        self._table = None
+        self._timestamp = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+
+    def snapshot(self):
+        with self._lock:
+            changed = self._inotify.pending()
+            if changed or self._table is None or \
+                    time.time() - self._timestamp > self.interval:
+                self._table = TapdiskTable(Tapdisk.list())
+                self._timestamp = time.time()
+            return self._table
+
+    def close(self):
+        with self._lock:
+            self._inotify.close()
+            self._table = None
+
+
+class TapdiskTable(object):
+    '''Snapshot of the tapdisks on this host, indexed by minor, volume
+    and pid. Take one per operation with ``Tapdisk.snapshot()`` and pass it
+    to the ``Tapdisk`` helpers so they do not list tapdisks again.'''
+    __slots__ = ('_tapdisks', '_by_minor', '_by_volume', '_by_pid')
+
+    def __init__(self, tapdisks):
+        self._tapdisks = list(tapdisks)
+        self._by_minor = {}
+        self._by_volume = {}
+        self._by_pid = {}
+        for tapdisk in self._tapdisks:
+            self._by_minor[tapdisk.minor] = tapdisk
+            if tapdisk.volume is not None:
+                self._by_volume[tapdisk.volume] = tapdisk
+            if tapdisk.pid is not None:
+                self._by_pid.setdefault(tapdisk.pid, []).append(tapdisk)
+
+    def __iter__(self):
+        return iter(self._tapdisks)
+
+    def __len__(self):
+        return len(self._tapdisks)
+
+    def from_minor(self, minor):
+        return self._by_minor.get(minor)
+
+    def from_volume(self, volume):
+        return self._by_volume.get(volume)
+
+    def from_pid(self, pid):
+        return list(self._by_pid.get(pid, ()))
+
+    def from_device(self, device):
+        minor = Tapdisk.minor(device)
+        if minor is None:
+            return None
+        return self._by_minor.get(minor)
+
+
+class TapdiskPool(object):
+    '''Keeps ``size`` tapdisks allocated, spawned and attached ahead of
+    time, so attaching a volume only needs ``tap-ctl open``. A background
+    thread refills the pool after every ``take``.
+
+    Pooled tapdisks have no image open, so ``tap-ctl list`` does not
+    report them as openvstorage tapdisks; ``minors`` tells which they
+    are. With a ``state_dir`` they are also recorded in a file of this
+    process there, so the pool of a later process can destroy those an
+    agent that died left behind.'''
+    # Seconds to wait before retrying after a failed refill
+    RETRY = 5
+    STATE = 'tapdisk-pool-%d.json'
+
+    def __init__(self, size, state_dir=None):
+        self.size = size
+        self.state_dir = state_dir
+        self._ready = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _state_file(self, pid):
+        return os.path.join(self.state_dir, self.STATE % (pid,))
+
+    def _save(self):
+        '''Record the idle tapdisks, with the pool lock held.'''
+        if self.state_dir is None:
+            return
+        path = self._state_file(os.getpid())
+        if not self._ready and self._stopped.is_set():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        tmp = '%s.tmp' % (path,)
+        with open(tmp, 'w') as fh:
+            json.dump([[t.pid, t.minor] for t in self._ready], fh)
+        os.rename(tmp, path)
+
+    @classmethod
+    def _recorded(cls, state_dir):
+        '''The ``(pid, path, tapdisks)`` of every pool state file in
+        ``state_dir``, ``tapdisks`` being ``[pid, minor]`` pairs.'''
+        prefix, suffix = cls.STATE.split('%d')
+        try:
+            names = os.listdir(state_dir)
+        except OSError:
+            return []
+        recorded = []
+        for name in names:
+            if not (name.startswith(prefix) and name.endswith(suffix)):
+                continue
+            try:
+                pid = int(name[len(prefix):-len(suffix)])
+            except ValueError:
+                continue
+            path = os.path.join(state_dir, name)
+            try:
+                with open(path) as fh:
+                    tapdisks = json.load(fh)
+            except (IOError, ValueError):
+                tapdisks = []
+            recorded.append((pid, path, tapdisks))
+        return recorded
+
+    @classmethod
+    def pooled_minors(cls, state_dir):
+        '''The minors of the idle tapdisks that the pools of the running
+        processes recorded in ``state_dir``.'''
+        if state_dir is None:
+            return set()
+        return set(minor for pid, _, tapdisks in cls._recorded(state_dir)
+                   if pid == os.getpid() or _alive(pid)
+                   for _, minor in tapdisks)
+
+    def reclaim(self):
+        '''Destroy the idle tapdisks that the pools of processes that are
+        gone recorded and that still have no image open. Return how many
+        were destroyed.'''
+        if self.state_dir is None:
+            return 0
+        leftovers = []
+        for pid, path, tapdisks in self._recorded(self.state_dir):
+            if pid == os.getpid() or _alive(pid):
+                continue
+            leftovers.extend(tapdisks)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        if not leftovers:
+            return 0
+        table = TapdiskTable(Tapdisk.list_all())
+        reclaimed = 0
+        for pid, minor in leftovers:
+            tapdisk = table.from_minor(minor)
+            # The minor may have been reused since
+            if tapdisk is None or tapdisk.driver is not None or \
+                    str(tapdisk.pid) != str(pid):
+                continue
+            try:
+                Tapdisk.exc(*Tapdisk.destroy_args(tapdisk))
+                reclaimed += 1
+            except TapdiskException:
+                pass
+        return reclaimed
+
+    def _prepare(self):
+        device = Tapdisk.exc('allocate')
+        minor = Tapdisk.minor(device)
+        if minor is None:
+            raise TapdiskException('allocate returned %r' % (device,))
+        try:
+            pid = Tapdisk.exc('spawn')
+            Tapdisk.exc('attach', '-p%s' % pid, '-m%s' % minor)
+        except TapdiskException:
+            Tapdisk.exc('free', '-m%s' % minor)
+            raise
+        return Tapdisk.TapdiskInt(pid=pid, minor=minor,
+                                  device='%s%s' % (Tapdisk.TAP_DEV, minor))
+
+    def fill(self):
+        '''Prepare tapdisks until the pool is full.'''
+        while not self._stopped.is_set():
+            with self._lock:
+                if len(self._ready) >= self.size:
+                    return
+            tapdisk = self._prepare()
+            with self._lock:
+                self._ready.append(tapdisk)
+                self._save()
+
+    def _run(self):
+        try:
+            self.reclaim()
+        except (TapdiskException, OSError):
+            # The reconciler finds them as leaked minors
+            pass
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self.fill()
+            except TapdiskException:
+                self._stopped.wait(self.RETRY)
+                continue
+            self._wakeup.wait()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='openvstorage-tapdisk-pool')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def take(self):
+        '''A prepared ``TapdiskInt``, ``None`` if the pool is empty.'''
+        with self._lock:
+            tapdisk = self._ready.pop() if self._ready else None
+            if tapdisk is not None:
+                self._save()
+        self._wakeup.set()
+        return tapdisk
+
+    def minors(self):
+        with self._lock:
+            return set(tapdisk.minor for tapdisk in self._ready)
+
+    def open(self, volume, readonly=False, timeout=None):
+        '''Open ``volume`` on a pooled tapdisk and return its device,
+        ``None`` if the pool is empty or the open failed, so the caller
+        creates a tapdisk instead. A tapdisk that fails to open is
+        destroyed.'''
+        tapdisk = self.take()
+        if tapdisk is None:
+            return None
+        args = ['open', '-p%s' % tapdisk.pid, '-m%s' % tapdisk.minor,
+                '-a%s:%s' % ('openvstorage', volume)]
+        if readonly:
+            args.append('-R')
+        try:
+            Tapdisk.exc(*args, timeout=timeout)
+        except TapdiskException:
+            try:
+                Tapdisk.exc(*Tapdisk.destroy_args(tapdisk))
+            except TapdiskException:
+                pass
+            return None
+        return tapdisk.device
+
+    def close(self):
+        '''Stop refilling and destroy the idle tapdisks.'''
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            ready, self._ready = self._ready, []
+        for tapdisk in ready:
+            try:
+                Tapdisk.exc(*Tapdisk.destroy_args(tapdisk))
+            except TapdiskException:
+                pass
+        with self._lock:
+            self._save()
+
+
+def _alive(pid):
+    '''Whether process ``pid`` exists.'''
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class HolderIndex(object):
+    '''Who holds which block device, from one read of
+    ``/proc/self/mountinfo`` and of the ``holders`` of ``/sys/block``.
+    Build one per operation, or per batch, instead of scanning
+    ``/proc/mounts`` or running ``fuser`` per device.'''
+    MOUNTINFO = '/proc/self/mountinfo'
+    SYS_BLOCK = '/sys/block'
+    __slots__ = ('_mounts', '_holders', '_parents')
+
+    def __init__(self, mounts, holders, parents):
+        self._mounts = mounts
+        self._holders = holders
+        self._parents = parents
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as fh:
+                return fh.read().strip()
+        except IOError:
+            return None
+
+    @classmethod
+    def build(cls):
+        mounts = {}
+        try:
+            with open(cls.MOUNTINFO) as fh:
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) > 4:
+                        mounts.setdefault(fields[2], []).append(fields[4])
+        except IOError:
+            pass
+        holders = {}
+        parents = {}
+        try:
+            names = os.listdir(cls.SYS_BLOCK)
+        except OSError:
+            names = []
+        for name in names:
+            directory = os.path.join(cls.SYS_BLOCK, name)
+            dev = cls._read(os.path.join(directory, 'dev'))
+            if dev is None:
+                continue
+            try:
+                holders[dev] = os.listdir(os.path.join(directory, 'holders'))
+            except OSError:
+                holders[dev] = []
+            # Partitions are subdirectories with a dev of their own
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                entries = []
+            for entry in entries:
+                if entry.startswith(name):
+                    part = cls._read(os.path.join(directory, entry, 'dev'))
+                    if part is not None:
+                        parents.setdefault(dev, []).append(part)
+        return cls(mounts, holders, parents)
+
+    @staticmethod
+    def dev(device):
+        '''The ``major:minor`` of ``device``, ``None`` if it is gone.'''
+        try:
+            rdev = os.stat(device).st_rdev
+        except OSError:
+            return None
+        return '%d:%d' % (os.major(rdev), os.minor(rdev))
+
+    def holders(self, device):
+        '''Mount points of ``device`` and of its partitions, and the
+        devices (e.g. device-mapper) stacked on them.'''
+        dev = self.dev(device)
+        if dev is None:
+            return []
+        found = []
+        for each in [dev] + self._parents.get(dev, []):
+            found.extend(self._mounts.get(each, ()))
+            found.extend(self._holders.get(each, ()))
+        return found
+
+    def is_busy(self, device):
+        return bool(self.holders(device))
+
+
 class Tapdisk(object):
     '''Tapdisk operations'''
     TAP_CTL = 'tap-ctl'
     TAP_DEV = '/dev/xen/blktap-2/tapdev'
+    # tap-ctl commands that do not change any tapdisk
+    READ_ONLY = ('list', 'stats', 'check')
+    # Seconds a tap-ctl command may run before it is killed
+    TIMEOUT = 60
+    watcher = None
+    pool = None
 
     class TapdiskInt(object):
+        __slots__ = ('pid', 'minor', 'state', 'volume', 'device', 'driver')
+
         def __init__(self, pid=None, minor=-1, state=None, volume=None,
                      device=None, driver=None):
             self.pid = pid
@@ -78,14 +620,49 @@ class Tapdisk(object):
                       self.device)
 
     @staticmethod
-    def exc(*args):
-        rc, stdout, stderr = doexec([Tapdisk.TAP_CTL] + list(args))
-        out, err = stdout.read().strip(), stderr.read().strip()
-        stdout.close()
-        stderr.close()
-        if rc:
+    def invalidate(*args):
+        '''Tell the watcher, if any, that ``tap-ctl args`` changes the
+        tapdisks.'''
+        if Tapdisk.watcher is not None and args[0] not in Tapdisk.READ_ONLY:
+            Tapdisk.watcher.invalidate()
+
+    @staticmethod
+    def run(*args, **kwargs):
+        '''Run ``tap-ctl args`` and return its ``ExecResult``.
+
+        :param timeout: Seconds before the command is killed, defaults to
+            ``Tapdisk.TIMEOUT``.'''
+        try:
+            return timed(TAP_CTL_CALL, 'tap-ctl', args[0],
+                         Tapdisk.subject(args), execute,
+                         [Tapdisk.TAP_CTL] + list(args),
+                         timeout=kwargs.get('timeout', Tapdisk.TIMEOUT))
+        finally:
+            # Once it ran, so a table listed meanwhile is not kept
+            Tapdisk.invalidate(*args)
+
+    @staticmethod
+    def subject(args):
+        '''The volume, or failing that the minor, ``tap-ctl args`` is
+        about.'''
+        minor = None
+        for arg in args[1:]:
+            if arg.startswith('-a') and ':' in arg:
+                return arg.split(':', 1)[1]
+            if arg.startswith('-m'):
+                minor = arg[2:]
+        return minor
+
+    @staticmethod
+    def exc(*args, **kwargs):
+        result = Tapdisk.run(*args, **kwargs)
+        out, err = result.out.strip(), result.err.strip()
+        if result.timed_out:
+            raise TapdiskTimeout('%s timed out after %.1fs (%s %s)' %
+                                 (args, result.elapsed, out, err))
+        if result.rc:
             raise TapdiskException('%s failed (%s %s %s)' %
-                                   (args, rc, out, err))
+                                   (args, result.rc, out, err))
         return out
 
     @staticmethod
@@ -99,12 +676,27 @@ class Tapdisk(object):
 
     @staticmethod  # NOQA
     def list():
+        return Tapdisk.parse_list(Tapdisk.exc('list'))
+
+    @staticmethod
+    def list_all():
+        '''Every tapdisk and allocated minor, including those with no
+        image open, whose ``driver`` is ``None``.'''
+        return Tapdisk.parse_list(Tapdisk.exc('list'), drivers=None)
+
+    @staticmethod
+    def parse_list(_list, drivers=('openvstorage',)):
+        '''Parse the output of ``tap-ctl list``.
+
+        :param drivers: Drivers of the tapdisks to return, all of them if
+            ``None``.'''
         tapdisks = []
-        _list = Tapdisk.exc('list')
         if not _list:
             return []
 
         for line in _list.split('\n'):
+            if not line.strip():
+                continue
             tapdisk = Tapdisk.TapdiskInt()
 
             for pair in line.split():
@@ -121,61 +713,122 @@ class Tapdisk(object):
                 elif key == 'args' and value.find(':') != -1:
                     args = value.split(':')
                     tapdisk.driver = args[0]
-                    tapdisk.volume = args[1]
+                    # Volumes in a directory of the vPool go by their name
+                    tapdisk.volume = args[1].rsplit('/', 1)[-1]
 
-            if tapdisk.driver == "openvstorage":
+            if drivers is None or tapdisk.driver in drivers:
                 tapdisks.append(tapdisk)
 
         return tapdisks
 
     @staticmethod
-    def fromDevice(device):
-        if device.startswith(Tapdisk.TAP_DEV):
-            minor = os.minor(os.stat(device).st_rdev)
-            tapdisks = filter(lambda x: x.minor == minor, Tapdisk.list())
-            if len(tapdisks) == 1:
-                return tapdisks[0]
-        return None
+    def start_watcher(interval=60):
+        '''Serve ``snapshot`` from a ``TapdiskWatcher`` from now on.'''
+        if Tapdisk.watcher is None:
+            Tapdisk.watcher = TapdiskWatcher(interval)
+        return Tapdisk.watcher
+
+    @staticmethod
+    def stop_watcher():
+        watcher, Tapdisk.watcher = Tapdisk.watcher, None
+        if watcher is not None:
+            watcher.close()
+
+    @staticmethod
+    def start_pool(size, state_dir=None):
+        '''Attach through a ``TapdiskPool`` of ``size`` tapdisks from
+        now on, until ``stop_pool`` or the process exits.'''
+        if Tapdisk.pool is None:
+            Tapdisk.pool = TapdiskPool(size, state_dir).start()
+            atexit.register(Tapdisk.stop_pool)
+        return Tapdisk.pool
+
+    @staticmethod
+    def stop_pool():
+        pool, Tapdisk.pool = Tapdisk.pool, None
+        if pool is not None:
+            pool.close()
 
     @staticmethod
-    def create(volume, readonly=False):
+    def snapshot():
+        if Tapdisk.watcher is not None:
+            return Tapdisk.watcher.snapshot()
+        return TapdiskTable(Tapdisk.list())
+
+    @staticmethod
+    def minor(device):
+        '''Minor number of a tapdev, taken from its name.'''
+        if not device.startswith(Tapdisk.TAP_DEV):
+            return None
+        try:
+            return int(device[len(Tapdisk.TAP_DEV):])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def fromDevice(device, table=None):
+        if Tapdisk.minor(device) is None:
+            return None
+        if table is None:
+            table = Tapdisk.snapshot()
+        return table.from_device(device)
+
+    @staticmethod
+    def create_args(volume, readonly=False):
         uri = "%s:%s" % ('openvstorage', volume)
 
         if readonly:
-            return Tapdisk.exc('create', "-a%s" % uri, '-R')
+            return ('create', "-a%s" % uri, '-R')
         else:
-            return Tapdisk.exc('create', "-a%s" % uri)
+            return ('create', "-a%s" % uri)
+
+    @staticmethod
+    def create(volume, readonly=False, timeout=None):
+        if timeout is None:
+            timeout = Tapdisk.TIMEOUT
+        if Tapdisk.pool is not None:
+            device = Tapdisk.pool.open(volume, readonly, timeout)
+            if device is not None:
+                return device
+        return Tapdisk.exc(*Tapdisk.create_args(volume, readonly),
+                           timeout=timeout)
 
     @staticmethod
-    def destroy(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def destroy_args(tapdisk):
+        if tapdisk.pid:
+            return ('destroy', '-p%s' % tapdisk.pid, '-m%s' % tapdisk.minor)
+        else:
+            return ('free', '-m%s' % tapdisk.minor)
+
+    @staticmethod
+    def destroy(device, table=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk:
-            if tapdisk.pid:
-                Tapdisk.exc('destroy',
-                            '-p%s' % tapdisk.pid,
-                            '-m%s' % tapdisk.minor)
-            else:
-                Tapdisk.exc('free', '-m%s' % tapdisk.minor)
+            Tapdisk.exc(*Tapdisk.destroy_args(tapdisk))
 
     @staticmethod
-    def pause(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def pause(device, table=None, timeout=None):
+        '''Pause the tapdisk, which returns once its in-flight requests
+        completed.'''
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk and tapdisk.pid:
             Tapdisk.exc('pause',
                         '-p%s' % tapdisk.pid,
-                        '-m%s' % tapdisk.minor)
+                        '-m%s' % tapdisk.minor,
+                        timeout=timeout or Tapdisk.TIMEOUT)
 
     @staticmethod
-    def unpause(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def unpause(device, table=None, timeout=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk and tapdisk.pid:
             Tapdisk.exc('unpause',
                         '-p%s' % tapdisk.pid,
-                        '-m%s' % tapdisk.minor)
+                        '-m%s' % tapdisk.minor,
+                        timeout=timeout or Tapdisk.TIMEOUT)
 
     @staticmethod
-    def stats(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def stats(device, table=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk and tapdisk.pid:
             import json
             stats = Tapdisk.exc('stats',
@@ -186,38 +839,43 @@ class Tapdisk(object):
 
     @staticmethod
     def busy_pid(device):
-        rc, stdout, stderr = doexec(['fuser', device])
-        out = stdout.read().strip()
-        stderr.close()
-        stdout.close()
-        return out
+        return execute(['fuser', device],
+                       timeout=Tapdisk.TIMEOUT).out.strip()
 
     @staticmethod
     def is_mounted(device):
-        fd = open("/proc/mounts", "r")
-        for line in fd.readlines():
-            if device == line.split()[0]:
-                return True
-        fd.close()
-        return False
+        return bool(HolderIndex.build().holders(device))
+
+    @staticmethod
+    def is_readonly(device):
+        '''Whether the tapdev was created read-only, ``None`` if its
+        block device cannot be found.'''
+        dev = HolderIndex.dev(device)
+        if dev is None:
+            return None
+        try:
+            with open('/sys/dev/block/%s/ro' % (dev,)) as fh:
+                return fh.read().strip() == '1'
+        except IOError:
+            return None
 
     @staticmethod
-    def is_paused(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def is_paused(device, table=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk:
             return not not (tapdisk.state & TDFlags.TD_PAUSED)
         return None
 
     @staticmethod
-    def is_running(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def is_running(device, table=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk:
             return not (tapdisk.state & TDFlags.TD_PAUSE_MASK)
         return None
 
     @staticmethod
-    def query_state(device):
-        tapdisk = Tapdisk.fromDevice(device)
+    def query_state(device, table=None):
+        tapdisk = Tapdisk.fromDevice(device, table)
         if tapdisk:
             if tapdisk.state & TDFlags.TD_PAUSED:
                 return "paused"
@@ -0,0 +1,361 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.blktap``.
+"""
+import os
+import subprocess
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import blktap
+from openvstorage_flocker_plugin.testtools import FakeTapCtl
+
+
+class TapdiskWatcherMixin(object):
+    """
+    Serves ``Tapdisk.snapshot`` from a ``TapdiskWatcher`` watching an empty
+    temporary directory, so only invalidation and the interval refresh it.
+    """
+
+    def start_watcher(self, interval=3600):
+        tap_dev = blktap.Tapdisk.TAP_DEV
+        directory = self.watched = self.mktemp()
+        os.mkdir(directory)
+        blktap.Tapdisk.TAP_DEV = os.path.join(directory, "tapdev")
+        try:
+            watcher = blktap.TapdiskWatcher(interval)
+        finally:
+            blktap.Tapdisk.TAP_DEV = tap_dev
+        self.addCleanup(watcher.close)
+        self.patch(blktap.Tapdisk, "watcher", watcher)
+        return watcher
+
+
+class HolderTreeMixin(object):
+    """
+    Points ``HolderIndex`` at a temporary mountinfo and ``/sys/block``.
+    """
+
+    def holder_tree(self, mounts=(), devices=()):
+        """
+        :param mounts: ``(major:minor, mount point)`` pairs.
+        :param devices: ``(name, major:minor, holders, partitions)`` of the
+            block devices, ``partitions`` being ``(name, major:minor)``.
+        """
+        root = self.mktemp()
+        sys_block = os.path.join(root, "block")
+        os.makedirs(sys_block)
+        mountinfo = os.path.join(root, "mountinfo")
+        with open(mountinfo, "w") as fh:
+            for index, (dev, mountpoint) in enumerate(mounts):
+                fh.write("%d 1 %s / %s rw - ext4 /dev/x rw\n" %
+                         (index + 20, dev, mountpoint))
+        for name, dev, holders, partitions in devices:
+            directory = os.path.join(sys_block, name)
+            os.makedirs(os.path.join(directory, "holders"))
+            for holder in holders:
+                open(os.path.join(directory, "holders", holder), "w").close()
+            for part, part_dev in [(name, dev)] + [
+                    (os.path.join(name, p), d) for p, d in partitions]:
+                path = os.path.join(sys_block, part)
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                with open(os.path.join(path, "dev"), "w") as fh:
+                    fh.write(part_dev + "\n")
+        self.patch(blktap.HolderIndex, "MOUNTINFO", mountinfo)
+        self.patch(blktap.HolderIndex, "SYS_BLOCK", sys_block)
+
+
+class HolderIndexTests(HolderTreeMixin, TestCase):
+    """
+    Tests for ``HolderIndex`` on a fake mountinfo and holders tree, with
+    the character devices of ``/dev/null`` and ``/dev/zero`` standing in
+    for tapdevs.
+    """
+
+    def setUp(self):
+        self.null = blktap.HolderIndex.dev(os.devnull)
+        self.zero = blktap.HolderIndex.dev("/dev/zero")
+
+    def test_holders(self):
+        """
+        The devices stacked on a device and the mounts of its partitions
+        hold it.
+        """
+        self.holder_tree(
+            mounts=[("250:1", "/mnt/data"), (self.zero, "/mnt/other")],
+            devices=[("tapdeva", self.null, ["dm-0"],
+                      [("tapdeva1", "250:1")])])
+        holders = blktap.HolderIndex.build()
+        self.assertEqual((["dm-0", "/mnt/data"], True),
+                         (holders.holders(os.devnull),
+                          holders.is_busy(os.devnull)))
+
+    def test_mounted(self):
+        """
+        A device mounted without partitions is held by its mount point.
+        """
+        self.holder_tree(mounts=[(self.zero, "/mnt/zero")],
+                         devices=[("tapdevb", self.zero, [], [])])
+        self.assertEqual(["/mnt/zero"],
+                         blktap.HolderIndex.build().holders("/dev/zero"))
+
+    def test_free(self):
+        """
+        Devices nothing holds, missing from ``/sys/block`` or gone are not
+        busy.
+        """
+        self.holder_tree(devices=[("tapdeva", self.null, [], [])])
+        holders = blktap.HolderIndex.build()
+        self.assertEqual(
+            [False, False, False],
+            [holders.is_busy(device) for device in
+             (os.devnull, "/dev/zero", os.path.join(self.mktemp(), "gone"))])
+
+
+class TapdiskTableTests(TestCase):
+    """
+    Tests for ``TapdiskTable`` built from ``FakeTapCtl`` listings.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.tap_ctl.seed(["vol-a", "flocker/vol-b"])
+        # A minor without an image, as a leak or a pooled tapdisk
+        self.idle = blktap.Tapdisk.minor(blktap.Tapdisk.exc("allocate"))
+
+    def test_by_volume(self):
+        """
+        Tapdisks are found by volume, those in a directory of the vPool by
+        their name.
+        """
+        table = blktap.TapdiskTable(blktap.Tapdisk.list())
+        self.assertEqual(
+            (2, [0, 1], None),
+            (len(table), [table.from_volume(v).minor
+                          for v in ("vol-a", "vol-b")],
+             table.from_volume("vol-c")))
+
+    def test_by_minor(self):
+        """
+        Every listed minor is found by its number or its tapdev.
+        """
+        table = blktap.TapdiskTable(blktap.Tapdisk.list_all())
+        self.assertEqual(
+            (["vol-a", "vol-b", None], "vol-b", None, None),
+            ([table.from_minor(m).volume for m in (0, 1, self.idle)],
+             table.from_device(blktap.Tapdisk.TAP_DEV + "1").volume,
+             table.from_device("/dev/sda"), table.from_minor(9)))
+
+    def test_by_pid(self):
+        """
+        Tapdisks are found by the pid of their tapdisk process, several
+        for a process that serves several minors.
+        """
+        other = blktap.Tapdisk.minor(blktap.Tapdisk.exc("allocate"))
+        pid = blktap.Tapdisk.exc("spawn")
+        for minor in (self.idle, other):
+            blktap.Tapdisk.exc("attach", "-p%s" % (pid,), "-m%s" % (minor,))
+        table = blktap.TapdiskTable(blktap.Tapdisk.list_all())
+        self.assertEqual(
+            ([self.idle, other], ["vol-a"], []),
+            ([t.minor for t in table.from_pid(pid)],
+             [t.volume for t in table.from_pid(table.from_minor(0).pid)],
+             table.from_pid("999")))
+
+    def test_iter(self):
+        """
+        The table iterates over the tapdisks in the order listed.
+        """
+        table = blktap.TapdiskTable(blktap.Tapdisk.list_all())
+        self.assertEqual([0, 1, self.idle], [t.minor for t in table])
+
+
+class TapdiskWatcherTests(TapdiskWatcherMixin, TestCase):
+    """
+    Tests for ``TapdiskWatcher`` against ``FakeTapCtl``.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.tap_ctl.seed(["vol"])
+        self.listings = 0
+        execute = blktap.execute
+
+        def count(args, *rest, **kwargs):
+            if args[1] == "list":
+                self.listings += 1
+            return execute(args, *rest, **kwargs)
+        self.patch(blktap, "execute", count)
+
+    def test_cached(self):
+        """
+        Without changes the table is listed once.
+        """
+        self.start_watcher()
+        table = blktap.Tapdisk.snapshot()
+        self.assertEqual((table, 1), (blktap.Tapdisk.snapshot(),
+                                      self.listings))
+
+    def test_read_only_command(self):
+        """
+        A ``tap-ctl`` command that changes no tapdisk keeps the table.
+        """
+        self.start_watcher()
+        table = blktap.Tapdisk.snapshot()
+        blktap.Tapdisk.stats(table.from_volume("vol").device, table)
+        self.assertIs(table, blktap.Tapdisk.snapshot())
+
+    def test_mutating_command(self):
+        """
+        After a ``tap-ctl`` command that changes a tapdisk the table is
+        listed again.
+        """
+        self.start_watcher()
+        table = blktap.Tapdisk.snapshot()
+        blktap.Tapdisk.pause(table.from_volume("vol").device, table)
+        self.assertEqual(
+            (True, 2),
+            (blktap.Tapdisk.is_paused(table.from_volume("vol").device),
+             self.listings))
+
+    def test_tapdev_changed(self):
+        """
+        A tapdev appearing in the watched directory refreshes the table.
+        """
+        self.start_watcher()
+        blktap.Tapdisk.snapshot()
+        open(os.path.join(self.watched, "tapdev9"), "w").close()
+        blktap.Tapdisk.snapshot()
+        self.assertEqual(2, self.listings)
+
+    def test_interval(self):
+        """
+        A table older than ``interval`` is listed again.
+        """
+        self.start_watcher(interval=-1)
+        blktap.Tapdisk.snapshot()
+        blktap.Tapdisk.snapshot()
+        self.assertEqual(2, self.listings)
+
+    def test_listed_during_command(self):
+        """
+        A table listed by another thread while a ``tap-ctl`` command runs
+        is not served once it returned, even if no tapdev changed.
+        """
+        self.start_watcher()
+        device = blktap.Tapdisk.snapshot().from_volume("vol").device
+        execute = blktap.execute
+
+        def listed_meanwhile(args, *rest, **kwargs):
+            if args[1] != "list":
+                blktap.Tapdisk.snapshot()
+            return execute(args, *rest, **kwargs)
+        self.patch(blktap, "execute", listed_meanwhile)
+        blktap.Tapdisk.pause(device)
+        state = blktap.Tapdisk.snapshot().from_volume("vol").state
+        self.assertTrue(state & blktap.TDFlags.TD_PAUSED)
+
+
+class TapdiskPoolTests(TestCase):
+    """
+    Tests for ``TapdiskPool`` against ``FakeTapCtl``.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.state_dir = self.mktemp()
+        os.mkdir(self.state_dir)
+
+    def pool(self, size=2):
+        """
+        A filled pool, without its refill thread.
+        """
+        pool = blktap.TapdiskPool(size, self.state_dir)
+        self.addCleanup(pool.close)
+        pool.fill()
+        return pool
+
+    def idle(self):
+        return [t["minor"] for t in self.tap_ctl.tapdisks if not t["args"]]
+
+    def test_open(self):
+        """
+        ``open`` opens the volume on a pooled tapdisk.
+        """
+        pool = self.pool()
+        minors = pool.minors()
+        device = pool.open("vol")
+        self.assertIn(blktap.Tapdisk.minor(device), minors)
+        self.assertEqual([("openvstorage:vol", blktap.Tapdisk.minor(device))],
+                         [(t["args"], t["minor"])
+                          for t in self.tap_ctl.tapdisks if t["args"]])
+
+    def test_open_failure_falls_back(self):
+        """
+        When opening a pooled tapdisk fails, ``Tapdisk.create`` creates one
+        instead.
+        """
+        pool = self.pool(size=1)
+        self.patch(blktap.Tapdisk, "pool", pool)
+        # Gone behind the back of the pool, so open fails
+        blktap.Tapdisk.exc("free", "-m%s" % (pool.minors().pop(),))
+        device = blktap.Tapdisk.create("vol")
+        self.assertEqual([("openvstorage:vol", blktap.Tapdisk.minor(device))],
+                         [(t["args"], t["minor"])
+                          for t in self.tap_ctl.tapdisks])
+
+    def test_close(self):
+        """
+        ``close`` destroys the idle tapdisks and removes the state file.
+        """
+        pool = self.pool()
+        pool.close()
+        self.assertEqual(([], []), (self.idle(), os.listdir(self.state_dir)))
+
+    def test_reclaim(self):
+        """
+        ``reclaim`` destroys the idle tapdisks recorded by a pool of a
+        process that is gone, but not those opened since.
+        """
+        self.pool()
+        saved = os.path.join(self.state_dir,
+                             blktap.TapdiskPool.STATE % (os.getpid(),))
+        child = subprocess.Popen(["true"])
+        child.wait()
+        os.rename(saved, os.path.join(
+            self.state_dir, blktap.TapdiskPool.STATE % (child.pid,)))
+        minor = self.idle()[0]
+        blktap.Tapdisk.exc("open", "-m%s" % (minor,), "-aopenvstorage:vol")
+
+        reclaimed = blktap.TapdiskPool(2, self.state_dir).reclaim()
+        self.assertEqual((1, [minor], []),
+                         (reclaimed,
+                          [t["minor"] for t in self.tap_ctl.tapdisks],
+                          os.listdir(self.state_dir)))
+
+    def test_reclaim_live(self):
+        """
+        The state file of a process that runs is left alone.
+        """
+        self.pool()
+        self.assertEqual(0, blktap.TapdiskPool(2, self.state_dir).reclaim())
+        self.assertEqual(2, len(self.idle()))
@@ -0,0 +1,580 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.openvstorage_blockdevice`` against
+the in-process stand-ins of ``testtools``, so they need neither a vPool nor
+blktap.
+"""
+import json
+import os
+import threading
+from uuid import uuid4
+
+from twisted.trial.unittest import TestCase
+
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, UnattachedVolume, UnknownVolume
+)
+
+from openvstorage_flocker_plugin import blktap
+from openvstorage_flocker_plugin.blktap_tests import HolderTreeMixin
+from openvstorage_flocker_plugin.locks import VolumeLocks
+from openvstorage_flocker_plugin.openvstorage_blockdevice import DeviceBusy
+from openvstorage_flocker_plugin.profiles import InvalidProfile
+from openvstorage_flocker_plugin.testtools import (
+    FakeStorageRouterClient, FakeTapCtl, fake_blockdevice_api, src
+)
+
+GiB = 1024 * 1024 * 1024
+
+
+class FakeDriverMixin(object):
+    """
+    Runs the driver against a ``FakeStorageRouterClient`` and
+    ``FakeTapCtl``.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.client = FakeStorageRouterClient("fake.json")
+
+    def api(self, **kwargs):
+        kwargs.setdefault("lock_dir", None)
+        return fake_blockdevice_api(self.client, **kwargs)
+
+    def patch_static(self, cls, name, function):
+        """
+        Replace the static method ``name`` of ``cls`` for the test; unlike
+        ``patch`` this restores it as a static method.
+        """
+        saved = cls.__dict__[name]
+        setattr(cls, name, staticmethod(function))
+        self.addCleanup(setattr, cls, name, saved)
+
+    def blockdevice_ids(self, api):
+        return sorted(volume.blockdevice_id for volume in api.list_volumes())
+
+
+class LifecycleTests(FakeDriverMixin, TestCase):
+    """
+    Tests for creating, attaching, detaching and destroying a volume.
+    """
+
+    def test_create(self):
+        """
+        A new volume is listed with its size rounded up to the allocation
+        unit, next to the vdisks that are not Flocker volumes.
+        """
+        self.client.populate(3)
+        api = self.api()
+        dataset_id = uuid4()
+        volume = api.create_volume(dataset_id, GiB - 1)
+        self.assertEqual(
+            [(volume.blockdevice_id, GiB, dataset_id, None)],
+            [(v.blockdevice_id, v.size, v.dataset_id, v.attached_to)
+             for v in api.list_volumes()])
+
+    def test_create_cluster_aligned(self):
+        """
+        With an allocation unit that is not a multiple of the cluster size
+        of the vPool, sizes are rounded up to a multiple of both.
+        """
+        vpool_conf_file = self.mktemp()
+        with open(vpool_conf_file, "w") as fh:
+            json.dump({"volume_manager": {"default_cluster_size": 4096}}, fh)
+        self.client = FakeStorageRouterClient(vpool_conf_file)
+        api = self.api(allocation_unit=6000)
+        # The LCM of 6000 and 4096
+        unit = 1536000
+        volume = api.create_volume(uuid4(), GiB)
+        self.assertEqual(
+            (unit, 700 * unit, [700 * unit]),
+            (api.allocation_unit(), volume.size,
+             [v.size for v in api.list_volumes()]))
+
+    def test_attach_detach(self):
+        """
+        An attached volume has a tapdev until it is detached.
+        """
+        api = self.api()
+        volume = api.create_volume(uuid4(), GiB)
+        attached = api.attach_volume(volume.blockdevice_id,
+                                     api.compute_instance_id())
+        self.assertEqual(api.compute_instance_id(), attached.attached_to)
+        self.assertEqual([attached], api.list_volumes())
+        self.assertTrue(api.get_device_path(volume.blockdevice_id).path
+                        .startswith("/dev/xen/blktap-2/tapdev"))
+        api.detach_volume(volume.blockdevice_id)
+        self.assertRaises(UnattachedVolume, api.get_device_path,
+                          volume.blockdevice_id)
+        self.assertEqual([], self.tap_ctl.tapdisks)
+
+    def test_attach_twice(self):
+        """
+        Attaching an attached volume raises ``AlreadyAttachedVolume``.
+        """
+        api = self.api()
+        volume = api.create_volume(uuid4(), GiB)
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        self.assertRaises(AlreadyAttachedVolume, api.attach_volume,
+                          volume.blockdevice_id, api.compute_instance_id())
+
+    def test_destroy(self):
+        """
+        A destroyed volume is no longer listed nor known.
+        """
+        api = self.api()
+        volume = api.create_volume(uuid4(), GiB)
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual([], api.list_volumes())
+        self.assertRaises(UnknownVolume, api.destroy_volume,
+                          volume.blockdevice_id)
+        self.assertRaises(UnknownVolume, api.attach_volume,
+                          volume.blockdevice_id, api.compute_instance_id())
+
+    def test_list_cached(self):
+        """
+        Once the sizes are cached, ``list_volumes`` costs one listing.
+        """
+        api = self.api()
+        for _ in range(3):
+            api.create_volume(uuid4(), GiB)
+        api.list_volumes()
+        self.client.reset_calls()
+        api.list_volumes()
+        self.assertEqual({"list_volumes_by_path": 1}, self.client.calls)
+
+
+class DestroyAllTests(FakeDriverMixin, TestCase):
+    """
+    Tests for ``OpenvStorageBlockDeviceAPI.destroy_all_flocker_volumes``.
+    """
+
+    def test_destroys_everything(self):
+        """
+        Attached and unattached volumes are all detached and destroyed.
+        """
+        api = self.api()
+        attached = api.create_volume(uuid4(), GiB)
+        api.create_volume(uuid4(), GiB)
+        api.attach_volume(attached.blockdevice_id, api.compute_instance_id())
+        api.destroy_all_flocker_volumes()
+        self.assertEqual(([], []),
+                         (self.blockdevice_ids(api), self.tap_ctl.tapdisks))
+
+    def test_failed_detach_keeps_volume(self):
+        """
+        A volume whose detach failed keeps its vdisk, and the failure is
+        raised once the other volumes were destroyed.
+        """
+        api = self.api()
+        attached = api.create_volume(uuid4(), GiB)
+        api.create_volume(uuid4(), GiB)
+        api.attach_volume(attached.blockdevice_id, api.compute_instance_id())
+
+        def destroy(device, table=None):
+            raise blktap.TapdiskTimeout(device)
+        self.patch_static(blktap.Tapdisk, "destroy", destroy)
+        self.assertRaises(blktap.TapdiskTimeout,
+                          api.destroy_all_flocker_volumes)
+        self.assertEqual(([attached.blockdevice_id], 1),
+                         (self.blockdevice_ids(api),
+                          len(self.tap_ctl.tapdisks)))
+
+
+class NamespaceTests(FakeDriverMixin, TestCase):
+    """
+    Tests for volumes kept in a ``namespace`` directory of the vPool.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.mountpoint = self.mktemp()
+        os.mkdir(self.mountpoint)
+        self.mounted = True
+        ismount = os.path.ismount
+        self.patch(os.path, "ismount", lambda path: (
+            self.mounted if path == self.mountpoint else ismount(path)))
+
+    def api(self, **kwargs):
+        kwargs.setdefault("namespace", "flocker")
+        kwargs.setdefault("vpool_mountpoints",
+                          {"fake.json": self.mountpoint})
+        return FakeDriverMixin.api(self, **kwargs)
+
+    def vdisk(self, path):
+        """
+        Add a Flocker vdisk at ``path`` on the vPool and its mount.
+        """
+        blockdevice_id = "flocker-%s" % (uuid4(),)
+        path = "%s/%s.raw" % (path, blockdevice_id)
+        self.client.add_volume(path, GiB)
+        directory = os.path.dirname(self.mountpoint + path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(self.mountpoint + path, "w").close()
+        return blockdevice_id
+
+    def test_create(self):
+        """
+        New volumes are created in the namespace directory, which is made
+        on the mount.
+        """
+        api = self.api()
+        volume = api.create_volume(uuid4(), GiB)
+        self.assertEqual(
+            (True, ["/flocker/%s.raw" % (volume.blockdevice_id,)]),
+            (os.path.isdir(os.path.join(self.mountpoint, "flocker")),
+             self.client.list_volumes_by_path()))
+
+    def test_list_mounted(self):
+        """
+        On a mounted vPool only the namespace directory is read, not the
+        storagerouter listing.
+        """
+        self.vdisk("")
+        inside = self.vdisk("/flocker")
+        self.vdisk("/flocker/nested")
+        api = self.api()
+        self.client.reset_calls()
+        self.assertEqual([inside], self.blockdevice_ids(api))
+        self.assertNotIn("list_volumes_by_path", self.client.calls)
+
+    def test_list_unmounted(self):
+        """
+        Without the mount the storagerouter listing is filtered down to the
+        namespace directory.
+        """
+        self.mounted = False
+        self.vdisk("")
+        inside = self.vdisk("/flocker")
+        self.assertEqual([inside], self.blockdevice_ids(self.api()))
+
+    def test_tapdisk_volume(self):
+        """
+        ``tap-ctl`` opens the volume by its path in the namespace, and the
+        tapdisk is found by its ``blockdevice_id`` again.
+        """
+        blockdevice_id = self.vdisk("/flocker")
+        api = self.api()
+        api.attach_volume(blockdevice_id, api.compute_instance_id())
+        self.assertEqual(
+            (["openvstorage:flocker/%s" % (blockdevice_id,)],
+             [api.compute_instance_id()]),
+            ([t["args"] for t in self.tap_ctl.tapdisks],
+             [v.attached_to for v in api.list_volumes()]))
+        self.assertTrue(api.get_device_path(blockdevice_id).path.startswith(
+            blktap.Tapdisk.TAP_DEV))
+
+
+class QuiesceTests(FakeDriverMixin, HolderTreeMixin, TestCase):
+    """
+    Tests for detaching in the ``"quiesce"`` detach mode, with every tapdev
+    being device ``250:0`` of a fake holders tree.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.patch_static(blktap.HolderIndex, "dev", lambda device: "250:0")
+        self.driver = self.api(detach_mode="quiesce", quiesce_timeout=2.5)
+        self.volume = self.driver.create_volume(uuid4(), GiB)
+        self.driver.attach_volume(self.volume.blockdevice_id,
+                                  self.driver.compute_instance_id())
+        self.pauses = []
+        pause = blktap.Tapdisk.pause
+
+        def record(device, table=None, timeout=None):
+            self.pauses.append(timeout)
+            return pause(device, table, timeout)
+        self.patch_static(blktap.Tapdisk, "pause", record)
+
+    def states(self):
+        return [tapdisk["state"] for tapdisk in self.tap_ctl.tapdisks]
+
+    def test_unknown_mode(self):
+        """
+        An unknown detach mode is refused.
+        """
+        self.assertRaises(ValueError, self.api, detach_mode="drain")
+
+    def test_quiesced(self):
+        """
+        A tapdev nothing holds is paused within the quiesce timeout, then
+        destroyed.
+        """
+        self.holder_tree(devices=[("tapdeva", "250:0", [], [])])
+        self.driver.detach_volume(self.volume.blockdevice_id)
+        self.assertEqual(([2.5], []), (self.pauses, self.tap_ctl.tapdisks))
+
+    def test_busy(self):
+        """
+        A mounted tapdev raises ``DeviceBusy`` and is neither paused nor
+        destroyed.
+        """
+        self.holder_tree(mounts=[("250:0", "/mnt/data")],
+                         devices=[("tapdeva", "250:0", [], [])])
+        error = self.assertRaises(DeviceBusy, self.driver.detach_volume,
+                                  self.volume.blockdevice_id)
+        self.assertEqual(
+            ((self.volume.blockdevice_id, ["/mnt/data"]), [], [0]),
+            ((error.blockdevice_id, error.holders), self.pauses,
+             self.states()))
+
+    def test_busy_bulk(self):
+        """
+        ``detach_volumes`` reports a tapdev held by another device as
+        ``DeviceBusy`` and keeps it.
+        """
+        self.holder_tree(devices=[("tapdeva", "250:0", ["dm-3"], [])])
+        result, = self.driver.detach_volumes([self.volume.blockdevice_id])
+        self.assertEqual((DeviceBusy, ["dm-3"], 1),
+                         (type(result.error), result.error.holders,
+                          len(self.tap_ctl.tapdisks)))
+
+    def test_timeout(self):
+        """
+        A pause past the quiesce timeout is raised, and the tapdisk is
+        resumed and kept.
+        """
+        self.holder_tree(devices=[("tapdeva", "250:0", [], [])])
+
+        def slow(device, table=None, timeout=None):
+            self.pauses.append(timeout)
+            blktap.Tapdisk.exc("pause",
+                               "-m%s" % (blktap.Tapdisk.minor(device),))
+            raise blktap.TapdiskTimeout("pause timed out")
+        self.patch_static(blktap.Tapdisk, "pause", slow)
+        self.assertRaises(blktap.TapdiskTimeout, self.driver.detach_volume,
+                          self.volume.blockdevice_id)
+        self.assertEqual(([2.5], [0]), (self.pauses, self.states()))
+
+
+class LockTests(FakeDriverMixin, TestCase):
+    """
+    Tests for how the driver holds the per-volume locks, against another
+    agent holding them through the same lock directory.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.lock_dir = self.mktemp()
+        self.other = VolumeLocks(self.lock_dir)
+
+    def in_thread(self, function, *args):
+        """
+        Start ``function`` on a thread; the returned event is set once it
+        returned.
+        """
+        done = threading.Event()
+
+        def run():
+            try:
+                function(*args)
+            finally:
+                done.set()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def test_attach_volumes(self):
+        """
+        ``attach_volumes`` waits for the lock of a volume held elsewhere,
+        and attaches the other volumes meanwhile.
+        """
+        api = self.api(lock_dir=self.lock_dir)
+        held, free = [api.create_volume(uuid4(), GiB).blockdevice_id
+                      for _ in range(2)]
+        self.other.acquire(held)
+        done = self.in_thread(api.attach_volumes, [held, free])
+        for _ in range(50):
+            if len(self.tap_ctl.tapdisks) == 1:
+                break
+            done.wait(0.1)
+        self.assertEqual(
+            (False, ["openvstorage:%s" % (free,)]),
+            (done.is_set(), [t["args"] for t in self.tap_ctl.tapdisks]))
+        self.other.release(held)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(2, len(self.tap_ctl.tapdisks))
+
+    def test_destroy(self):
+        """
+        ``destroy_volume`` waits for the lock of the volume and removes
+        its lock file.
+        """
+        api = self.api(lock_dir=self.lock_dir)
+        volume = api.create_volume(uuid4(), GiB)
+        self.other.acquire(volume.blockdevice_id)
+        done = self.in_thread(api.destroy_volume, volume.blockdevice_id)
+        self.assertFalse(done.wait(0.3))
+        self.assertEqual([volume.blockdevice_id], self.blockdevice_ids(api))
+        self.other.release(volume.blockdevice_id)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(
+            ([], []), (self.blockdevice_ids(api), os.listdir(self.lock_dir)))
+
+
+class ProfileTests(FakeDriverMixin, TestCase):
+    """
+    Tests for ``OpenvStorageBlockDeviceAPI.create_volume_with_profile``.
+    """
+
+    def test_settings(self):
+        """
+        The cache and DTL settings of the profile are applied.
+        """
+        api = self.api(profiles={"gold": {"cache_behaviour": "no_cache",
+                                          "dtl": "none"}})
+        volume = api.create_volume_with_profile(uuid4(), GiB, u"gold")
+        object_id = self.client.get_object_id(
+            "/%s.raw" % (volume.blockdevice_id,))
+        self.assertEqual(
+            {"cache_behaviour": src.ClusterCacheBehaviour.NO_CACHE,
+             "dtl_config": None},
+            self.client.settings[object_id])
+
+    def test_failed_settings(self):
+        """
+        A volume whose settings cannot be applied is unlinked again.
+        """
+        api = self.api(profiles={"gold": {"cache_behaviour": "no_cache"}})
+
+        def fail(object_id, behaviour):
+            raise RuntimeError("storagedriver unavailable")
+        self.patch(self.client, "set_cluster_cache_behaviour", fail)
+        self.assertRaises(RuntimeError, api.create_volume_with_profile,
+                          uuid4(), GiB, u"gold")
+        self.assertEqual([], api.list_volumes())
+
+    def test_readonly(self):
+        """
+        Volumes of a ``readonly`` profile are on its own vPool and attached
+        read-only.
+        """
+        reference = FakeStorageRouterClient("reference.json")
+        api = self.api(vpools={"reference.json": reference},
+                       profiles={"reference": {
+                           "vpool_conf_file": "reference.json",
+                           "readonly": True}})
+        volume = api.create_volume_with_profile(uuid4(), GiB, u"reference")
+        api.attach_volume(volume.blockdevice_id, api.compute_instance_id())
+        self.assertEqual(
+            [(True, "openvstorage:%s" % (volume.blockdevice_id,))],
+            [(t["readonly"], t["args"]) for t in self.tap_ctl.tapdisks])
+        self.assertEqual(1, len(reference.list_volumes_by_path()))
+
+    def test_readonly_needs_vpool(self):
+        """
+        A ``readonly`` profile without a vPool of its own is refused.
+        """
+        self.assertRaises(InvalidProfile, self.api,
+                          profiles={"reference": {"readonly": True}})
+        self.assertRaises(InvalidProfile, self.api,
+                          vpool_conf_files=["fake.json", "other.json"],
+                          profiles={"reference": {
+                              "vpool_conf_file": "other.json",
+                              "readonly": True}})
+        self.assertRaises(InvalidProfile, self.api,
+                          profiles={"reference": {
+                              "vpool_conf_file": "reference.json",
+                              "readonly": True},
+                              "gold": {"vpool_conf_file": "reference.json",
+                                       "cache_behaviour": "no_cache"}})
+
+
+class ReadonlyDatasetTests(FakeDriverMixin, TestCase):
+    """
+    Tests for the volumes of ``readonly_datasets``, which several instances
+    may attach.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.dataset_id = uuid4()
+        self.driver = self.api(readonly_datasets=[unicode(self.dataset_id)])
+        self.here = self.driver.compute_instance_id()
+
+    def test_shared(self):
+        """
+        A volume of a read-only dataset is attached by two instances, and a
+        second attach here shares its read-only tapdev.
+        """
+        volume = self.driver.create_volume(self.dataset_id, GiB)
+        for instance_id in (u"other-host", self.here, self.here):
+            self.driver.attach_volume(volume.blockdevice_id, instance_id)
+        self.driver.attach_volume(volume.blockdevice_id, u"other-host")
+        self.assertEqual(
+            ([(True, "openvstorage:%s" % (volume.blockdevice_id,))],
+             [self.here]),
+            ([(t["readonly"], t["args"]) for t in self.tap_ctl.tapdisks],
+             [v.attached_to for v in self.driver.list_volumes()]))
+
+    def test_writable_refused(self):
+        """
+        A volume of another dataset is attached writable, and once it is
+        no other attach is allowed.
+        """
+        volume = self.driver.create_volume(uuid4(), GiB)
+        self.driver.attach_volume(volume.blockdevice_id, self.here)
+        for instance_id in (self.here, u"other-host"):
+            self.assertRaises(AlreadyAttachedVolume, self.driver.attach_volume,
+                              volume.blockdevice_id, instance_id)
+        self.assertEqual([False],
+                         [t["readonly"] for t in self.tap_ctl.tapdisks])
+
+    def test_writable_tapdev_refused(self):
+        """
+        A read-only volume does not share a tapdev that is writable.
+        """
+        volume = self.driver.create_volume(self.dataset_id, GiB)
+        self.driver.attach_volume(volume.blockdevice_id, self.here)
+        self.patch_static(blktap.Tapdisk, "is_readonly", lambda device: False)
+        self.assertRaises(AlreadyAttachedVolume, self.driver.attach_volume,
+                          volume.blockdevice_id, self.here)
+
+
+class TemplateTests(FakeDriverMixin, TestCase):
+    """
+    Tests for volumes cloned from a template.
+    """
+    template = "/templates/seed.raw"
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.client.add_volume(self.template, GiB // 2)
+
+    def test_grown(self):
+        """
+        A clone larger than the template is grown to the requested size.
+        """
+        api = self.api(template=self.template)
+        volume = api.create_volume(uuid4(), GiB)
+        self.assertEqual([(volume.blockdevice_id, GiB)],
+                         [(v.blockdevice_id, v.size)
+                          for v in api.list_volumes()])
+
+    def test_failed_resize(self):
+        """
+        A clone that cannot be grown is unlinked again.
+        """
+        api = self.api(template=self.template)
+
+        def fail(object_id, size):
+            raise RuntimeError("storagedriver unavailable")
+        self.patch(self.client, "resize", fail)
+        self.assertRaises(RuntimeError, api.create_volume, uuid4(), GiB)
+        self.assertEqual([], api.list_volumes())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A stand-in for ``tap-ctl`` that keeps its tapdisks in a JSON state file
+instead of the kernel, for benchmarks and tests on hosts without blktap.
+
+The state file is named by ``FAKE_TAPCTL_STATE``; every invocation also
+counts itself in it, so callers can tell how many times ``tap-ctl`` was
+forked.
+"""
+import fcntl
+import json
+import os
+import sys
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+STATE_ENV = 'FAKE_TAPCTL_STATE'
+TAP_DEV = '/dev/xen/blktap-2/tapdev'
+TD_PAUSED = 0x0020
+
+
+def empty_state():
+    return {'tapdisks': [], 'forks': 0, 'next_pid': 1000}
+
+
+def load_state(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return empty_state()
+
+
+def save_state(path, state):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp, path)
+
+
+def _options(args):
+    options = {}
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 1:
+            options[arg[1]] = arg[2:]
+    return options
+
+
+def _free_minor(tapdisks):
+    used = set(t['minor'] for t in tapdisks)
+    minor = 0
+    while minor in used:
+        minor += 1
+    return minor
+
+
+def _find(tapdisks, options):
+    minor = int(options.get('m', -1))
+    for tapdisk in tapdisks:
+        if tapdisk['minor'] == minor:
+            return tapdisk
+    raise KeyError('no such minor: %s' % minor)
+
+
+def _format(tapdisk):
+    fields = []
+    if tapdisk['pid'] is not None:
+        fields.append('pid=%d' % tapdisk['pid'])
+    fields.append('minor=%d' % tapdisk['minor'])
+    if tapdisk['pid'] is not None:
+        fields.append('state=%#x' % tapdisk['state'])
+    if tapdisk['args']:
+        fields.append('args=%s' % tapdisk['args'])
+    return ' '.join(fields)
+
+
+def run(state, command, options):
+    """
+    Apply ``command`` to ``state``, return what tap-ctl would print.
+    """
+    tapdisks = state['tapdisks']
+    if command == 'list':
+        return '\n'.join(_format(t) for t in tapdisks)
+    if command == 'check':
+        return 'ok'
+    if command in ('allocate', 'create'):
+        tapdisk = dict(pid=None, minor=_free_minor(tapdisks), state=0,
+                       args=None, readonly='R' in options, reqs=0, secs=0)
+        tapdisks.append(tapdisk)
+        if command == 'create':
+            state['next_pid'] += 1
+            tapdisk['pid'] = state['next_pid']
+            tapdisk['args'] = options['a']
+        return '%s%d' % (TAP_DEV, tapdisk['minor'])
+    if command == 'spawn':
+        state['next_pid'] += 1
+        return str(state['next_pid'])
+    tapdisk = _find(tapdisks, options)
+    if command == 'attach':
+        tapdisk['pid'] = int(options['p'])
+    elif command == 'open':
+        tapdisk['args'] = options['a']
+        tapdisk['readonly'] = 'R' in options
+    elif command == 'close':
+        tapdisk['args'] = None
+    elif command == 'detach':
+        tapdisk['pid'] = None
+    elif command in ('destroy', 'free'):
+        tapdisks.remove(tapdisk)
+    elif command == 'pause':
+        tapdisk['state'] |= TD_PAUSED
+    elif command == 'unpause':
+        tapdisk['state'] &= ~TD_PAUSED
+    elif command == 'stats':
+        # Pretend every call saw some I/O
+        tapdisk['reqs'] += 100
+        tapdisk['secs'] += 800
+        return json.dumps({'name': tapdisk['args'],
+                           'reqs': [tapdisk['reqs'], tapdisk['reqs']],
+                           'secs': [tapdisk['secs'], tapdisk['secs']]})
+    else:
+        raise KeyError('unknown command: %s' % command)
+    return ''
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    path = os.environ.get(STATE_ENV)
+    if not path or not argv:
+        sys.stderr.write('usage: %s=<file> fake-tap-ctl <command> ...\n' %
+                         STATE_ENV)
+        return 2
+    with open('%s.lock' % path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state(path)
+        state['forks'] += 1
+        try:
+            out = run(state, argv[0], _options(argv[1:]))
+            rc = 0
+        except KeyError, e:
+            out = ''
+            sys.stderr.write('%s\n' % e)
+            rc = 1
+        save_state(path, state)
+    sys.stdout.write(out)
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
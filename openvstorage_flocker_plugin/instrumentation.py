@@ -0,0 +1,204 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Eliot actions around every storagerouter and ``tap-ctl`` call, and an
+optional in-memory timing summary of them.
+"""
+import collections
+import signal
+import threading
+import time
+
+from eliot import ActionType, Field, Logger, MessageType
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+_logger = Logger()
+
+OPERATION = Field.for_types(
+    u"operation", [unicode, bytes], u"The method or command being run.")
+VOLUME = Field.for_types(
+    u"volume", [unicode, bytes, None],
+    u"The volume path, object_id or tapdev minor the call is about.")
+DURATION = Field.for_types(
+    u"duration", [float], u"Wall-clock seconds the call took.")
+SUMMARY = Field.for_types(
+    u"summary", [dict], u"Count, errors, p50 and p99 per call type.")
+
+STORAGEROUTER_CALL = ActionType(
+    u"openvstorage:storagerouter:call", [OPERATION, VOLUME], [DURATION],
+    u"A call on the storagerouter client.")
+TAP_CTL_CALL = ActionType(
+    u"openvstorage:tap-ctl:call", [OPERATION, VOLUME], [DURATION],
+    u"A tap-ctl invocation.")
+TIMING_SUMMARY = MessageType(
+    u"openvstorage:timing:summary", [SUMMARY],
+    u"Aggregated latency of the storagerouter and tap-ctl calls.")
+
+
+class TimingStats(object):
+    """
+    Per call type counters and a bounded window of recent durations.
+    """
+
+    def __init__(self, window=1024):
+        self.enabled = False
+        self._window = window
+        self._lock = threading.Lock()
+        self._samples = dict()
+        self._counts = collections.defaultdict(int)
+        self._errors = collections.defaultdict(int)
+
+    def record(self, key, duration, failed=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = \
+                    collections.deque(maxlen=self._window)
+            samples.append(duration)
+            self._counts[key] += 1
+            if failed:
+                self._errors[key] += 1
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._errors.clear()
+
+    def summary(self):
+        """
+        :returns: A ``dict`` mapping ``"kind:operation"`` to its ``count``,
+            ``errors``, ``p50`` and ``p99`` in seconds.
+        """
+        with self._lock:
+            items = [(key, sorted(samples)) for key, samples
+                     in self._samples.items()]
+            counts, errors = dict(self._counts), dict(self._errors)
+        return dict((key, dict(count=counts[key],
+                               errors=errors.get(key, 0),
+                               p50=_percentile(samples, 50),
+                               p99=_percentile(samples, 99)))
+                    for key, samples in items)
+
+    def dump(self, logger=None):
+        """
+        Log the summary as an Eliot message and return it.
+        """
+        summary = self.summary()
+        TIMING_SUMMARY(summary=summary).write(logger or _logger)
+        return summary
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+TIMINGS = TimingStats()
+
+
+def timed(action_type, kind, operation, volume, function, *args, **kwargs):
+    """
+    Run ``function`` inside ``action_type`` and record how long it took.
+    """
+    started = time.time()
+    failed = True
+    with action_type(_logger, operation=operation,
+                     volume=volume) as action:
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+        finally:
+            duration = time.time() - started
+            TIMINGS.record("%s:%s" % (kind, operation), duration, failed)
+        action.addSuccessFields(duration=duration)
+    return result
+
+
+class InstrumentedClient(object):
+    """
+    Wraps a storagerouter client so every method call is an Eliot action
+    and feeds ``TIMINGS``.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            volume = args[0] if args and isinstance(args[0], basestring) \
+                else None
+            return timed(STORAGEROUTER_CALL, "storagerouter", name, volume,
+                         attribute, *args, **kwargs)
+        return call
+
+
+class _SummaryDumper(object):
+    """
+    Logs the timing summary on a thread of its own whenever ``request`` is
+    called. Requesting only sets an event, so a signal handler may do it
+    even when it interrupted ``TimingStats.record`` holding the lock that
+    ``summary`` takes.
+    """
+
+    def __init__(self):
+        self._requested = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            TIMINGS.dump()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='openvstorage-timing-summary')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def request(self, *args):
+        self._requested.set()
+
+
+DUMPER = _SummaryDumper()
+
+
+def enable_timing_summary(signum=signal.SIGUSR1):
+    """
+    Start aggregating timings, and log the summary whenever the process
+    receives ``signum``. The handler is only installed from the main
+    thread.
+    """
+    TIMINGS.enabled = True
+    if signum is None or \
+            threading.current_thread().name != 'MainThread':
+        return
+    signal.signal(signum, DUMPER.start().request)
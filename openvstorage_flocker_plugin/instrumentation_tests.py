@@ -0,0 +1,55 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.instrumentation``.
+"""
+import os
+import signal
+import threading
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import instrumentation
+from openvstorage_flocker_plugin.instrumentation import TIMINGS
+
+
+class TimingSummaryTests(TestCase):
+    """
+    Tests for ``enable_timing_summary``.
+    """
+
+    def setUp(self):
+        previous = signal.getsignal(signal.SIGUSR1)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+        self.patch(TIMINGS, "enabled", False)
+
+    def test_signal_during_record(self):
+        """
+        ``SIGUSR1`` arriving while ``record`` holds the lock of ``TIMINGS``
+        does not deadlock; the summary is logged once the lock is free.
+        """
+        dumped = threading.Event()
+        dump = TIMINGS.dump
+
+        def record_dump(*args):
+            summary = dump(*args)
+            dumped.set()
+            return summary
+        self.patch(TIMINGS, "dump", record_dump)
+        instrumentation.enable_timing_summary()
+        with TIMINGS._lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertFalse(dumped.wait(0.2))
+        dumped.wait(5)
+        self.assertTrue(dumped.is_set())
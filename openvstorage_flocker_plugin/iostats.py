@@ -0,0 +1,237 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-volume I/O statistics of the openvstorage tapdisks on this host,
+sampled from ``tap-ctl stats`` and served in the Prometheus text format.
+"""
+import collections
+import os
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import blktap as Blktap
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+SECTOR_SIZE = 512
+
+# Default number of seconds between two samples.
+DEFAULT_INTERVAL = 10
+
+# Default number of samples kept per volume.
+DEFAULT_HISTORY = 60
+
+
+class IOSample(object):
+    """
+    The counters of one tapdisk at one point in time.
+    """
+    __slots__ = ('timestamp', 'received', 'completed', 'read_sectors',
+                 'write_sectors', 'inflight')
+
+    def __init__(self, timestamp, received, completed, read_sectors,
+                 write_sectors, inflight):
+        self.timestamp = timestamp
+        self.received = received
+        self.completed = completed
+        self.read_sectors = read_sectors
+        self.write_sectors = write_sectors
+        self.inflight = inflight
+
+    @classmethod
+    def from_stats(cls, timestamp, stats):
+        """
+        Build a sample from the JSON of ``tap-ctl stats``. Requests come
+        from ``reqs`` (received, completed) or, failing that, from the
+        ``hits`` of the images, sectors from ``secs`` (read, write).
+        """
+        reqs = stats.get('reqs')
+        if reqs:
+            received, completed = int(reqs[0]), int(reqs[-1])
+        else:
+            completed = sum(sum(image.get('hits', ()))
+                            for image in stats.get('images', ()))
+            received = completed
+        secs = stats.get('secs') or (0, 0)
+        inflight = stats.get('reqs_outstanding', received - completed)
+        return cls(timestamp, received, completed, int(secs[0]),
+                   int(secs[-1]), int(inflight))
+
+
+class IORates(object):
+    """
+    Rates between the two most recent samples of a volume.
+    """
+    __slots__ = ('iops', 'read_bps', 'write_bps', 'inflight', 'requests')
+
+    def __init__(self, previous, current):
+        elapsed = max(current.timestamp - previous.timestamp, 1e-6)
+        self.iops = \
+            max(current.completed - previous.completed, 0) / elapsed
+        self.read_bps = max(current.read_sectors - previous.read_sectors,
+                            0) * SECTOR_SIZE / elapsed
+        self.write_bps = max(current.write_sectors - previous.write_sectors,
+                             0) * SECTOR_SIZE / elapsed
+        self.inflight = current.inflight
+        self.requests = current.completed
+
+
+class IOStatsCollector(object):
+    """
+    Samples ``tap-ctl stats`` of every attached openvstorage tapdisk every
+    ``interval`` seconds, keeping the last ``history`` samples per volume.
+
+    :param textfile: Path the metrics are written to after every sample,
+        e.g. for the node exporter's textfile collector.
+    :param port: Serve the metrics on ``http://address:port/metrics``.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, history=DEFAULT_HISTORY,
+                 textfile=None, port=None, address='127.0.0.1'):
+        self.interval = interval
+        self.history = max(2, history)
+        self.textfile = textfile
+        self.port = port
+        self.address = address
+        self._samples = dict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def sample(self):
+        """
+        Take one sample of every attached openvstorage tapdisk.
+        """
+        table = Blktap.Tapdisk.snapshot()
+        taken = dict()
+        for tapdisk in table:
+            if not tapdisk.pid or tapdisk.volume is None:
+                continue
+            try:
+                stats = Blktap.Tapdisk.stats(tapdisk.device, table)
+            except Blktap.TapdiskException:
+                continue
+            if stats is not None:
+                taken[tapdisk.volume] = IOSample.from_stats(time.time(),
+                                                            stats)
+        with self._lock:
+            for volume in set(self._samples) - set(taken):
+                del self._samples[volume]
+            for volume, sample in taken.items():
+                samples = self._samples.get(volume)
+                if samples is None:
+                    samples = self._samples[volume] = \
+                        collections.deque(maxlen=self.history)
+                samples.append(sample)
+
+    def samples(self, volume):
+        with self._lock:
+            return list(self._samples.get(volume, ()))
+
+    def rates(self):
+        """
+        :returns: A ``dict`` mapping volumes with at least two samples to
+            their ``IORates``.
+        """
+        with self._lock:
+            return dict((volume, IORates(samples[-2], samples[-1]))
+                        for volume, samples in self._samples.items()
+                        if len(samples) > 1)
+
+    def render(self):
+        """
+        The current rates in the Prometheus text exposition format.
+        """
+        rates = sorted(self.rates().items())
+        metrics = (
+            ('iops', 'gauge', 'Completed requests per second.'),
+            ('read_bps', 'gauge', 'Bytes read per second.'),
+            ('write_bps', 'gauge', 'Bytes written per second.'),
+            ('inflight', 'gauge', 'Requests submitted but not completed.'),
+            ('requests', 'counter', 'Requests completed since attach.'),
+        )
+        lines = []
+        for name, kind, help in metrics:
+            metric = 'openvstorage_flocker_volume_%s' % name
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for volume, rate in rates:
+                lines.append('%s{volume="%s"} %s' %
+                             (metric, volume, repr(getattr(rate, name))))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        tmp = '%s.tmp' % self.textfile
+        with open(tmp, 'w') as fh:
+            fh.write(self.render())
+        os.rename(tmp, self.textfile)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+                if self.textfile:
+                    self.write_textfile()
+            except Exception:
+                # Never let one bad sample stop the collector
+                pass
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='openvstorage-iostats')
+        self._thread.daemon = True
+        self._thread.start()
+        if self.port is not None:
+            self._server = HTTPServer((self.address, self.port),
+                                      _handler(self))
+            thread = threading.Thread(target=self._server.serve_forever,
+                                      name='openvstorage-iostats-http')
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _handler(collector):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = collector.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return MetricsHandler
@@ -0,0 +1,164 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.iostats``.
+"""
+import urllib2
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import blktap, iostats
+from openvstorage_flocker_plugin.iostats import IOSample, IOStatsCollector
+from openvstorage_flocker_plugin.testtools import FakeTapCtl
+
+# FakeTapCtl counts 100 requests and 800 sectors each way per stats call,
+# so samples 10 seconds apart give these rates.
+RENDERED = """\
+# HELP openvstorage_flocker_volume_iops Completed requests per second.
+# TYPE openvstorage_flocker_volume_iops gauge
+openvstorage_flocker_volume_iops{volume="vol"} 10.0
+# HELP openvstorage_flocker_volume_read_bps Bytes read per second.
+# TYPE openvstorage_flocker_volume_read_bps gauge
+openvstorage_flocker_volume_read_bps{volume="vol"} 40960.0
+# HELP openvstorage_flocker_volume_write_bps Bytes written per second.
+# TYPE openvstorage_flocker_volume_write_bps gauge
+openvstorage_flocker_volume_write_bps{volume="vol"} 40960.0
+# HELP openvstorage_flocker_volume_inflight Requests submitted but not \
+completed.
+# TYPE openvstorage_flocker_volume_inflight gauge
+openvstorage_flocker_volume_inflight{volume="vol"} 0
+# HELP openvstorage_flocker_volume_requests Requests completed since attach.
+# TYPE openvstorage_flocker_volume_requests counter
+openvstorage_flocker_volume_requests{volume="vol"} 200
+"""
+
+
+class Clock(object):
+    """
+    Stands in for the ``time`` module, advancing ``step`` seconds per call.
+    """
+
+    def __init__(self, step=10.0):
+        self.now = 1000.0
+        self.step = step
+
+    def time(self):
+        self.now += self.step
+        return self.now
+
+
+class IOSampleTests(TestCase):
+    """
+    Tests for ``IOSample.from_stats``.
+    """
+
+    def test_reqs(self):
+        """
+        Requests come from ``reqs``, sectors from ``secs``.
+        """
+        sample = IOSample.from_stats(5, {"reqs": [12, 10], "secs": [8, 16]})
+        self.assertEqual(
+            (12, 10, 8, 16, 2),
+            (sample.received, sample.completed, sample.read_sectors,
+             sample.write_sectors, sample.inflight))
+
+    def test_image_hits(self):
+        """
+        Without ``reqs`` the hits of the images are counted.
+        """
+        stats = {"images": [{"hits": [3, 4]}, {"hits": [5]}],
+                 "reqs_outstanding": 1}
+        sample = IOSample.from_stats(5, stats)
+        self.assertEqual((12, 12, 0, 0, 1),
+                         (sample.received, sample.completed,
+                          sample.read_sectors, sample.write_sectors,
+                          sample.inflight))
+
+
+class IOStatsCollectorTests(TestCase):
+    """
+    Tests for ``IOStatsCollector`` against ``FakeTapCtl``.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.tap_ctl.seed(["vol"])
+        self.patch(iostats, "time", Clock())
+
+    def collector(self, samples=2, **kwargs):
+        collector = IOStatsCollector(**kwargs)
+        for _ in range(samples):
+            collector.sample()
+        return collector
+
+    def test_render(self):
+        """
+        The rates between the last two samples are rendered in the
+        Prometheus text format.
+        """
+        self.assertEqual(RENDERED, self.collector().render())
+
+    def test_one_sample(self):
+        """
+        A volume sampled once has no rates yet.
+        """
+        self.assertEqual(
+            [], [line for line in self.collector(samples=1).render()
+                 .splitlines() if not line.startswith("#")])
+
+    def test_history(self):
+        """
+        Only the last ``history`` samples of a volume are kept, at least
+        two.
+        """
+        collector = self.collector(samples=5, history=3)
+        self.assertEqual([1030, 1040, 1050],
+                         [s.timestamp for s in collector.samples("vol")])
+        collector = self.collector(samples=3, history=1)
+        self.assertEqual([1070, 1080],
+                         [s.timestamp for s in collector.samples("vol")])
+
+    def test_detached(self):
+        """
+        The samples of a volume are dropped once it is detached.
+        """
+        collector = self.collector()
+        device = blktap.Tapdisk.snapshot().from_volume("vol").device
+        blktap.Tapdisk.destroy(device)
+        collector.sample()
+        self.assertEqual(([], {}), (collector.samples("vol"),
+                                    collector.rates()))
+
+    def test_textfile(self):
+        """
+        ``write_textfile`` writes the rendered metrics to ``textfile``.
+        """
+        path = self.mktemp()
+        self.collector(textfile=path).write_textfile()
+        with open(path) as fh:
+            self.assertEqual(RENDERED, fh.read())
+
+    def test_http(self):
+        """
+        The metrics are served on ``/metrics``.
+        """
+        collector = self.collector(interval=3600, port=0)
+        collector.start()
+        self.addCleanup(collector.stop)
+        url = "http://127.0.0.1:%d/metrics" % (
+            collector._server.server_address[1],)
+        self.assertIn('openvstorage_flocker_volume_requests{volume="vol"}',
+                      urllib2.urlopen(url).read())
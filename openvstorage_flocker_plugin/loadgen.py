@@ -0,0 +1,323 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Load generator for the driver: concurrent workers run a weighted mix of
+volume lifecycles against a vPool, or against the in-process stand-ins
+with ``--fake``, and report latency percentiles, throughput and error
+rate per operation.
+
+    python -m openvstorage_flocker_plugin.loadgen <vpool_conf_file>
+        [--workers 4] [--duration 60 | --iterations 10]
+        [--mix lifecycle:3,attach-detach:1,list:1] [--size 1073741824]
+        [-o inventory_ttl=0 ...] [--json]
+    python -m openvstorage_flocker_plugin.loadgen --fake [--latency 0.001]
+
+Scenarios:
+
+* ``lifecycle``: create, attach, get_device_path, detach, destroy
+* ``create-destroy``: create, destroy
+* ``attach-detach``: attach and detach a volume the worker keeps
+* ``list``: list_volumes
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+SCENARIOS = ("lifecycle", "create-destroy", "attach-detach", "list")
+
+DEFAULT_MIX = "lifecycle:3,attach-detach:1,list:1"
+
+
+class Histogram(object):
+    """
+    Latencies of one operation: every sample for the percentiles, and
+    counts per power of two milliseconds for the histogram.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+        self.buckets = collections.defaultdict(int)
+
+    def record(self, duration, failed=False):
+        self.samples.append(duration)
+        if failed:
+            self.errors += 1
+        milliseconds = duration * 1000
+        bucket = 2 ** max(0, int(math.ceil(math.log(max(milliseconds, 1),
+                                                    2))))
+        self.buckets[bucket] += 1
+
+    def merge(self, other):
+        self.samples.extend(other.samples)
+        self.errors += other.errors
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+
+    def percentile(self, percent):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+        return ordered[max(0, min(rank, len(ordered) - 1))]
+
+    def report(self, elapsed):
+        count = len(self.samples)
+        return {
+            "count": count,
+            "errors": self.errors,
+            "error_rate": float(self.errors) / count if count else 0.0,
+            "ops_per_second": count / elapsed if elapsed else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "histogram_ms": dict(("<=%d" % bucket, count) for bucket, count
+                                 in sorted(self.buckets.items())),
+        }
+
+
+def parse_mix(text):
+    """
+    ``"lifecycle:3,list:1"`` to ``[("lifecycle", 3), ("list", 1)]``.
+    """
+    mix = []
+    for item in text.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name not in SCENARIOS:
+            raise ValueError("Unknown scenario %s, use one of %s" %
+                             (name, ", ".join(SCENARIOS)))
+        mix.append((name, int(weight or 1)))
+    return mix
+
+
+class Worker(object):
+    """
+    Runs scenarios on one thread and records the latency of every
+    operation.
+    """
+
+    def __init__(self, api, mix, size, seed):
+        self.api = api
+        self.mix = mix
+        self.size = size
+        self.random = random.Random(seed)
+        self.histograms = collections.defaultdict(Histogram)
+        self.volumes = set()
+        self._kept = None
+
+    def _call(self, operation, function, *args):
+        started = time.time()
+        try:
+            result = function(*args)
+        except Exception:
+            self.histograms[operation].record(time.time() - started, True)
+            raise
+        self.histograms[operation].record(time.time() - started)
+        return result
+
+    def _create(self):
+        volume = self._call("create_volume", self.api.create_volume,
+                            uuid.uuid4(), self.size)
+        self.volumes.add(volume.blockdevice_id)
+        return volume.blockdevice_id
+
+    def _destroy(self, blockdevice_id):
+        self._call("destroy_volume", self.api.destroy_volume, blockdevice_id)
+        self.volumes.discard(blockdevice_id)
+
+    def _attach_detach(self, blockdevice_id):
+        self._call("attach_volume", self.api.attach_volume, blockdevice_id,
+                   self.api.compute_instance_id())
+        try:
+            self._call("get_device_path", self.api.get_device_path,
+                       blockdevice_id)
+        finally:
+            self._call("detach_volume", self.api.detach_volume,
+                       blockdevice_id)
+
+    def run_once(self):
+        total = sum(weight for _, weight in self.mix)
+        pick = self.random.uniform(0, total)
+        for scenario, weight in self.mix:
+            pick -= weight
+            if pick <= 0:
+                break
+        try:
+            if scenario == "list":
+                self._call("list_volumes", self.api.list_volumes)
+            elif scenario == "attach-detach":
+                if self._kept is None:
+                    self._kept = self._create()
+                self._attach_detach(self._kept)
+            else:
+                blockdevice_id = self._create()
+                try:
+                    if scenario == "lifecycle":
+                        self._attach_detach(blockdevice_id)
+                finally:
+                    self._destroy(blockdevice_id)
+        except Exception:
+            # Already recorded as an error of the failing operation
+            pass
+
+    def cleanup(self):
+        for blockdevice_id in list(self.volumes):
+            try:
+                self._destroy(blockdevice_id)
+            except Exception:
+                pass
+
+
+def run(api, workers=4, duration=None, iterations=10, mix=DEFAULT_MIX,
+        size=1024 * 1024 * 1024):
+    """
+    Run the load and return the report as a ``dict``.
+
+    :param duration: Seconds every worker runs, ``iterations`` scenarios
+        per worker if ``None``.
+    """
+    mix = parse_mix(mix) if isinstance(mix, basestring) else mix
+    pool = [Worker(api, mix, size, seed) for seed in range(workers)]
+    deadline = None if duration is None else time.time() + duration
+
+    def loop(worker):
+        done = 0
+        while (time.time() < deadline) if deadline is not None \
+                else (done < iterations):
+            worker.run_once()
+            done += 1
+
+    threads = [threading.Thread(target=loop, args=(worker,))
+               for worker in pool]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    for worker in pool:
+        worker.cleanup()
+
+    histograms = collections.defaultdict(Histogram)
+    total = Histogram()
+    for worker in pool:
+        for operation, histogram in worker.histograms.items():
+            histograms[operation].merge(histogram)
+            total.merge(histogram)
+    return {
+        "workers": workers,
+        "elapsed": elapsed,
+        "mix": dict(mix),
+        "size": size,
+        "total": total.report(elapsed),
+        "operations": dict((operation, histogram.report(elapsed))
+                           for operation, histogram in histograms.items()),
+    }
+
+
+def _option(text):
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate concurrent volume lifecycle load.")
+    parser.add_argument("vpool_conf_file", nargs="?")
+    parser.add_argument("--fake", action="store_true",
+                        help="use the in-process storagerouter and tap-ctl "
+                             "stand-ins instead of a vPool")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds every fake storagerouter call takes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float,
+                        help="seconds to run, instead of --iterations")
+    parser.add_argument("--iterations", type=int, default=10,
+                        help="scenarios per worker")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weighted scenarios, e.g. %s" % DEFAULT_MIX)
+    parser.add_argument("--size", type=int, default=1024 * 1024 * 1024,
+                        help="bytes per volume")
+    parser.add_argument("-o", "--option", action="append", default=[],
+                        type=_option, metavar="KEY=VALUE",
+                        help="driver setting, as in agent.yml")
+    parser.add_argument("--json", action="store_true")
+    options = parser.parse_args(argv)
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError, e:
+        parser.error(str(e))
+    settings = dict(options.option)
+
+    tap_ctl = None
+    if options.fake:
+        from openvstorage_flocker_plugin.testtools import (
+            FakeStorageRouterClient, FakeTapCtl, fake_blockdevice_api
+        )
+        tap_ctl = FakeTapCtl().install()
+        settings.setdefault("lock_dir", None)
+        api = fake_blockdevice_api(
+            FakeStorageRouterClient(options.vpool_conf_file,
+                                    latency=options.latency), **settings)
+    elif options.vpool_conf_file:
+        from openvstorage_flocker_plugin import api_factory
+        api = api_factory(cluster_id=None,
+                          vpool_conf_file=options.vpool_conf_file,
+                          **settings)
+    else:
+        parser.error("a vPool configuration file or --fake is needed")
+
+    try:
+        report = run(api, options.workers, options.duration,
+                     options.iterations, mix, options.size)
+    finally:
+        if tap_ctl is not None:
+            tap_ctl.uninstall()
+
+    if options.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print "%d workers, %.1fs, %.1f ops/s, %.2f%% errors" % (
+            report["workers"], report["elapsed"],
+            report["total"]["ops_per_second"],
+            report["total"]["error_rate"] * 100)
+        print "%-16s %7s %7s %9s %9s %9s %8s" % (
+            "operation", "count", "errors", "p50 (ms)", "p95 (ms)",
+            "p99 (ms)", "ops/s")
+        for operation, stats in sorted(report["operations"].items()):
+            print "%-16s %7d %7d %9.1f %9.1f %9.1f %8.1f" % (
+                operation, stats["count"], stats["errors"], stats["p50_ms"],
+                stats["p95_ms"], stats["p99_ms"], stats["ops_per_second"])
+    return 1 if report["total"]["errors"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
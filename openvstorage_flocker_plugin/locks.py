@@ -0,0 +1,139 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-volume locks, held within this process and, through ``flock`` on a
+lock file, across every process on this host.
+"""
+import errno
+import fcntl
+import os
+import threading
+
+from contextlib import contextmanager
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+DEFAULT_LOCK_DIR = '/var/lock/openvstorage-flocker'
+
+
+class VolumeLocks(object):
+    """
+    One lock per ``blockdevice_id``. Threads of this process wait on a
+    ``threading.Lock`` first, so only one of them at a time waits on the
+    lock file.
+
+    ``acquire`` and ``release`` may be called from different threads, which
+    lets a lock be held across the callbacks of a ``Deferred``.
+
+    The lock file of a destroyed volume is removed with ``remove`` while
+    the lock is held. A process that was waiting on it then holds the lock
+    of a file that is gone, so ``acquire`` checks the file it locked is
+    still the one at the path, and tries again otherwise.
+
+    :param directory: Where the lock files live, ``None`` for in-process
+        locking only.
+    """
+
+    def __init__(self, directory=DEFAULT_LOCK_DIR):
+        self.directory = directory
+        if directory is not None:
+            try:
+                os.makedirs(directory, 0755)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._lock = threading.Lock()
+        self._locks = dict()
+        self._files = dict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.lock' % (key,))
+
+    def acquire(self, blockdevice_id):
+        key = unicode(blockdevice_id)
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+        if self.directory is None:
+            return
+        try:
+            fd = self._lock_file(self._path(key))
+        except BaseException:
+            self._forget(key)
+            raise
+        self._files[key] = fd
+
+    def _lock_file(self, path):
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(path).st_ino
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    current = None
+            except BaseException:
+                os.close(fd)
+                raise
+            if current == os.fstat(fd).st_ino:
+                return fd
+            # Removed, and maybe created again, while we waited
+            os.close(fd)
+
+    def remove(self, blockdevice_id):
+        """
+        Remove the lock file of ``blockdevice_id``, whose lock must be held,
+        once the volume is gone.
+        """
+        key = unicode(blockdevice_id)
+        if key not in self._files:
+            return
+        try:
+            os.unlink(self._path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def release(self, blockdevice_id):
+        key = unicode(blockdevice_id)
+        fd = self._files.pop(key, None)
+        if fd is not None:
+            os.close(fd)
+        self._forget(key)
+
+    def _forget(self, key):
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+        entry[0].release()
+
+    @contextmanager
+    def lock(self, blockdevice_id):
+        self.acquire(blockdevice_id)
+        try:
+            yield
+        finally:
+            self.release(blockdevice_id)
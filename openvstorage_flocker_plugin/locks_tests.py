@@ -0,0 +1,132 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.locks``.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin.locks import VolumeLocks
+
+# Holds the flock of a file for a while, as another agent would
+HOLDER = """
+import fcntl, os, sys, time
+fd = os.open(sys.argv[1], os.O_CREAT | os.O_RDWR, 0644)
+fcntl.flock(fd, fcntl.LOCK_EX)
+sys.stdout.write("locked\\n")
+sys.stdout.flush()
+time.sleep(float(sys.argv[2]))
+"""
+
+
+class VolumeLocksTests(TestCase):
+    """
+    Tests for ``VolumeLocks``.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.locks = VolumeLocks(self.directory)
+
+    def acquire_in_thread(self, locks, blockdevice_id):
+        """
+        Start acquiring the lock on a thread; the returned event is set
+        once it is held.
+        """
+        held = threading.Event()
+
+        def acquire():
+            locks.acquire(blockdevice_id)
+            held.set()
+        thread = threading.Thread(target=acquire)
+        thread.daemon = True
+        thread.start()
+        return held
+
+    def test_other_process(self):
+        """
+        The lock waits until another process releases the lock file.
+        """
+        holder = subprocess.Popen(
+            [sys.executable, "-c", HOLDER,
+             os.path.join(self.directory, "vol.lock"), "0.5"],
+            stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        self.assertEqual("locked\n", holder.stdout.readline())
+        started = time.time()
+        self.locks.acquire(u"vol")
+        self.locks.release(u"vol")
+        self.assertGreater(time.time() - started, 0.2)
+
+    def test_threads(self):
+        """
+        Threads of one process take turns, and a lock may be released by
+        another thread than the one that acquired it.
+        """
+        self.locks.acquire(u"vol")
+        held = self.acquire_in_thread(self.locks, u"vol")
+        self.assertFalse(held.wait(0.2))
+        releaser = threading.Thread(target=self.locks.release, args=(u"vol",))
+        releaser.start()
+        releaser.join()
+        self.assertTrue(held.wait(5))
+        self.locks.release(u"vol")
+        self.assertEqual({}, self.locks._locks)
+
+    def test_remove(self):
+        """
+        ``remove`` deletes the lock file, and only while the lock is held.
+        """
+        self.locks.remove(u"vol")
+        with self.locks.lock(u"vol"):
+            self.assertEqual(["vol.lock"], os.listdir(self.directory))
+            self.locks.remove(u"vol")
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_removed_while_waiting(self):
+        """
+        A waiter whose lock file was removed locks the file at the path
+        instead.
+        """
+        other = VolumeLocks(self.directory)
+        self.locks.acquire(u"vol")
+        held = self.acquire_in_thread(other, u"vol")
+        self.assertFalse(held.wait(0.2))
+        self.locks.remove(u"vol")
+        self.locks.release(u"vol")
+        self.assertTrue(held.wait(5))
+        path = os.path.join(self.directory, "vol.lock")
+        self.assertEqual(os.stat(path).st_ino,
+                         os.fstat(other._files[u"vol"]).st_ino)
+        # So a third one waits for it
+        third_locks = VolumeLocks(self.directory)
+        third = self.acquire_in_thread(third_locks, u"vol")
+        self.assertFalse(third.wait(0.2))
+        other.release(u"vol")
+        self.assertTrue(third.wait(5))
+        third_locks.release(u"vol")
+
+    def test_no_directory(self):
+        """
+        Without a directory only threads of this process are kept apart.
+        """
+        locks = VolumeLocks(None)
+        with locks.lock(u"vol"):
+            locks.remove(u"vol")
+        self.assertEqual({}, locks._locks)
@@ -0,0 +1,149 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Move the Flocker volumes at the root of vPools into a namespace directory,
+or back with ``--reverse``, by renaming them on the vPool mount. Renames
+are metadata operations of the volumedriver, no data is copied.
+
+    python -m openvstorage_flocker_plugin.migrate --namespace flocker \\
+        [--dry-run] [--reverse] [--force] /mnt/<vpool_name> [...]
+
+Volumes attached on this host are skipped; detach them and run the
+migration again. Other hosts are not checked, and a volume renamed while
+another node has it attached or is attaching it is lost to that node, so
+the migration only runs with ``--force``, which confirms the Flocker
+agents of every node using the vPools are stopped. ``--dry-run`` needs no
+``--force``.
+"""
+import argparse
+import errno
+import os
+import sys
+
+import blktap as Blktap
+
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    ExternalBlockDeviceId, _dataset_id
+)
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+
+def _flocker_vdisks(directory):
+    """
+    The ``(blockdevice_id, file name)`` of the Flocker volumes directly in
+    ``directory``.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    vdisks = []
+    for name in sorted(names):
+        blockdevice_id, extension = os.path.splitext(name)
+        if extension != ".raw":
+            continue
+        try:
+            _dataset_id(blockdevice_id.decode())
+        except (ExternalBlockDeviceId, ValueError):
+            continue
+        vdisks.append((blockdevice_id, name))
+    return vdisks
+
+
+def migrate(mountpoint, namespace, reverse=False, dry_run=False,
+            attached=None):
+    """
+    Rename the Flocker volumes of the vPool mounted at ``mountpoint``
+    between its root and the ``namespace`` directory.
+
+    :param attached: Names of the volumes attached on this host, listed
+        with ``tap-ctl`` if ``None``.
+    :returns: ``(moved, skipped)`` lists of ``blockdevice_id``.
+    """
+    namespace = namespace.strip("/")
+    root = mountpoint
+    directory = os.path.join(mountpoint, namespace)
+    source, target = (directory, root) if reverse else (root, directory)
+    if attached is None:
+        attached = set(tapdisk.volume for tapdisk in Blktap.Tapdisk.list())
+    if not dry_run and not reverse:
+        try:
+            os.mkdir(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    moved, skipped = [], []
+    for blockdevice_id, name in _flocker_vdisks(source):
+        if blockdevice_id in attached:
+            skipped.append(blockdevice_id)
+            continue
+        if not dry_run:
+            os.rename(os.path.join(source, name), os.path.join(target, name))
+        moved.append(blockdevice_id)
+    return moved, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move Flocker volumes into or out of a namespace "
+                    "directory of their vPool.")
+    parser.add_argument("--namespace", required=True,
+                        help="directory on the vPool, as in agent.yml")
+    parser.add_argument("--reverse", action="store_true",
+                        help="move volumes back to the vPool root")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print what would be moved")
+    parser.add_argument("--force", action="store_true",
+                        help="confirm the Flocker agents of every node "
+                             "using the vPools are stopped")
+    parser.add_argument("mountpoints", nargs="+", metavar="mountpoint",
+                        help="where a vPool is mounted, e.g. /mnt/pool1")
+    options = parser.parse_args(argv)
+    if not (options.dry_run or options.force):
+        parser.error("only volumes attached on this host are checked; stop "
+                     "the Flocker agents of every node using the vPools "
+                     "and pass --force")
+
+    attached = set(tapdisk.volume for tapdisk in Blktap.Tapdisk.list())
+    rc = 0
+    for mountpoint in options.mountpoints:
+        if not os.path.ismount(mountpoint):
+            print "%s: not mounted, skipped" % (mountpoint,)
+            rc = 1
+            continue
+        moved, skipped = migrate(mountpoint, options.namespace,
+                                 options.reverse, options.dry_run, attached)
+        for blockdevice_id in moved:
+            print "%s: %s %s" % (mountpoint, "would move" if
+                                 options.dry_run else "moved",
+                                 blockdevice_id)
+        for blockdevice_id in skipped:
+            print "%s: %s is attached, skipped" % (mountpoint,
+                                                   blockdevice_id)
+            rc = 1
+        print "%s: %d moved, %d skipped" % (mountpoint, len(moved),
+                                            len(skipped))
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
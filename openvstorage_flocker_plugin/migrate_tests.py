@@ -0,0 +1,132 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.migrate``.
+"""
+import os
+import sys
+from StringIO import StringIO
+from uuid import uuid4
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin.migrate import main, migrate
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    _blockdevice_id
+)
+from openvstorage_flocker_plugin.testtools import FakeTapCtl
+
+
+class MigrateTests(TestCase):
+    """
+    Tests for ``migrate`` and ``main`` on a temporary vPool mount.
+    """
+
+    def setUp(self):
+        tap_ctl = FakeTapCtl().install()
+        self.addCleanup(tap_ctl.uninstall)
+        self.tap_ctl = tap_ctl
+        self.mountpoint = self.mktemp()
+        os.mkdir(self.mountpoint)
+        self.patch(os.path, "ismount", lambda path: path == self.mountpoint)
+
+    def vdisks(self, count, directory=""):
+        """
+        Create ``count`` Flocker vdisks in ``directory`` of the mount.
+        """
+        directory = os.path.join(self.mountpoint, directory)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        blockdevice_ids = sorted(str(_blockdevice_id(uuid4()))
+                                 for _ in range(count))
+        for blockdevice_id in blockdevice_ids:
+            open(os.path.join(directory, blockdevice_id + ".raw"), "w").close()
+        return blockdevice_ids
+
+    def listing(self, directory=""):
+        path = os.path.join(self.mountpoint, directory)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, name)))
+
+    def main(self, *argv):
+        self.patch(sys, "stdout", StringIO())
+        return main(list(argv) + [self.mountpoint])
+
+    def test_migrate(self):
+        """
+        Flocker vdisks at the root move into the namespace; foreign ones and
+        attached ones stay.
+        """
+        moving, attached = self.vdisks(2)
+        open(os.path.join(self.mountpoint, "other.raw"), "w").close()
+        self.assertEqual(
+            ([moving], [attached]),
+            migrate(self.mountpoint, "/flocker/", attached=[attached]))
+        self.assertEqual(
+            ([attached + ".raw", "other.raw"], [moving + ".raw"]),
+            (self.listing(), self.listing("flocker")))
+
+    def test_reverse(self):
+        """
+        ``reverse`` moves the vdisks of the namespace back to the root.
+        """
+        blockdevice_ids = self.vdisks(2, "flocker")
+        self.assertEqual((blockdevice_ids, []),
+                         migrate(self.mountpoint, "flocker", reverse=True,
+                                 attached=[]))
+        self.assertEqual(([b + ".raw" for b in blockdevice_ids], []),
+                         (self.listing(), self.listing("flocker")))
+
+    def test_dry_run(self):
+        """
+        A dry run reports what would move and renames nothing.
+        """
+        blockdevice_ids = self.vdisks(1)
+        self.assertEqual(0, self.main("--namespace", "flocker", "--dry-run"))
+        self.assertEqual(
+            ([b + ".raw" for b in blockdevice_ids], False),
+            (self.listing(),
+             os.path.exists(os.path.join(self.mountpoint, "flocker"))))
+
+    def test_refused_without_force(self):
+        """
+        Without ``--force`` nothing is renamed.
+        """
+        blockdevice_ids = self.vdisks(1)
+        self.patch(sys, "stderr", StringIO())
+        error = self.assertRaises(SystemExit, self.main,
+                                  "--namespace", "flocker")
+        self.assertEqual((2, [b + ".raw" for b in blockdevice_ids]),
+                         (error.code, self.listing()))
+
+    def test_force(self):
+        """
+        With ``--force`` the vdisks not attached on this host are moved.
+        """
+        moving, attached = self.vdisks(2)
+        self.tap_ctl.seed([attached])
+        self.assertEqual(1, self.main("--namespace", "flocker", "--force"))
+        self.assertEqual(([attached + ".raw"], [moving + ".raw"]),
+                         (self.listing(), self.listing("flocker")))
+
+    def test_not_mounted(self):
+        """
+        A directory no vPool is mounted at is skipped.
+        """
+        self.vdisks(1)
+        self.patch(os.path, "ismount", lambda path: False)
+        self.assertEqual(1, self.main("--namespace", "flocker", "--force"))
+        self.assertEqual([], self.listing("flocker"))
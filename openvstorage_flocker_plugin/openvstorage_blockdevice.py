@@ -13,28 +13,35 @@
 # limitations under the License.
 import time
 import os
+import sys
+import errno
 import platform
-import uuid
 from uuid import UUID
-import logging
-import requests
+import threading
+import Queue
+import importlib
 import json
-import sys
 
-import blktap as Blktap
-import volumedriver.storagerouter.storagerouterclient as src
+from fractions import gcd
 
-from subprocess import check_output
+from contextlib import contextmanager
 
-from bitmath import Byte, GiB, MiB, KiB
+import blktap as Blktap
+import instrumentation
+import iostats
+import locks as Locks
+import placement as Placement
+import profiles as Profiles
+import resilience as Resilience
+import tuning as Tuning
 
-from eliot import Message, Logger
-from zope.interface import implementer, Interface
+from eliot import Logger
+from zope.interface import implementer
 from twisted.python.filepath import FilePath
-from characteristic import attributes
+from characteristic import attributes, Attribute
 
 from flocker.node.agents.blockdevice import (
-    AlreadyAttachedVolume, IBlockDeviceAPI,
+    AlreadyAttachedVolume, IBlockDeviceAPI, IProfiledBlockDeviceAPI,
     BlockDeviceVolume, UnknownVolume, UnattachedVolume
 )
 
@@ -48,6 +55,56 @@ __status__ = "Development"
 _logger = Logger()
 
 
+class _LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first used.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+# The storagerouter client loads the volumedriver C++ bindings, which only
+# the calls on a vPool need.
+src = _LazyModule("volumedriver.storagerouter.storagerouterclient")
+
+# Volumes sizes are multiples of this and of the cluster size of the vPools.
+DEFAULT_ALLOCATION_UNIT = 1024 * 1024
+
+# Cluster size of vPools whose configuration does not tell.
+DEFAULT_CLUSTER_SIZE = 4096
+
+# Default number of seconds a cached volume size is trusted before
+# ``list_volumes`` asks the storagerouter again.
+DEFAULT_INVENTORY_TTL = 60
+
+# Default number of concurrent metadata lookups in ``list_volumes``.
+DEFAULT_METADATA_WORKERS = 1
+
+# Default number of volumes a bulk operation handles concurrently.
+DEFAULT_BULK_WORKERS = 4
+
+# Default number of seconds between two consistency listings of the tapdisk
+# watcher.
+DEFAULT_WATCH_INTERVAL = 60
+
+# How a tapdisk is detached: destroyed right away, or quiesced first.
+DETACH_MODES = ("destroy", "quiesce")
+
+# Default number of seconds a tapdisk may take to drain its in-flight I/O
+# in the "quiesce" detach mode.
+DEFAULT_QUIESCE_TIMEOUT = 10
+
+
 class VolumeExists(Exception):
     """
     An OpenvStorage volume with the request name already exists.
@@ -57,6 +114,23 @@ class VolumeExists(Exception):
         self.blockdevice_id = blockdevice_id
 
 
+class TemplateError(Exception):
+    """
+    A volume cannot be cloned from its template.
+    """
+
+
+class DeviceBusy(Exception):
+    """
+    The tapdev of a volume is still mounted or held by another device, so
+    it is not detached.
+    """
+    def __init__(self, blockdevice_id, holders):
+        Exception.__init__(self, blockdevice_id, holders)
+        self.blockdevice_id = blockdevice_id
+        self.holders = holders
+
+
 class ExternalBlockDeviceId(Exception):
     """
     The ``blockdevice_id`` was not a Flocker-controlled volume.
@@ -80,33 +154,569 @@ def _dataset_id(blockdevice_id):
     return UUID(blockdevice_id[8:])
 
 
-@implementer(IBlockDeviceAPI)
+def _volume_path(blockdevice_id, namespace=None):
+    """
+    The path of the vdisk backing ``blockdevice_id`` on the vPool, in the
+    ``namespace`` directory if given.
+    """
+    if namespace:
+        return str("/%s/%s.raw" % (namespace, blockdevice_id))
+    return str("/%s.raw" % (blockdevice_id,))
+
+
+def _path_blockdevice_id(path, namespace=None):
+    """
+    The ``blockdevice_id`` of the vdisk at ``path``, ``None`` unless it is
+    directly in the ``namespace`` directory (the root if ``None``).
+    """
+    directory, name = os.path.split(os.path.splitext(path)[0])
+    if directory.strip("/") != (namespace or ""):
+        return None
+    return name
+
+
+def _vpool_cluster_size(vpool_conf_file):
+    """
+    The ``volume_manager.default_cluster_size`` of the vPool configuration
+    file, ``None`` if it cannot be read (e.g. a configuration kept in a
+    distributed store rather than in a file).
+    """
+    try:
+        with open(vpool_conf_file) as fh:
+            config = json.load(fh)
+        return int(config["volume_manager"]["default_cluster_size"])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _lcm(a, b):
+    return a * b // gcd(a, b)
+
+
+def _vpool_mountpoint(vpool_conf_file):
+    """
+    Where Open vStorage mounts the vPool of ``vpool_conf_file``:
+    ``/mnt/<vpool_name>`` for ``.../<vpool_name>.json``.
+    """
+    name = os.path.splitext(os.path.basename(vpool_conf_file))[0]
+    return os.path.join("/mnt", name)
+
+
+class _InventoryEntry(object):
+    """
+    Cached backend metadata of a single Flocker volume.
+    """
+    __slots__ = ('object_id', 'size', 'timestamp', 'vpool')
+
+    def __init__(self, object_id=None, size=None, timestamp=0, vpool=None):
+        self.object_id = object_id
+        self.size = size
+        self.timestamp = timestamp
+        self.vpool = vpool
+
+
+class _VolumeInventory(object):
+    """
+    Cache of the object_id, size and owning vPool of Flocker volumes, keyed
+    by ``blockdevice_id``.
+
+    The object_id and vPool of a vdisk never change, so they are kept until
+    the volume is invalidated. The size is only trusted for ``ttl`` seconds;
+    a ``ttl`` of ``0`` disables caching altogether.
+    """
+
+    def __init__(self, ttl=DEFAULT_INVENTORY_TTL):
+        self.ttl = ttl
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def lookup(self, blockdevice_id):
+        """
+        Return ``(object_id, size)`` for ``blockdevice_id``. Either element
+        is ``None`` when it is unknown or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            if entry is None:
+                return None, None
+            if time.time() - entry.timestamp > self.ttl:
+                return entry.object_id, None
+            return entry.object_id, entry.size
+
+    def stale(self, blockdevice_id):
+        """
+        Return ``(object_id, size)`` for ``blockdevice_id`` however old,
+        for when the storagerouter cannot be asked.
+        """
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            if entry is None:
+                return None, None
+            return entry.object_id, entry.size
+
+    def known(self, vpool):
+        """
+        The ``blockdevice_id`` of every volume recorded on ``vpool``.
+        """
+        with self._lock:
+            return [blockdevice_id for blockdevice_id, entry
+                    in self._entries.items() if entry.vpool is vpool]
+
+    def owner(self, blockdevice_id):
+        """
+        The ``_VPool`` holding ``blockdevice_id``, ``None`` if unknown.
+        """
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            return None if entry is None else entry.vpool
+
+    def __contains__(self, blockdevice_id):
+        """
+        Whether ``blockdevice_id`` was seen on its vPool less than ``ttl``
+        seconds ago.
+        """
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            return entry is not None and entry.size is not None and \
+                time.time() - entry.timestamp <= self.ttl
+
+    def remember(self, blockdevice_id, object_id=None, vpool=None):
+        """
+        Record the object_id and/or vPool of ``blockdevice_id`` without a
+        known size.
+        """
+        if not self.ttl:
+            return
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            if entry is None:
+                entry = self._entries[blockdevice_id] = _InventoryEntry()
+            if object_id is not None:
+                entry.object_id = object_id
+            if vpool is not None:
+                entry.vpool = vpool
+
+    def update(self, blockdevice_id, object_id, size):
+        if not self.ttl:
+            return
+        with self._lock:
+            entry = self._entries.get(blockdevice_id)
+            vpool = None if entry is None else entry.vpool
+            self._entries[blockdevice_id] = \
+                _InventoryEntry(object_id, size, time.time(), vpool)
+
+    def invalidate(self, blockdevice_id):
+        with self._lock:
+            self._entries.pop(blockdevice_id, None)
+
+    def retain(self, blockdevice_ids):
+        """
+        Forget every volume that is not in ``blockdevice_ids``.
+        """
+        with self._lock:
+            for blockdevice_id in set(self._entries) - set(blockdevice_ids):
+                del self._entries[blockdevice_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+@attributes(["blockdevice_id",
+             Attribute("result", default_value=None),
+             Attribute("error", default_value=None)])
+class BulkResult(object):
+    """
+    The outcome of a bulk operation for a single volume.
+
+    :ivar unicode blockdevice_id: The volume.
+    :ivar result: What the single volume operation returned.
+    :ivar Exception error: What it raised, ``None`` on success.
+    """
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+class _ClientPool(object):
+    """
+    A bounded pool of storagerouter clients, so concurrent callers never
+    share a client object.
+    """
+
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.Semaphore(max(size, 1))
+
+    @contextmanager
+    def client(self):
+        self._slots.acquire()
+        try:
+            try:
+                client = self._idle.get_nowait()
+            except Queue.Empty:
+                client = self._factory()
+            try:
+                yield client
+            finally:
+                self._idle.put(client)
+        finally:
+            self._slots.release()
+
+
+class _VPool(object):
+    """
+    A vPool volumes are kept on, with its own pool of storagerouter
+    clients and the attach settings of the profiles placed on it.
+
+    :param resilience.BackendGuard guard: Guards every call of the
+        clients, which are used as they are if ``None``.
+    """
+
+    def __init__(self, vpool_conf_file, connect, size, mountpoint=None,
+                 guard=None):
+        self.vpool_conf_file = vpool_conf_file
+        self.mountpoint = mountpoint or _vpool_mountpoint(vpool_conf_file)
+        self.guard = guard
+        self.listed = False
+        if guard is None:
+            self._connect = lambda: connect(vpool_conf_file)
+        else:
+            self._connect = lambda: Resilience.ResilientClient(
+                lambda: connect(vpool_conf_file), guard)
+        self._client = None
+        self._lock = threading.Lock()
+        self.clients = _ClientPool(self._connect, size)
+        self.attach_settings = dict()
+
+    @property
+    def client(self):
+        """
+        A storagerouter client of this vPool, connected on first use like
+        the ones of ``clients``.
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+            return self._client
+
+    def __repr__(self):
+        return "<_VPool %s>" % (self.vpool_conf_file,)
+
+
+@implementer(IBlockDeviceAPI, IProfiledBlockDeviceAPI)
 class OpenvStorageBlockDeviceAPI(object):
     """
     A ``IBlockDeviceAPI`` which uses OpenvStorage Block Devices.
     """
 
-    def __init__(self, vpool_conf_file):
+    def __init__(self, vpool_conf_file, inventory_ttl=DEFAULT_INVENTORY_TTL,
+                 tapdisk_watcher=False,
+                 watch_interval=DEFAULT_WATCH_INTERVAL,
+                 metadata_workers=DEFAULT_METADATA_WORKERS,
+                 tap_ctl_timeout=None,
+                 bulk_workers=DEFAULT_BULK_WORKERS,
+                 timing_stats=False,
+                 iostats_interval=None,
+                 iostats_history=iostats.DEFAULT_HISTORY,
+                 iostats_textfile=None,
+                 iostats_port=None,
+                 profiles=None,
+                 vpool_conf_files=(),
+                 placement="round_robin",
+                 template=None,
+                 template_snapshot=None,
+                 tapdisk_pool=0,
+                 queue_tuning=None,
+                 lock_dir=Locks.DEFAULT_LOCK_DIR,
+                 storagerouter_client=None,
+                 namespace=None,
+                 vpool_mountpoints=None,
+                 allocation_unit=None,
+                 detach_mode="destroy",
+                 quiesce_timeout=DEFAULT_QUIESCE_TIMEOUT,
+                 reconcile_interval=None,
+                 reconcile_batch=None,
+                 reconcile_dry_run=False,
+                 storagerouter_deadlines=None,
+                 storagerouter_retries=Resilience.DEFAULT_RETRIES,
+                 storagerouter_backoff=Resilience.DEFAULT_BACKOFF,
+                 breaker_threshold=Resilience.DEFAULT_BREAKER_THRESHOLD,
+                 breaker_reset=Resilience.DEFAULT_BREAKER_RESET,
+                 readonly_datasets=None):
+        """
+        :param storagerouter_client: Called with a vPool configuration file
+            to connect to that vPool, ``src.LocalStorageRouterClient`` if
+            ``None``.
+        :param namespace: Directory of the vPools the Flocker volumes live
+            in, the root of the vPools if ``None``.
+        :param dict vpool_mountpoints: vPool configuration files mapped to
+            where their vPool is mounted, if not ``/mnt/<vpool_name>``.
+        :param int allocation_unit: Bytes volume sizes are rounded up to,
+            ``DEFAULT_ALLOCATION_UNIT`` if ``None``; either way extended to
+            a multiple of the cluster size of every vPool.
+        :param detach_mode: ``"destroy"`` to destroy the tapdisk right
+            away, ``"quiesce"`` to refuse busy tapdevs and pause the tapdisk
+            to drain its in-flight I/O first.
+        :param quiesce_timeout: Seconds the pause may take in ``"quiesce"``
+            mode before the detach fails and the tapdisk is resumed.
+        :param reconcile_interval: Seconds between two reconciliation
+            passes on a background thread, none if ``None``.
+        :param reconcile_batch: Orphans a pass cleans up at most,
+            ``reconcile.DEFAULT_BATCH`` if ``None``.
+        :param reconcile_dry_run: Only report orphans in the background
+            passes.
+        :param dict storagerouter_deadlines: Seconds a storagerouter call
+            may take, per method name or for every ``"read"`` or
+            ``"write"``, over ``resilience.DEFAULT_DEADLINES``.
+        :param storagerouter_retries: Times a failed read is tried again.
+        :param storagerouter_backoff: Seconds of the first retry backoff.
+        :param breaker_threshold: Failed calls in a row after which the
+            calls to a vPool fail fast, never if ``0``.
+        :param breaker_reset: Seconds calls fail fast before one may try
+            the vPool again.
+        :param readonly_datasets: Dataset ids whose volumes are attached
+            read-only and may be attached by several hosts at once, like
+            those on the vPool of a ``readonly`` profile.
+        """
+        if detach_mode not in DETACH_MODES:
+            raise ValueError("Unknown detach_mode %s, use one of %s" %
+                             (detach_mode, ", ".join(DETACH_MODES)))
         self.vpool_conf_file = vpool_conf_file
-        self.client = src.LocalStorageRouterClient(self.vpool_conf_file)
+        self._namespace = namespace.strip("/") if namespace else None
+        self._mountpoints = dict(vpool_mountpoints or {})
+
+        def client_factory(vpool_conf_file):
+            connect = storagerouter_client or src.LocalStorageRouterClient
+            return instrumentation.InstrumentedClient(
+                connect(vpool_conf_file))
+        self._inventory = _VolumeInventory(ttl=inventory_ttl)
+        self._locks = Locks.VolumeLocks(lock_dir)
+        self._widths = dict(metadata=max(1, metadata_workers),
+                            bulk=max(1, bulk_workers))
+        self._pools = dict()
+        self._pools_lock = threading.Lock()
+        self._connect = client_factory
+        self._guard_settings = dict(
+            deadlines=storagerouter_deadlines,
+            retries=storagerouter_retries, backoff=storagerouter_backoff,
+            threshold=breaker_threshold, reset=breaker_reset,
+            answered=lambda e: isinstance(e, src.ObjectNotFoundException))
+        self._vpools = []
+        self._vpool = self._vpool_of_conf(vpool_conf_file)
+        self._placement = Placement.placement_from_configuration(placement)
+        self._placement_vpools = [self._vpool]
+        for conf in vpool_conf_files:
+            vpool = self._vpool_of_conf(conf)
+            if vpool not in self._placement_vpools:
+                self._placement_vpools.append(vpool)
+        self._template = (template, template_snapshot)
+        self._allocation_unit = allocation_unit or DEFAULT_ALLOCATION_UNIT
+        self._aligned_unit = None
+        self._queue_tuning = \
+            Tuning.queue_tuning_from_configuration(queue_tuning)
+        self._templates = dict()
+        self._quiesce = quiesce_timeout if detach_mode == "quiesce" else None
+        self._readonly_datasets = frozenset(
+            UUID(unicode(dataset_id)) for dataset_id
+            in readonly_datasets or ())
+        self._profiles = Profiles.profiles_from_configuration(profiles)
+        # Read-only applies to the whole vPool, keep other volumes off it
+        readonly = set(self._vpool_of_conf(profile.vpool_conf_file)
+                       for profile in self._profiles.values()
+                       if profile.readonly)
+        for profile in sorted(self._profiles.values(),
+                              key=lambda p: p.name):
+            if profile.readonly:
+                if self._vpool_of_conf(profile.vpool_conf_file) in \
+                        self._placement_vpools:
+                    raise Profiles.InvalidProfile(
+                        "readonly profile %s uses a vPool volumes are "
+                        "placed on by default" % (profile.name,))
+            elif profile.vpool_conf_file is not None and \
+                    self._vpool_of_conf(profile.vpool_conf_file) in readonly:
+                raise Profiles.InvalidProfile(
+                    "Profile %s uses the vPool of a readonly profile" %
+                    (profile.name,))
+            if profile.vpool_conf_file is None:
+                vpools = self._placement_vpools
+            else:
+                vpools = [self._vpool_of_conf(profile.vpool_conf_file)]
+            for vpool in vpools:
+                for key, value in profile.attach_settings().items():
+                    if vpool.attach_settings.setdefault(key, value) != value:
+                        raise Profiles.InvalidProfile(
+                            "Profiles on %s disagree on %s" %
+                            (vpool.vpool_conf_file, key))
+        if timing_stats:
+            instrumentation.enable_timing_summary()
+        if tap_ctl_timeout is not None:
+            Blktap.Tapdisk.TIMEOUT = tap_ctl_timeout
+        if tapdisk_watcher:
+            Blktap.Tapdisk.start_watcher(watch_interval)
+        if tapdisk_pool:
+            Blktap.Tapdisk.start_pool(tapdisk_pool, lock_dir)
+        self.iostats = None
+        if iostats_interval:
+            self.iostats = iostats.IOStatsCollector(
+                interval=iostats_interval, history=iostats_history,
+                textfile=iostats_textfile, port=iostats_port).start()
+        self._reconciler = None
+        self._reconcile_settings = dict(interval=reconcile_interval,
+                                        dry_run=reconcile_dry_run)
+        if reconcile_batch is not None:
+            self._reconcile_settings["batch"] = reconcile_batch
+        if reconcile_interval:
+            self.reconciler().start()
+
+    @property
+    def client(self):
+        """
+        The storagerouter client of the default vPool.
+        """
+        return self._vpool.client
+
+    def _volume_path(self, blockdevice_id):
+        return _volume_path(blockdevice_id, self._namespace)
+
+    def _tapdisk_volume(self, blockdevice_id):
+        """
+        The name ``tap-ctl`` opens ``blockdevice_id`` by.
+        """
+        return self._volume_path(blockdevice_id)[1:-len(".raw")]
+
+    def _vpool_of_conf(self, vpool_conf_file):
+        """
+        The ``_VPool`` of ``vpool_conf_file``, added if it is a new one.
+        """
+        for vpool in self._vpools:
+            if vpool.vpool_conf_file == vpool_conf_file:
+                return vpool
+        vpool = _VPool(vpool_conf_file, self._connect,
+                       max(self._widths.values()),
+                       self._mountpoints.get(vpool_conf_file),
+                       Resilience.BackendGuard(vpool_conf_file,
+                                               **self._guard_settings))
+        self._vpools.append(vpool)
+        return vpool
+
+    def _place(self):
+        """
+        The vPool a new volume goes to, according to the placement policy.
+        """
+        if len(self._placement_vpools) == 1:
+            return self._placement_vpools[0]
+        return self._placement.choose(self._placement_vpools, self._usage)
+
+    def _usage(self):
+        """
+        :returns: A ``dict`` mapping every ``_VPool`` to the
+            ``placement.VPoolUsage`` of its Flocker volumes.
+        """
+        usages = dict((vpool, Placement.VPoolUsage())
+                      for vpool in self._vpools)
+        flocker_volumes = self._flocker_volumes()
+        sizes = self._sizes([b for b, _, _ in flocker_volumes])
+        for (_, _, vpool), size in zip(flocker_volumes, sizes):
+            if size is not None:
+                usages[vpool].volumes += 1
+                usages[vpool].allocated += size
+        return usages
+
+    def storagerouter_health(self):
+        """
+        :returns: A ``dict`` mapping every vPool configuration file to the
+            state of its circuit breaker: ``closed``, ``open`` or
+            ``half_open``.
+        """
+        return dict((vpool.vpool_conf_file, vpool.guard.state)
+                    for vpool in self._vpools)
+
+    def timing_summary(self):
+        """
+        Log and return the latency summary of the storagerouter and tap-ctl
+        calls made so far, see ``instrumentation.TimingStats.summary``.
+        """
+        return instrumentation.TIMINGS.dump()
+
+    def _locate(self, blockdevice_id):
+        """
+        Find the vPool holding ``blockdevice_id``, trying the one recorded in
+        the inventory first.
+
+        While the circuit of the recorded vPool is open, what the inventory
+        knows is trusted however old it is.
+
+        :raises UnknownVolume: If no vPool has it.
+        :raises CircuitOpen: If it is on no vPool that answered, and some
+            did not.
+        :returns: ``(vpool, object_id)``.
+        """
+        owner = self._inventory.owner(blockdevice_id)
+        candidates = [v for v in self._vpools if v is owner]
+        candidates += [v for v in self._vpools if v is not owner]
+        unavailable = None
+        for vpool in candidates:
+            with vpool.clients.client() as client:
+                try:
+                    object_id = client.get_object_id(
+                        self._volume_path(blockdevice_id))
+                except src.ObjectNotFoundException:
+                    continue
+                except Resilience.CircuitOpen, e:
+                    object_id = self._inventory.stale(blockdevice_id)[0]
+                    if vpool is owner and object_id is not None:
+                        return vpool, object_id
+                    unavailable = e
+                    continue
+            if object_id is not None:
+                self._inventory.remember(blockdevice_id, object_id, vpool)
+                return vpool, object_id
+        if unavailable is not None:
+            raise unavailable
+        self._inventory.invalidate(blockdevice_id)
+        raise UnknownVolume(unicode(blockdevice_id))
+
+    def _owner(self, blockdevice_id):
+        """
+        The ``_VPool`` holding ``blockdevice_id``.
+
+        :raises UnknownVolume: If no vPool has it.
+        """
+        owner = self._inventory.owner(blockdevice_id)
+        if owner is not None and blockdevice_id in self._inventory:
+            return owner
+        return self._locate(blockdevice_id)[0]
 
     def _check_exists(self, blockdevice_id):
-        all_volumes = [os.path.splitext(x)[0].lstrip("/")
-                       for x in self.client.list_volumes_by_path()]
-        if blockdevice_id not in all_volumes:
-            raise UnknownVolume(unicode(blockdevice_id))
+        """
+        Raise ``UnknownVolume`` unless ``blockdevice_id`` exists on a vPool.
 
-    def _list_maps(self):
+        Volumes recently seen in the inventory are trusted, anything else
+        costs a single lookup of the volume path per vPool, whatever the
+        size of the vPools.
+        """
+        if blockdevice_id in self._inventory:
+            return
+        self._locate(blockdevice_id)
+
+    def _list_maps(self, table=None):
         """
         Return a ``dict`` mapping unicode OpenvStorage volumes to mounted block
         device ``FilePath``s for the active pool only.
         This information only applies to this host.
+
+        :param TapdiskTable table: Tapdisk snapshot to use, a new one is
+            taken if ``None``.
         """
         maps = dict()
-        list_output = Blktap.Tapdisk.list()
-        if not len(list_output):
+        if table is None:
+            table = Blktap.Tapdisk.snapshot()
+        if not len(table):
             return maps
-        for i in list_output:
+        for i in table:
             try:
                 _dataset_id(i.volume)
             except ExternalBlockDeviceId:
@@ -114,19 +724,125 @@ class OpenvStorageBlockDeviceAPI(object):
             maps[i.volume] = FilePath(i.device)
         return maps
 
-    def _is_already_mapped(self, blockdevice_id):
+    def _is_already_mapped(self, blockdevice_id, table=None):
         """
         Return ``True`` or ``False`` if requested blockdevice_id is already
         mapped.
         """
-        mapped = self._list_maps()
-        for volume in mapped:
-            if volume == blockdevice_id:
-                return True
-        return False
+        if table is None:
+            table = Blktap.Tapdisk.snapshot()
+        return table.from_volume(blockdevice_id) is not None
+
+    def _device_path(self, blockdevice_id, table):
+        """
+        Return the tapdev ``FilePath`` of ``blockdevice_id`` in ``table``.
+
+        :raises UnattachedVolume: If it is not mapped on this host.
+        """
+        tapdisk = table.from_volume(blockdevice_id)
+        if tapdisk is None or tapdisk.device is None:
+            raise UnattachedVolume(blockdevice_id)
+        return FilePath(tapdisk.device)
+
+    def _volume_metadata(self, blockdevice_id, refresh=False):
+        """
+        Return ``(object_id, size)`` of ``blockdevice_id``, asking the
+        storagerouter only for what the inventory does not know.
+
+        :param bool refresh: Ask for the size even if it is cached.
+        :raises UnknownVolume: If no vPool has it.
+        """
+        object_id, size = self._inventory.lookup(blockdevice_id)
+        vpool = self._inventory.owner(blockdevice_id)
+        if refresh:
+            size = None
+        if object_id is None or vpool is None:
+            vpool, object_id = self._locate(blockdevice_id)
+        if size is None:
+            try:
+                with vpool.clients.client() as client:
+                    size = client.info_volume(object_id).volume_size
+            except Resilience.CircuitOpen:
+                size = self._inventory.stale(blockdevice_id)[1]
+                if size is None:
+                    raise
+                return object_id, size
+            self._inventory.update(blockdevice_id, object_id, size)
+        return object_id, size
+
+    def _fetch_size(self, blockdevice_id):
+        """
+        Size of ``blockdevice_id``, ``None`` if it vanished from its vPool.
+        """
+        try:
+            return self._volume_metadata(blockdevice_id)[1]
+        except (UnknownVolume, src.ObjectNotFoundException):
+            self._inventory.invalidate(blockdevice_id)
+            return None
+
+    def _map(self, function, items, kind="metadata"):
+        """
+        ``map`` over at most ``metadata_workers`` or ``bulk_workers``
+        threads, depending on ``kind``, keeping the order of ``items``.
+        """
+        width = self._widths[kind]
+        if width == 1 or len(items) < 2:
+            return map(function, items)
+        with self._pools_lock:
+            pool = self._pools.get(kind)
+            if pool is None:
+                from multiprocessing.pool import ThreadPool
+                pool = self._pools[kind] = ThreadPool(width)
+        return pool.map(function, items)
+
+    def _bulk(self, function, items, key):
+        """
+        Run ``function(item)`` for every item on the bulk workers.
+
+        :param key: Returns the ``blockdevice_id`` of an item.
+        :returns: A ``list`` of ``BulkResult`` in the order of ``items``.
+        """
+        def run(item):
+            try:
+                return BulkResult(blockdevice_id=key(item),
+                                  result=function(item))
+            except Exception, e:
+                return BulkResult(blockdevice_id=key(item), error=e)
+        return self._map(run, list(items), "bulk")
+
+    def _sizes(self, blockdevice_ids):
+        """
+        Sizes of ``blockdevice_ids`` in the same order. Cached sizes are used
+        as is, the others are fetched concurrently.
+        """
+        sizes = [self._inventory.lookup(b)[1] for b in blockdevice_ids]
+        missing = [i for i, size in enumerate(sizes) if size is None]
+        fetched = self._map(self._fetch_size,
+                            [blockdevice_ids[i] for i in missing])
+        for i, size in zip(missing, fetched):
+            sizes[i] = size
+        return sizes
 
     def allocation_unit(self):
-        return 1024 * 1024
+        """
+        The configured allocation unit, aligned to the cluster size of
+        every vPool so volumes never end in a partial cluster.
+        """
+        if self._aligned_unit is None:
+            unit = self._allocation_unit
+            for vpool in self._vpools:
+                unit = _lcm(unit,
+                            _vpool_cluster_size(vpool.vpool_conf_file) or
+                            DEFAULT_CLUSTER_SIZE)
+            self._aligned_unit = unit
+        return self._aligned_unit
+
+    def _round_size(self, size):
+        """
+        ``size`` rounded up to a multiple of ``allocation_unit``.
+        """
+        unit = self.allocation_unit()
+        return -(-size // unit) * unit
 
     def compute_instance_id(self):
         """
@@ -143,18 +859,133 @@ class OpenvStorageBlockDeviceAPI(object):
         :param int size: The size of the new volume in bytes.
         :returns: A ``BlockDeviceVolume``.
         """
+        return self._create_volume(dataset_id, size)
+
+    def create_volume_with_profile(self, dataset_id, size, profile_name):
+        """
+        Create a new OpenvStorage volume in the storage profile
+        ``profile_name``. Unknown profiles get a plain ``create_volume``.
+        :param UUID dataset_id: The Flocker dataset ID of the dataset on this
+            volume.
+        :param int size: The size of the new volume in bytes.
+        :param unicode profile_name: The name of the storage profile.
+        :returns: A ``BlockDeviceVolume``.
+        """
+        profile = self._profiles.get(unicode(profile_name).lower())
+        return self._create_volume(dataset_id, size, profile)
+
+    def _create_volume(self, dataset_id, size, profile=None):
         blockdevice_id = _blockdevice_id(dataset_id)
-        try:
-            self.client.info_volume(str(blockdevice_id))
-            raise VolumeExists(blockdevice_id)
-        except src.ObjectNotFoundException:
-            self.client.create_volume("/%s.raw" % str(blockdevice_id),
-                                      None,
-                                      "%d KiB" % Byte(size).to_KiB().value)
+        size = self._round_size(size)
+        with self._locks.lock(blockdevice_id):
+            self._inventory.invalidate(blockdevice_id)
+            try:
+                self._locate(blockdevice_id)
+                raise VolumeExists(blockdevice_id)
+            except UnknownVolume:
+                pass
+            template, template_snapshot = self._template
+            if profile is not None and profile.template is not None:
+                template = profile.template
+                template_snapshot = profile.template_snapshot
+            if profile is not None and profile.vpool_conf_file is not None:
+                vpools = [self._vpool_of_conf(profile.vpool_conf_file)]
+            else:
+                vpools = self._placement_vpools
+            if template is not None:
+                # Clones share the backend of their parent, so the volume
+                # goes to the vPool holding the template.
+                vpool, parent_id = self._find_template(vpools, template)
+            elif len(vpools) == 1:
+                vpool = vpools[0]
+            else:
+                vpool = self._place()
+            path = self._volume_path(blockdevice_id)
+            self._create_namespace(vpool)
+            with vpool.clients.client() as client:
+                if template is None:
+                    client.create_volume(
+                        path, None, "%d KiB" % (size // 1024))
+                else:
+                    self._clone(client, path, size, parent_id, template,
+                                template_snapshot)
+                if profile is not None:
+                    try:
+                        Profiles.apply_profile(
+                            src, client, client.get_object_id(path), profile)
+                    except Exception:
+                        # Flocker would adopt it as a plain volume
+                        self._discard(client, path)
+            self._inventory.remember(blockdevice_id, vpool=vpool)
             return BlockDeviceVolume(blockdevice_id=blockdevice_id,
                                      size=size,
                                      dataset_id=dataset_id)
 
+    def _discard(self, client, path):
+        """
+        Unlink the new vdisk at ``path`` that could not be set up, and
+        raise the exception being handled again.
+        """
+        exc_info = sys.exc_info()
+        try:
+            client.unlink(path)
+        except Exception:
+            # The original failure matters more
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _find_template(self, vpools, template):
+        """
+        The vPool holding the template vdisk at ``template`` and its
+        object_id, trying ``vpools`` in order.
+
+        :raises TemplateError: If none of them has it.
+        """
+        for vpool in vpools:
+            object_id = self._templates.get((vpool, template))
+            if object_id is not None:
+                return vpool, object_id
+            with vpool.clients.client() as client:
+                try:
+                    object_id = client.get_object_id(template)
+                except src.ObjectNotFoundException:
+                    continue
+            if object_id is not None:
+                self._templates[(vpool, template)] = object_id
+                return vpool, object_id
+        raise TemplateError("Template %s not found on %s" %
+                            (template, ", ".join(v.vpool_conf_file
+                                                 for v in vpools)))
+
+    def _clone(self, client, path, size, parent_id, template, snapshot):
+        """
+        Create a thin clone of the template ``parent_id`` at ``path``, from
+        ``snapshot`` if given, grown to ``size`` bytes.
+
+        :raises TemplateError: If the template is larger than ``size``.
+        """
+        template_size = client.info_volume(parent_id).volume_size
+        if template_size > size:
+            raise TemplateError("Template %s (%d bytes) does not fit in %d "
+                                "bytes" % (template, template_size, size))
+        try:
+            if snapshot is None:
+                client.create_clone_from_template(path, None, parent_id)
+            else:
+                client.create_clone(path, None, parent_id, str(snapshot))
+        except src.ObjectNotFoundException:
+            # The template went away, look it up again next time
+            for key in [k for k in self._templates if k[1] == template]:
+                self._templates.pop(key, None)
+            raise TemplateError("Template %s not found" % (template,))
+        if size > template_size:
+            try:
+                client.resize(client.get_object_id(path),
+                              "%d KiB" % (size // 1024))
+            except Exception:
+                # Left at the size of the template, Flocker would adopt it
+                self._discard(client, path)
+
     def destroy_volume(self, blockdevice_id):
         """
         Destroy an existing OpenvStorage volume.
@@ -164,9 +995,32 @@ class OpenvStorageBlockDeviceAPI(object):
             exist.
         :return: ``None``
         """
+        self._destroy_volume(blockdevice_id)
+
+    def _destroy_volume(self, blockdevice_id, vpool=None,
+                        unless_attached=False):
+        """
+        :param vpool: The ``_VPool`` holding the volume. Without it the
+            volume is looked up first.
+        :param unless_attached: Refuse to destroy the volume if it is
+            attached to this host.
+        :raises AlreadyAttachedVolume: If it is attached and
+            ``unless_attached`` is set.
+        """
         ascii_blockdevice_id = blockdevice_id.encode()
-        self._check_exists(ascii_blockdevice_id)
-        self.client.unlink(str("/%s.raw" % ascii_blockdevice_id))
+        with self._locks.lock(blockdevice_id):
+            if unless_attached and self._is_already_mapped(blockdevice_id):
+                raise AlreadyAttachedVolume(blockdevice_id)
+            if vpool is None:
+                vpool = self._owner(ascii_blockdevice_id)
+            self._inventory.invalidate(blockdevice_id)
+            try:
+                with vpool.clients.client() as client:
+                    client.unlink(self._volume_path(ascii_blockdevice_id))
+            except src.ObjectNotFoundException:
+                self._locks.remove(blockdevice_id)
+                raise UnknownVolume(unicode(blockdevice_id))
+            self._locks.remove(blockdevice_id)
 
     def attach_volume(self, blockdevice_id, attach_to):
         """
@@ -181,27 +1035,95 @@ class OpenvStorageBlockDeviceAPI(object):
         :raises UnknownVolume: If the supplied ``blockdevice_id`` does not
             exist.
         :raises AlreadyAttachedVolume: If the supplied ``blockdevice_id`` is
-            already attached.
+            already attached, unless it is read-only and attached read-only.
         :returns: A ``BlockDeviceVolume`` with a ``attached_to`` attribute set
             to ``attach_to``.
         """
-        ascii_blockdevice_id = blockdevice_id.encode()
-        self._check_exists(ascii_blockdevice_id)
+        return self._attach(blockdevice_id, attach_to)
 
-        if self._is_already_mapped(blockdevice_id):
+    def _readonly(self, blockdevice_id, vpool):
+        """
+        Whether ``blockdevice_id`` is attached read-only: its dataset is in
+        ``readonly_datasets`` or a ``readonly`` profile is on ``vpool``.
+        """
+        return _dataset_id(blockdevice_id) in self._readonly_datasets or \
+            bool(vpool.attach_settings.get("readonly"))
+
+    def _shared(self, blockdevice_id, tapdisk, readonly):
+        """
+        Check an attach of ``blockdevice_id`` may share ``tapdisk``, the
+        tapdisk it already has on this host: only read-only volumes may,
+        and not with a tapdev known to be writable.
+
+        :raises AlreadyAttachedVolume: If it may not.
+        """
+        if not readonly or Blktap.Tapdisk.is_readonly(tapdisk.device) is False:
             raise AlreadyAttachedVolume(blockdevice_id)
 
+    def _attach(self, blockdevice_id, attach_to):
+        """
+        Attach ``blockdevice_id`` while holding its lock, so the mapping
+        check and ``tap-ctl create`` cannot interleave with another attach
+        of the same volume, in this process or any other.
+        """
+        ascii_blockdevice_id = blockdevice_id.encode()
+        vpool = self._owner(ascii_blockdevice_id)
+        readonly = self._readonly(blockdevice_id, vpool)
+
         if attach_to != self.compute_instance_id():
+            if not readonly and self._is_already_mapped(blockdevice_id):
+                raise AlreadyAttachedVolume(blockdevice_id)
             return
 
-        Blktap.Tapdisk.create(blockdevice_id)
-        object_id = self.client.get_object_id(str("/%s.raw" % blockdevice_id))
-        size = self.client.info_volume(object_id).volume_size
+        with self._locks.lock(blockdevice_id):
+            table = Blktap.Tapdisk.snapshot()
+            tapdisk = table.from_volume(blockdevice_id)
+            if tapdisk is not None:
+                # Read-only volumes share the tapdev they already have
+                self._shared(blockdevice_id, tapdisk, readonly)
+                device = None
+            else:
+                device = Blktap.Tapdisk.create(
+                    self._tapdisk_volume(blockdevice_id), readonly,
+                    timeout=vpool.attach_settings.get("tap_ctl_timeout"))
+        self._tune_queue(vpool, device)
+        _, size = self._volume_metadata(blockdevice_id, refresh=True)
         return BlockDeviceVolume(blockdevice_id=blockdevice_id,
                                  size=size,
                                  attached_to=self.compute_instance_id(),
                                  dataset_id=_dataset_id(blockdevice_id))
 
+    def _tune_queue(self, vpool, device):
+        """
+        Apply the global queue tuning, overridden by the one of the
+        profiles on ``vpool``, to the tapdev ``device``.
+
+        :returns: The settings read back, ``None`` if there is nothing to
+            tune or the device is gone.
+        """
+        settings = dict(self._queue_tuning or {})
+        settings.update(vpool.attach_settings.get("queue_tuning") or {})
+        if not settings or not device:
+            return None
+        try:
+            return Tuning.tune_queue(device, settings)
+        except OSError:
+            return None
+
+    def queue_report(self, blockdevice_id):
+        """
+        The current block queue settings of the tapdev of
+        ``blockdevice_id`` on this host.
+
+        :raises UnknownVolume: If the supplied ``blockdevice_id`` does not
+            exist.
+        :raises UnattachedVolume: If it is not attached to this host.
+        :returns: A ``dict`` mapping each of ``tuning.QUEUE_SETTINGS`` to
+            its value, ``None`` where it cannot be read.
+        """
+        device = self.get_device_path(blockdevice_id)
+        return Tuning.read_queue(device.path)
+
     def detach_volume(self, blockdevice_id):
         """
         Detach ``blockdevice_id`` from whatever host it is attached to.
@@ -216,27 +1138,137 @@ class OpenvStorageBlockDeviceAPI(object):
         :returns: ``None``
         """
         self._check_exists(blockdevice_id)
-        device_path = self.get_device_path(blockdevice_id).path
-        Blktap.Tapdisk.destroy(str(device_path))
+        self._detach(blockdevice_id)
+
+    def _detach(self, blockdevice_id, table=None, holders=None):
+        """
+        Destroy the tapdisk of ``blockdevice_id`` while holding its lock,
+        quiescing it first in ``"quiesce"`` detach mode.
+
+        :param TapdiskTable table: Tapdisk snapshot to use, a new one is
+            taken once the lock is held if ``None``.
+        :param HolderIndex holders: Holder index to check the tapdev
+            against, a new one is built if ``None``.
+        """
+        with self._locks.lock(blockdevice_id):
+            if table is None:
+                table = Blktap.Tapdisk.snapshot()
+            device = str(self._device_path(blockdevice_id, table).path)
+            if self._quiesce is not None:
+                self._quiesce_device(blockdevice_id, device, table, holders)
+            Blktap.Tapdisk.destroy(device, table)
+            self._inventory.invalidate(blockdevice_id)
+
+    def _quiesce_device(self, blockdevice_id, device, table, holders=None):
+        """
+        Pause the tapdisk of ``device``, which drains its in-flight I/O,
+        within the quiesce timeout.
+
+        :raises DeviceBusy: If the tapdev is mounted or held.
+        :raises TapdiskTimeout: If the pause takes too long; the tapdisk
+            is resumed.
+        """
+        if holders is None:
+            holders = Blktap.HolderIndex.build()
+        busy = holders.holders(device)
+        if busy:
+            raise DeviceBusy(blockdevice_id, busy)
+        try:
+            Blktap.Tapdisk.pause(device, table, timeout=self._quiesce)
+        except Blktap.TapdiskException:
+            try:
+                Blktap.Tapdisk.unpause(device, table)
+            except Blktap.TapdiskException:
+                pass
+            raise
+
+    def _list_paths(self, vpool):
+        """
+        The vdisk paths on ``vpool`` that may be Flocker volumes.
+
+        With a namespace only its directory on the vPool mount is read,
+        falling back to the storagerouter listing when the vPool is not
+        mounted here, and to the volumes in the inventory while its circuit
+        is open, once it was listed in full.
+        """
+        if self._namespace is not None and os.path.ismount(vpool.mountpoint):
+            directory = os.path.join(vpool.mountpoint, self._namespace)
+            try:
+                names = os.listdir(directory)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                names = []
+            return ["/%s/%s" % (self._namespace, name) for name in names]
+        try:
+            with vpool.clients.client() as client:
+                paths = client.list_volumes_by_path()
+        except Resilience.CircuitOpen:
+            # Only a full listing recorded every volume of the vPool
+            if not (vpool.listed and self._inventory.ttl):
+                raise
+            return [self._volume_path(blockdevice_id) for blockdevice_id
+                    in self._inventory.known(vpool)]
+        vpool.listed = True
+        return paths
+
+    def _create_namespace(self, vpool):
+        """
+        Make sure the namespace directory exists on ``vpool``, if it is
+        mounted here.
+        """
+        if self._namespace is None or not os.path.ismount(vpool.mountpoint):
+            return
+        try:
+            os.mkdir(os.path.join(vpool.mountpoint, self._namespace))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _flocker_volumes(self):
+        """
+        List the Flocker volumes with a single listing call per vPool.
+
+        :returns: A ``list`` of ``(blockdevice_id, dataset_id, vpool)``.
+        """
+        flocker_volumes = []
+        seen = set()
+        for vpool in self._vpools:
+            for path in self._list_paths(vpool):
+                blockdevice_id = _path_blockdevice_id(path, self._namespace)
+                if blockdevice_id is None:
+                    continue
+                blockdevice_id = blockdevice_id.decode()
+                try:
+                    dataset_id = _dataset_id(blockdevice_id)
+                except ExternalBlockDeviceId:
+                    continue
+                if blockdevice_id in seen:
+                    continue
+                seen.add(blockdevice_id)
+                self._inventory.remember(blockdevice_id, vpool=vpool)
+                flocker_volumes.append((blockdevice_id, dataset_id, vpool))
+        return flocker_volumes
 
     def list_volumes(self):
         """
         List all the block devices available via the back end API.
+
+        Sizes come from the volume inventory where possible, so in steady
+        state this costs a single listing call per vPool.
         :returns: A ``list`` of ``BlockDeviceVolume``s.
         """
         volumes = []
-        all_volumes = [os.path.splitext(x)[0].lstrip("/")
-                       for x in self.client.list_volumes_by_path()]
+        flocker_volumes = self._flocker_volumes()
         all_maps = self._list_maps()
-        for blockdevice_id in all_volumes:
-            blockdevice_id = blockdevice_id.decode()
-            try:
-                dataset_id = _dataset_id(blockdevice_id)
-            except ExternalBlockDeviceId:
+        blockdevice_ids = [b for b, _, _ in flocker_volumes]
+        self._inventory.retain(blockdevice_ids)
+        sizes = self._sizes(blockdevice_ids)
+        for (blockdevice_id, dataset_id, _), size in zip(flocker_volumes,
+                                                         sizes):
+            if size is None:
+                # Removed by somebody else since the listing.
                 continue
-            object_id = \
-                self.client.get_object_id(str("/%s.raw" % blockdevice_id))
-            size = self.client.info_volume(object_id).volume_size
             if blockdevice_id in all_maps:
                 attached_to = self.compute_instance_id()
             else:
@@ -262,43 +1294,115 @@ class OpenvStorageBlockDeviceAPI(object):
         :returns: A ``FilePath`` for the device.
         """
         self._check_exists(blockdevice_id)
-        maps = self._list_maps()
-        try:
-            return maps[blockdevice_id]
-        except KeyError:
-            raise UnattachedVolume(blockdevice_id)
+        return self._device_path(blockdevice_id, Blktap.Tapdisk.snapshot())
+
+    def create_volumes(self, volumes):
+        """
+        Create several OpenvStorage volumes concurrently.
+
+        :param volumes: An iterable of ``(dataset_id, size)``.
+        :returns: A ``list`` of ``BulkResult`` whose ``result`` is the
+            ``BlockDeviceVolume``.
+        """
+        return self._bulk(
+            lambda (dataset_id, size): self._create_volume(dataset_id, size),
+            volumes, lambda (dataset_id, _): _blockdevice_id(dataset_id))
+
+    def attach_volumes(self, blockdevice_ids, attach_to=None):
+        """
+        Attach several volumes to this host concurrently. Each attach holds
+        the lock of its volume, so independent volumes proceed in parallel.
+
+        :param unicode attach_to: The node to attach to, this host if
+            ``None``.
+        :returns: A ``list`` of ``BulkResult`` whose ``result`` is the
+            ``BlockDeviceVolume``.
+        """
+        if attach_to is None:
+            attach_to = self.compute_instance_id()
+        return self._bulk(
+            lambda blockdevice_id: self._attach(blockdevice_id, attach_to),
+            blockdevice_ids, lambda blockdevice_id: blockdevice_id)
+
+    def destroy_volumes(self, blockdevice_ids):
+        """
+        Destroy several OpenvStorage volumes concurrently.
+
+        :returns: A ``list`` of ``BulkResult``.
+        """
+        return self._bulk(self._destroy_volume, blockdevice_ids,
+                          lambda blockdevice_id: blockdevice_id)
+
+    def detach_volumes(self, blockdevice_ids, table=None):
+        """
+        Detach several volumes from this host concurrently, using a single
+        tapdisk snapshot and, in ``"quiesce"`` detach mode, a single holder
+        index.
+
+        :param TapdiskTable table: Tapdisk snapshot to use, a new one is
+            taken if ``None``.
+        :returns: A ``list`` of ``BulkResult``.
+        """
+        if table is None:
+            table = Blktap.Tapdisk.snapshot()
+        holders = None
+        if self._quiesce is not None:
+            holders = Blktap.HolderIndex.build()
+
+        def detach(blockdevice_id):
+            self._check_exists(blockdevice_id)
+            self._detach(blockdevice_id, table, holders)
+        return self._bulk(detach, blockdevice_ids,
+                          lambda blockdevice_id: blockdevice_id)
+
+    def reconciler(self):
+        """
+        The ``reconcile.Reconciler`` of this driver, made on first use.
+        """
+        if self._reconciler is None:
+            # Imported here, it depends on this module
+            from openvstorage_flocker_plugin.reconcile import Reconciler
+            self._reconciler = Reconciler(self, **self._reconcile_settings)
+        return self._reconciler
+
+    def reconcile(self, datasets=None, dry_run=None):
+        """
+        Find and clean up orphaned tapdisks, tapdev minors and, if
+        ``datasets`` is given, Flocker vdisks of no dataset in it.
+
+        :param datasets: The dataset ids (``UUID``) in use.
+        :param dry_run: Only report the orphans; the ``reconcile_dry_run``
+            setting if ``None``.
+        :returns: A ``list`` of ``reconcile.Orphan``.
+        """
+        return self.reconciler().sweep(datasets, dry_run)
 
     def destroy_all_flocker_volumes(self):
         """
         Search for and destroy all Flocker volumes.
+
+        Volumes that vanish or get detached meanwhile are skipped, and those
+        that failed to detach are kept, so no tapdisk is left without its
+        vdisk. The first other failure is raised once every volume has been
+        handled.
         """
-        maps = self._list_maps()
-        for blockdevice_id in maps:
-            self.detach_volume(blockdevice_id)
-        for blockdevicevolume in self.list_volumes():
-            self.destroy_volume(blockdevicevolume.blockdevice_id)
-
-
-def openvstorage_from_configuration(vpool_conf_file):
-    return OpenvStorageBlockDeviceAPI(vpool_conf_file)
-
-
-def main():
-    if len(sys.argv) != 2:
-        print "Please provide vPool configuration file"
-        return
-    vpool_config_file = sys.argv[1]
-    vs = openvstorage_from_configuration(vpool_conf_file=vpool_config_file)
-    volume = vs.create_volume(dataset_id=uuid.uuid4(), size=21474836480)
-    vs.list_volumes()
-    vm = vs.compute_instance_id()
-    vs.attach_volume(blockdevice_id=volume.blockdevice_id, attach_to=vm)
-    vs.list_volumes()
-    vs.get_device_path(volume.blockdevice_id)
-    vs.detach_volume(volume.blockdevice_id)
-    vs.list_volumes()
-    vs.destroy_volume(volume.blockdevice_id)
-    vs.list_volumes()
-
-if __name__ == '__main__':
-    main()
+        table = Blktap.Tapdisk.snapshot()
+        results = self.detach_volumes(list(self._list_maps(table)), table)
+        attached = set(result.blockdevice_id for result in results
+                       if not isinstance(result.error,
+                                         (type(None), UnknownVolume,
+                                          UnattachedVolume)))
+        results += self._bulk(
+            lambda (blockdevice_id, _, vpool):
+                self._destroy_volume(blockdevice_id, vpool),
+            [volume for volume in self._flocker_volumes()
+             if volume[0] not in attached],
+            lambda (blockdevice_id, _, __): blockdevice_id)
+        for result in results:
+            if not isinstance(result.error,
+                              (type(None), UnknownVolume, UnattachedVolume)):
+                raise result.error
+
+
+def openvstorage_from_configuration(vpool_conf_file, **kwargs):
+    return OpenvStorageBlockDeviceAPI(vpool_conf_file, **kwargs)
@@ -0,0 +1,101 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Placement policies: which of the configured vPools a new volume goes to.
+
+A policy is an object with a ``choose(vpools, usage)`` method, where
+``usage`` is a callable returning the ``VPoolUsage`` of every vPool and
+is only called by the policies that need it.
+"""
+import itertools
+import threading
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+
+class InvalidPlacement(Exception):
+    """
+    The configured placement policy does not exist.
+    """
+
+
+class VPoolUsage(object):
+    """
+    The Flocker volumes of one vPool.
+    """
+    __slots__ = ('volumes', 'allocated')
+
+    def __init__(self, volumes=0, allocated=0):
+        self.volumes = volumes
+        self.allocated = allocated
+
+
+class RoundRobinPlacement(object):
+    """
+    Cycle through the vPools.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self, vpools, usage):
+        with self._lock:
+            return vpools[next(self._counter) % len(vpools)]
+
+
+class LeastUsedPlacement(object):
+    """
+    The vPool with the fewest bytes allocated to Flocker volumes.
+    """
+
+    def choose(self, vpools, usage):
+        usages = usage()
+        return min(vpools, key=lambda vpool: usages[vpool].allocated)
+
+
+class FewestVolumesPlacement(object):
+    """
+    The vPool with the fewest Flocker volumes.
+    """
+
+    def choose(self, vpools, usage):
+        usages = usage()
+        return min(vpools, key=lambda vpool: usages[vpool].volumes)
+
+
+PLACEMENTS = {
+    "round_robin": RoundRobinPlacement,
+    "least_used": LeastUsedPlacement,
+    "fewest_volumes": FewestVolumesPlacement,
+}
+
+
+def placement_from_configuration(name):
+    """
+    :param name: A key of ``PLACEMENTS``, or a policy object.
+    :raises InvalidPlacement: For unknown names.
+    """
+    if not isinstance(name, basestring):
+        return name
+    try:
+        return PLACEMENTS[name]()
+    except KeyError:
+        raise InvalidPlacement("Unknown placement policy %s, use one of %s" %
+                               (name, ", ".join(sorted(PLACEMENTS))))
@@ -0,0 +1,126 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.placement``.
+"""
+from uuid import uuid4
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin.blockdevice_tests import FakeDriverMixin
+from openvstorage_flocker_plugin.placement import (
+    FewestVolumesPlacement, InvalidPlacement, LeastUsedPlacement,
+    RoundRobinPlacement, VPoolUsage, placement_from_configuration
+)
+from openvstorage_flocker_plugin.testtools import FakeStorageRouterClient
+
+GiB = 1024 * 1024 * 1024
+
+VPOOLS = ["pool1", "pool2", "pool3"]
+
+# pool2 has the fewest bytes, pool3 the fewest volumes
+INVENTORY = {
+    "pool1": VPoolUsage(volumes=4, allocated=40 * GiB),
+    "pool2": VPoolUsage(volumes=8, allocated=8 * GiB),
+    "pool3": VPoolUsage(volumes=2, allocated=20 * GiB),
+}
+
+
+def _unused():
+    raise AssertionError("usage is not needed")
+
+
+class PlacementTests(TestCase):
+    """
+    Tests for the placement policies on a fake inventory.
+    """
+
+    def test_round_robin(self):
+        """
+        ``round_robin`` cycles through the vPools without the inventory.
+        """
+        policy = RoundRobinPlacement()
+        self.assertEqual(VPOOLS + VPOOLS[:1],
+                         [policy.choose(VPOOLS, _unused) for _ in range(4)])
+
+    def test_least_used(self):
+        """
+        ``least_used`` picks the vPool with the fewest bytes allocated.
+        """
+        self.assertEqual("pool2", LeastUsedPlacement().choose(
+            VPOOLS, lambda: INVENTORY))
+
+    def test_fewest_volumes(self):
+        """
+        ``fewest_volumes`` picks the vPool with the fewest volumes.
+        """
+        self.assertEqual("pool3", FewestVolumesPlacement().choose(
+            VPOOLS, lambda: INVENTORY))
+
+    def test_tie(self):
+        """
+        On a tie the first of the vPools is picked.
+        """
+        usages = dict((vpool, VPoolUsage()) for vpool in VPOOLS)
+        self.assertEqual(
+            ["pool1", "pool1"],
+            [policy.choose(VPOOLS, lambda: usages) for policy in
+             (LeastUsedPlacement(), FewestVolumesPlacement())])
+
+    def test_from_configuration(self):
+        """
+        Policies are made by name, policy objects are used as they are and
+        unknown names are refused.
+        """
+        policy = FewestVolumesPlacement()
+        self.assertEqual(
+            (LeastUsedPlacement, policy),
+            (type(placement_from_configuration("least_used")),
+             placement_from_configuration(policy)))
+        self.assertRaises(InvalidPlacement, placement_from_configuration,
+                          "random")
+
+
+class DriverPlacementTests(FakeDriverMixin, TestCase):
+    """
+    Tests for where the driver creates volumes with several vPools.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.other = FakeStorageRouterClient("other.json")
+        # fake.json has more bytes, other.json more volumes
+        self.client.populate(1, flocker=1, size=10 * GiB)
+        self.other.populate(2, flocker=2, size=GiB)
+
+    def place(self, placement):
+        api = self.api(vpools={"other.json": self.other},
+                       vpool_conf_files=["fake.json", "other.json"],
+                       placement=placement)
+        before = len(self.other.list_volumes_by_path())
+        api.create_volume(uuid4(), GiB)
+        return "other.json" if len(
+            self.other.list_volumes_by_path()) > before else "fake.json"
+
+    def test_least_used(self):
+        """
+        ``least_used`` counts the sizes of the Flocker volumes listed.
+        """
+        self.assertEqual("other.json", self.place("least_used"))
+
+    def test_fewest_volumes(self):
+        """
+        ``fewest_volumes`` counts the Flocker volumes listed.
+        """
+        self.assertEqual("fake.json", self.place("fewest_volumes"))
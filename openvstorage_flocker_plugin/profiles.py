@@ -0,0 +1,186 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Storage profiles: named performance tiers, defined in agent.yml, that map
+Flocker's gold/silver/bronze (or any other) profile names to a vPool and
+to per-volume cache and DTL settings.
+
+    "profiles":
+      "gold":
+        "vpool_conf_file": "/path/to/ssd-vpool.json"
+        "cache_behaviour": "cache_on_write"
+        "dtl": "sync"
+        "tap_ctl_timeout": 30
+        "queue_tuning":
+          "read_ahead_kb": 4096
+      "postgres":
+        "template": "/templates/postgres-seed.raw"
+      "reference":
+        "vpool_conf_file": "/path/to/reference-vpool.json"
+        "readonly": true
+      "bronze":
+        "cache_behaviour": "no_cache"
+        "dtl": "none"
+"""
+from characteristic import attributes, Attribute
+
+import tuning as Tuning
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+# agent.yml values and the matching ``ClusterCacheBehaviour`` members.
+CACHE_BEHAVIOURS = {
+    "cache_on_read": "CACHE_ON_READ",
+    "cache_on_write": "CACHE_ON_WRITE",
+    "no_cache": "NO_CACHE",
+}
+
+# agent.yml values and the matching ``DTLMode`` members; ``none`` disables
+# the DTL of the volume.
+DTL_MODES = {
+    "none": None,
+    "async": "ASYNCHRONOUS",
+    "sync": "SYNCHRONOUS",
+}
+
+
+class InvalidProfile(Exception):
+    """
+    A storage profile in the configuration cannot be used.
+    """
+
+
+@attributes(["name",
+             Attribute("vpool_conf_file", default_value=None),
+             Attribute("cache_behaviour", default_value=None),
+             Attribute("dtl", default_value=None),
+             Attribute("dtl_host", default_value=None),
+             Attribute("dtl_port", default_value=None),
+             Attribute("tap_ctl_timeout", default_value=None),
+             Attribute("template", default_value=None),
+             Attribute("template_snapshot", default_value=None),
+             Attribute("queue_tuning", default_value=None),
+             Attribute("readonly", default_value=None)])
+class StorageProfile(object):
+    """
+    A performance tier volumes can be created in.
+
+    :ivar unicode name: The Flocker profile name.
+    :ivar vpool_conf_file: The vPool the volumes live on, the default vPool
+        if ``None``.
+    :ivar cache_behaviour: A key of ``CACHE_BEHAVIOURS``, or ``None`` to
+        keep the vPool default.
+    :ivar dtl: A key of ``DTL_MODES``, or ``None`` to keep the vPool
+        default. ``async`` and ``sync`` need ``dtl_host`` and ``dtl_port``.
+    :ivar tap_ctl_timeout: Seconds ``tap-ctl`` may take to attach volumes
+        of this profile.
+    :ivar template: Path of the template vdisk volumes of this profile are
+        cloned from, ``None`` for empty volumes.
+    :ivar template_snapshot: Snapshot of ``template`` to clone, ``None``
+        to clone the template itself.
+    :ivar queue_tuning: Block queue settings of the tapdevs of this
+        profile, on top of the global ``queue_tuning``.
+    :ivar readonly: Attach the volumes read-only, so several containers
+        and hosts may attach them at once.
+    """
+
+    def attach_settings(self):
+        """
+        The settings applied when a volume is attached, which therefore
+        belong to the vPool rather than to a single volume.
+        """
+        return dict((key, value) for key, value
+                    in [("tap_ctl_timeout", self.tap_ctl_timeout),
+                        ("queue_tuning", self.queue_tuning),
+                        ("readonly", self.readonly)]
+                    if value is not None)
+
+
+def profiles_from_configuration(config):
+    """
+    Parse the ``profiles`` section of agent.yml.
+
+    :param dict config: Profile names mapped to their settings.
+    :raises InvalidProfile: For unknown settings or values, or a
+        ``readonly`` profile without a ``vpool_conf_file``.
+    :returns: A ``dict`` mapping lower case profile names to
+        ``StorageProfile``.
+    """
+    profiles = dict()
+    fields = set(["vpool_conf_file", "cache_behaviour", "dtl", "dtl_host",
+                  "dtl_port", "tap_ctl_timeout", "template",
+                  "template_snapshot", "queue_tuning", "readonly"])
+    for name, settings in (config or {}).items():
+        settings = dict(settings or {})
+        unknown = set(settings) - fields
+        if unknown:
+            raise InvalidProfile("Unknown settings for profile %s: %s" %
+                                 (name, ", ".join(sorted(unknown))))
+        if settings.get("cache_behaviour") not in \
+                [None] + CACHE_BEHAVIOURS.keys():
+            raise InvalidProfile("Unknown cache_behaviour for profile %s" %
+                                 (name,))
+        if settings.get("dtl") not in [None] + DTL_MODES.keys():
+            raise InvalidProfile("Unknown dtl for profile %s" % (name,))
+        if settings.get("dtl") in ("async", "sync") and \
+                (not settings.get("dtl_host") or not settings.get("dtl_port")):
+            raise InvalidProfile("dtl %s of profile %s needs dtl_host and "
+                                 "dtl_port" % (settings["dtl"], name))
+        if settings.get("template_snapshot") is not None and \
+                settings.get("template") is None:
+            raise InvalidProfile("template_snapshot of profile %s needs a "
+                                 "template" % (name,))
+        try:
+            settings["queue_tuning"] = Tuning.queue_tuning_from_configuration(
+                settings.get("queue_tuning"))
+        except Tuning.InvalidQueueTuning, e:
+            raise InvalidProfile("Profile %s: %s" % (name, e))
+        if settings.get("tap_ctl_timeout") is not None:
+            settings["tap_ctl_timeout"] = float(settings["tap_ctl_timeout"])
+        if settings.get("readonly") is not None:
+            settings["readonly"] = bool(settings["readonly"])
+        if settings.get("readonly") and \
+                settings.get("vpool_conf_file") is None:
+            raise InvalidProfile("readonly profile %s needs a vpool_conf_file"
+                                 " of its own" % (name,))
+        profiles[unicode(name).lower()] = StorageProfile(
+            name=unicode(name).lower(), **settings)
+    return profiles
+
+
+def apply_profile(src, client, object_id, profile):
+    """
+    Apply the per-volume settings of ``profile`` to a new volume.
+
+    :param src: The storagerouter client module.
+    :param client: A storagerouter client of the volume's vPool.
+    """
+    if profile.cache_behaviour is not None:
+        client.set_cluster_cache_behaviour(
+            object_id, getattr(src.ClusterCacheBehaviour,
+                               CACHE_BEHAVIOURS[profile.cache_behaviour]))
+    if profile.dtl is not None:
+        mode = DTL_MODES[profile.dtl]
+        if mode is None:
+            client.set_manual_dtl_config(object_id, None)
+        else:
+            client.set_manual_dtl_config(
+                object_id, src.DTLConfig(str(profile.dtl_host),
+                                         int(profile.dtl_port),
+                                         getattr(src.DTLMode, mode)))
@@ -0,0 +1,352 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reconcile the tapdisks of this host with the vPools, joining one
+``tap-ctl list`` with one listing per vPool:
+
+* ``unlinked_tapdisk``: an openvstorage tapdisk of a Flocker volume that
+  no vPool has any more; it is destroyed.
+* ``leaked_minor``: a tapdev minor with no image open that no tapdisk
+  pool of a running agent recorded, left by a failed attach; it is
+  destroyed or freed.
+* ``unused_vdisk``: a Flocker vdisk, not attached to this host, whose
+  dataset is not among the ones given; it is destroyed. Only found when
+  the datasets in use are passed to ``Reconciler.sweep``.
+
+    python -m openvstorage_flocker_plugin.reconcile [--clean]
+        [--clean-minors] [-o namespace=flocker ...] <vpool_conf_file> [...]
+
+The idle tapdisks of the agents' pools are recorded in ``lock_dir`` and
+left alone. Minors other blktap users hold without an image open cannot be
+told apart from leaked ones, so the command line only destroys those with
+``--clean-minors``.
+"""
+import argparse
+import json
+import sys
+import threading
+
+import blktap as Blktap
+
+from characteristic import attributes, Attribute
+from eliot import Field, Logger, MessageType
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, UnknownVolume
+)
+
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    DeviceBusy, ExternalBlockDeviceId, _dataset_id
+)
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+_logger = Logger()
+
+UNLINKED_TAPDISK = "unlinked_tapdisk"
+LEAKED_MINOR = "leaked_minor"
+UNUSED_VDISK = "unused_vdisk"
+
+# Default number of orphans cleaned up per pass, the rest wait for the next.
+DEFAULT_BATCH = 32
+
+COUNTS = Field.for_types(
+    u"counts", [dict], u"Orphans found, by kind and what was done.")
+DRY_RUN = Field.for_types(
+    u"dry_run", [bool], u"Whether the orphans were only reported.")
+RECONCILED = MessageType(
+    u"openvstorage:reconcile:pass", [COUNTS, DRY_RUN],
+    u"A reconciliation pass over the tapdisks and vPools finished.")
+
+
+@attributes(["kind", "key",
+             Attribute("blockdevice_id", default_value=None),
+             Attribute("tapdisk", default_value=None),
+             Attribute("vpool", default_value=None),
+             Attribute("action", default_value="reported"),
+             Attribute("error", default_value=None)])
+class Orphan(object):
+    """
+    Something a reconciliation pass found.
+
+    :ivar kind: ``UNLINKED_TAPDISK``, ``LEAKED_MINOR`` or ``UNUSED_VDISK``.
+    :ivar key: Identifies the orphan across passes.
+    :ivar tapdisk: The ``Tapdisk.TapdiskInt``, if it is a tapdisk.
+    :ivar vpool: The ``_VPool`` of an unused vdisk.
+    :ivar action: ``reported`` in a dry run; ``deferred`` when first seen
+        or beyond the batch; ``cleaned``, ``busy``, ``kept`` when the
+        volume turned out to be in use, or ``failed``.
+    :ivar Exception error: Why it was not cleaned up.
+    """
+
+
+def _flocker_volume(name):
+    """
+    The ``blockdevice_id`` a tapdisk opens, ``None`` if not a Flocker one.
+    """
+    try:
+        blockdevice_id = name.decode()
+        _dataset_id(blockdevice_id)
+    except (ExternalBlockDeviceId, ValueError):
+        return None
+    return blockdevice_id
+
+
+def find_orphans(tapdisks, volumes, pooled=(), datasets=None):
+    """
+    Join a tapdisk listing with a vPool listing.
+
+    :param tapdisks: ``Tapdisk.list_all()``, taken before ``volumes`` so
+        every volume a listed tapdisk opens shows up in ``volumes``.
+    :param volumes: ``(blockdevice_id, dataset_id, vpool)`` of the Flocker
+        volumes on the vPools.
+    :param pooled: Minors of the tapdisk pool, which have no image open.
+    :param datasets: The dataset ids in use, unused vdisks are not looked
+        for if ``None``.
+    :returns: A ``list`` of ``Orphan``.
+    """
+    present = set(blockdevice_id for blockdevice_id, _, _ in volumes)
+    attached = set()
+    orphans = []
+    for tapdisk in tapdisks:
+        if tapdisk.driver is None:
+            if tapdisk.minor >= 0 and tapdisk.minor not in pooled:
+                orphans.append(Orphan(kind=LEAKED_MINOR,
+                                      key="minor:%d" % (tapdisk.minor,),
+                                      tapdisk=tapdisk))
+            continue
+        if tapdisk.driver != "openvstorage":
+            continue
+        blockdevice_id = _flocker_volume(tapdisk.volume)
+        if blockdevice_id is None:
+            continue
+        attached.add(blockdevice_id)
+        if blockdevice_id not in present:
+            orphans.append(Orphan(kind=UNLINKED_TAPDISK,
+                                  key="tapdisk:%s" % (blockdevice_id,),
+                                  blockdevice_id=blockdevice_id,
+                                  tapdisk=tapdisk))
+    if datasets is not None:
+        datasets = set(datasets)
+        for blockdevice_id, dataset_id, vpool in volumes:
+            if dataset_id not in datasets and blockdevice_id not in attached:
+                orphans.append(Orphan(kind=UNUSED_VDISK,
+                                      key="vdisk:%s" % (blockdevice_id,),
+                                      blockdevice_id=blockdevice_id,
+                                      vpool=vpool))
+    return orphans
+
+
+class Reconciler(object):
+    """
+    Finds and cleans up orphans of an ``OpenvStorageBlockDeviceAPI``,
+    on demand with ``sweep`` or every ``interval`` seconds on a background
+    thread once started.
+
+    Unless ``grace`` is off, an orphan is only cleaned up once two passes
+    in a row found it, so a tapdisk an attach is still setting up is left
+    alone. Clean-ups take the lock of their volume only, so other volumes
+    are not held up.
+
+    :param batch: Orphans cleaned up per pass at most.
+    :param dry_run: Only report orphans, by default.
+    :param leaked_minors: Clean up leaked minors, or only report them.
+    """
+
+    def __init__(self, api, interval=None, batch=DEFAULT_BATCH,
+                 dry_run=False, grace=True, leaked_minors=True):
+        self.api = api
+        self.interval = interval
+        self.batch = batch
+        self.dry_run = dry_run
+        self.grace = grace
+        self.leaked_minors = leaked_minors
+        self._suspects = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sweep(self, datasets=None, dry_run=None):
+        """
+        Run one pass.
+
+        :param datasets: The dataset ids in use, to look for unused vdisks.
+        :param dry_run: Overrides the ``dry_run`` of the reconciler.
+        :returns: A ``list`` of ``Orphan``.
+        """
+        if dry_run is None:
+            dry_run = self.dry_run
+        with self._lock:
+            tapdisks = Blktap.Tapdisk.list_all()
+            volumes = self.api._flocker_volumes()
+            orphans = find_orphans(tapdisks, volumes, self._pooled(),
+                                   datasets)
+            suspects, self._suspects = (self._suspects,
+                                        set(o.key for o in orphans))
+        if dry_run:
+            due = []
+        elif self.grace:
+            due = [o for o in orphans if o.key in suspects]
+        else:
+            due = list(orphans)
+        for orphan in orphans:
+            orphan.action = "reported" if dry_run or \
+                (orphan.kind == LEAKED_MINOR and not self.leaked_minors) \
+                else "deferred"
+        due = [o for o in due if o.action == "deferred"]
+        due = due[:self.batch]
+        if due:
+            holders = Blktap.HolderIndex.build()
+            results = self.api._bulk(lambda o: self._clean(o, holders), due,
+                                     lambda o: o.blockdevice_id or o.key)
+            for orphan, result in zip(due, results):
+                orphan.action = result.result if result.succeeded else \
+                    "busy" if isinstance(result.error, DeviceBusy) else \
+                    "failed"
+                orphan.error = result.error
+        counts = dict()
+        for orphan in orphans:
+            key = "%s.%s" % (orphan.kind, orphan.action)
+            counts[key] = counts.get(key, 0) + 1
+        RECONCILED(counts=counts, dry_run=dry_run).write(_logger)
+        return orphans
+
+    def _pooled(self):
+        """
+        The minors of the idle tapdisks of this and the other agents'
+        pools.
+        """
+        pooled = Blktap.TapdiskPool.pooled_minors(self.api._locks.directory)
+        pool = Blktap.Tapdisk.pool
+        if pool is not None:
+            pooled.update(pool.minors())
+        return pooled
+
+    def _clean(self, orphan, holders):
+        """
+        Clean up ``orphan``.
+
+        :raises DeviceBusy: If its tapdev is mounted or held.
+        :returns: ``"cleaned"``, or ``"kept"`` if the volume is in use
+            after all.
+        """
+        api = self.api
+        if orphan.kind == UNUSED_VDISK:
+            try:
+                api._destroy_volume(orphan.blockdevice_id, orphan.vpool,
+                                    unless_attached=True)
+            except AlreadyAttachedVolume:
+                return "kept"
+            return "cleaned"
+        if orphan.kind == LEAKED_MINOR:
+            return self._destroy_tapdisk(orphan, holders)
+        with api._locks.lock(orphan.blockdevice_id):
+            try:
+                api._locate(orphan.blockdevice_id.encode())
+            except UnknownVolume:
+                return self._destroy_tapdisk(orphan, holders)
+            return "kept"
+
+    def _destroy_tapdisk(self, orphan, holders):
+        tapdisk = orphan.tapdisk
+        busy = holders.holders(tapdisk.device) if tapdisk.device else []
+        if busy:
+            raise DeviceBusy(orphan.blockdevice_id or orphan.key, busy)
+        # Listed afresh, a snapshot has neither minors without an image nor
+        # the latest attaches
+        current = Blktap.TapdiskTable(
+            Blktap.Tapdisk.list_all()).from_minor(tapdisk.minor)
+        if current is None:
+            return "cleaned"
+        if orphan.kind == LEAKED_MINOR:
+            if current.driver is not None or current.pid != tapdisk.pid or \
+                    current.minor in self._pooled():
+                # An attach or the pool picked it up meanwhile
+                return "kept"
+        elif current.driver != "openvstorage" or \
+                _flocker_volume(current.volume) != orphan.blockdevice_id:
+            # The minor is reused by another volume
+            return "cleaned"
+        Blktap.Tapdisk.exc(*Blktap.Tapdisk.destroy_args(current))
+        return "cleaned"
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                # Try again next time, a failed pass changes nothing
+                pass
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='openvstorage-reconcile')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _option(text):
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report, or clean up, orphaned tapdisks and minors.")
+    parser.add_argument("--clean", action="store_true",
+                        help="clean the orphans up instead of reporting them")
+    parser.add_argument("--clean-minors", action="store_true",
+                        help="with --clean, also destroy leaked minors; "
+                             "only if no other blktap user runs on this "
+                             "host")
+    parser.add_argument("-o", "--option", action="append", default=[],
+                        type=_option, metavar="KEY=VALUE",
+                        help="driver setting, as in agent.yml")
+    parser.add_argument("vpool_conf_files", nargs="+",
+                        metavar="vpool_conf_file")
+    options = parser.parse_args(argv)
+
+    from openvstorage_flocker_plugin import api_factory
+    api = api_factory(cluster_id=None,
+                      vpool_conf_files=options.vpool_conf_files,
+                      **dict(options.option))
+    reconciler = Reconciler(api, batch=sys.maxint, grace=False,
+                            leaked_minors=options.clean_minors)
+    orphans = reconciler.sweep(dry_run=not options.clean)
+    for orphan in orphans:
+        print "%-16s %-8s %s%s" % (
+            orphan.kind, orphan.action,
+            orphan.blockdevice_id or orphan.key,
+            " (%s)" % (orphan.error,) if orphan.error else "")
+    print "%d orphans" % (len(orphans),)
+    return 1 if any(o.action in ("busy", "failed") for o in orphans) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
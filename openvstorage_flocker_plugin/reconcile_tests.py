@@ -0,0 +1,223 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.reconcile``.
+"""
+import json
+import os
+import subprocess
+from uuid import uuid4
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import blktap
+from openvstorage_flocker_plugin.blockdevice_tests import FakeDriverMixin
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    _blockdevice_id
+)
+from openvstorage_flocker_plugin.reconcile import (
+    LEAKED_MINOR, UNLINKED_TAPDISK, UNUSED_VDISK, Reconciler, find_orphans
+)
+
+GiB = 1024 * 1024 * 1024
+
+TapdiskInt = blktap.Tapdisk.TapdiskInt
+
+
+def _opened(minor, volume, driver="openvstorage"):
+    return TapdiskInt(pid="100%d" % (minor,), minor=minor, volume=volume,
+                      driver=driver)
+
+
+class FindOrphansTests(TestCase):
+    """
+    Tests for ``find_orphans``.
+    """
+
+    def kinds(self, *args, **kwargs):
+        return sorted((orphan.kind, orphan.key)
+                      for orphan in find_orphans(*args, **kwargs))
+
+    def test_unlinked_tapdisk(self):
+        """
+        A tapdisk of a Flocker volume no vPool lists is unlinked; those of
+        listed or foreign volumes are not.
+        """
+        gone, present = _blockdevice_id(uuid4()), _blockdevice_id(uuid4())
+        tapdisks = [_opened(0, gone), _opened(1, present),
+                    _opened(2, "some-vdisk"), _opened(3, gone, driver="aio")]
+        self.assertEqual(
+            [(UNLINKED_TAPDISK, "tapdisk:%s" % (gone,))],
+            self.kinds(tapdisks, [(present, uuid4(), None)]))
+
+    def test_leaked_minor(self):
+        """
+        A minor without an image is leaked unless the pool owns it.
+        """
+        tapdisks = [TapdiskInt(minor=0), TapdiskInt(pid="1001", minor=1)]
+        self.assertEqual([(LEAKED_MINOR, "minor:0")],
+                         self.kinds(tapdisks, [], pooled=set([1])))
+
+    def test_unused_vdisk(self):
+        """
+        With ``datasets``, a volume of another dataset that is not attached
+        here is unused.
+        """
+        used, unused, attached = uuid4(), uuid4(), uuid4()
+        volumes = [(_blockdevice_id(dataset_id), dataset_id, None)
+                   for dataset_id in (used, unused, attached)]
+        tapdisks = [_opened(0, _blockdevice_id(attached))]
+        self.assertEqual([], self.kinds(tapdisks, volumes))
+        self.assertEqual(
+            [(UNUSED_VDISK, "vdisk:%s" % (_blockdevice_id(unused),))],
+            self.kinds(tapdisks, volumes, datasets=[used]))
+
+
+class SweepTests(FakeDriverMixin, TestCase):
+    """
+    Tests for ``Reconciler.sweep`` against ``FakeTapCtl``.
+    """
+
+    def setUp(self):
+        FakeDriverMixin.setUp(self)
+        self.driver = self.api()
+
+    def leak(self, count):
+        """
+        Allocate ``count`` minors without a tapdisk.
+        """
+        return [blktap.Tapdisk.minor(blktap.Tapdisk.exc("allocate"))
+                for _ in range(count)]
+
+    def minors(self):
+        return sorted(tapdisk["minor"] for tapdisk in self.tap_ctl.tapdisks)
+
+    def actions(self, orphans):
+        return sorted((orphan.kind, orphan.action) for orphan in orphans)
+
+    def test_grace(self):
+        """
+        Orphans are only cleaned up by the second pass that finds them.
+        """
+        self.leak(1)
+        self.tap_ctl.seed([_blockdevice_id(uuid4())])
+        reconciler = Reconciler(self.driver)
+        self.assertEqual(
+            [(LEAKED_MINOR, "deferred"), (UNLINKED_TAPDISK, "deferred")],
+            self.actions(reconciler.sweep()))
+        self.assertEqual(2, len(self.tap_ctl.tapdisks))
+        self.assertEqual(
+            [(LEAKED_MINOR, "cleaned"), (UNLINKED_TAPDISK, "cleaned")],
+            self.actions(reconciler.sweep()))
+        self.assertEqual([], self.tap_ctl.tapdisks)
+
+    def test_batch(self):
+        """
+        At most ``batch`` orphans are cleaned up per pass.
+        """
+        self.leak(3)
+        reconciler = Reconciler(self.driver, batch=2, grace=False)
+        self.assertEqual(
+            [(LEAKED_MINOR, "cleaned")] * 2 + [(LEAKED_MINOR, "deferred")],
+            self.actions(reconciler.sweep()))
+        self.assertEqual(1, len(self.tap_ctl.tapdisks))
+
+    def test_dry_run(self):
+        """
+        A dry run reports the orphans and touches nothing.
+        """
+        self.leak(1)
+        volume = self.driver.create_volume(uuid4(), GiB)
+        reconciler = Reconciler(self.driver, grace=False)
+        for _ in range(2):
+            self.assertEqual(
+                [(LEAKED_MINOR, "reported"), (UNUSED_VDISK, "reported")],
+                self.actions(reconciler.sweep(datasets=[], dry_run=True)))
+        self.assertEqual(
+            ([0], [volume.blockdevice_id]),
+            (self.minors(), self.blockdevice_ids(self.driver)))
+
+    def test_unused_vdisk(self):
+        """
+        An unused vdisk is destroyed, a used one is kept.
+        """
+        used = self.driver.create_volume(uuid4(), GiB)
+        self.driver.create_volume(uuid4(), GiB)
+        reconciler = Reconciler(self.driver, grace=False)
+        self.assertEqual([(UNUSED_VDISK, "cleaned")],
+                         self.actions(reconciler.sweep(
+                             datasets=[used.dataset_id])))
+        self.assertEqual([used.blockdevice_id],
+                         self.blockdevice_ids(self.driver))
+
+    def test_other_pools(self):
+        """
+        The idle tapdisks recorded by the pools of running agents are not
+        leaked; those of agents that are gone are.
+        """
+        lock_dir = self.mktemp()
+        driver = self.api(lock_dir=lock_dir)
+        live, dead = self.leak(2)
+        child = subprocess.Popen(["true"])
+        child.wait()
+        for pid, minor in ((os.getppid(), live), (child.pid, dead)):
+            with open(os.path.join(lock_dir, blktap.TapdiskPool.STATE %
+                                   (pid,)), "w") as fh:
+                json.dump([[None, minor]], fh)
+        orphans = Reconciler(driver).sweep(dry_run=True)
+        self.assertEqual([(LEAKED_MINOR, "minor:%d" % (dead,))],
+                         [(o.kind, o.key) for o in orphans])
+
+    def test_keep_leaked_minors(self):
+        """
+        Without ``leaked_minors`` leaked minors are only reported.
+        """
+        self.leak(1)
+        self.tap_ctl.seed([_blockdevice_id(uuid4())])
+        reconciler = Reconciler(self.driver, grace=False,
+                                leaked_minors=False)
+        self.assertEqual(
+            [(LEAKED_MINOR, "reported"), (UNLINKED_TAPDISK, "cleaned")],
+            self.actions(reconciler.sweep()))
+        self.assertEqual([0], self.minors())
+
+    def test_leaked_minor_attached_meanwhile(self):
+        """
+        A leaked minor that had an image opened after it was listed is
+        kept.
+        """
+        minor, = self.leak(1)
+        orphan, = find_orphans(blktap.Tapdisk.list_all(), [])
+        blktap.Tapdisk.exc("open", "-m%s" % (minor,),
+                           "-aopenvstorage:%s" % (_blockdevice_id(uuid4()),))
+        reconciler = Reconciler(self.driver)
+        self.assertEqual(
+            "kept",
+            reconciler._destroy_tapdisk(orphan, blktap.HolderIndex.build()))
+        self.assertEqual([minor], self.minors())
+
+    def test_unlinked_tapdisk_reused(self):
+        """
+        An unlinked tapdisk whose minor another volume got meanwhile is
+        left to that volume.
+        """
+        self.tap_ctl.seed([_blockdevice_id(uuid4())])
+        orphan, = find_orphans(blktap.Tapdisk.list_all(), [])
+        blktap.Tapdisk.exc(*blktap.Tapdisk.destroy_args(orphan.tapdisk))
+        self.tap_ctl.seed([_blockdevice_id(uuid4())])
+        reconciler = Reconciler(self.driver)
+        self.assertEqual(
+            "cleaned",
+            reconciler._destroy_tapdisk(orphan, blktap.HolderIndex.build()))
+        self.assertEqual(1, len(self.tap_ctl.tapdisks))
@@ -0,0 +1,406 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Deadlines, retries and a circuit breaker around the storagerouter client,
+so a degraded storagedriver makes calls fail fast instead of hang.
+"""
+import Queue
+import atexit
+import collections
+import random
+import sys
+import threading
+import time
+
+from eliot import Field, Logger, MessageType
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+_logger = Logger()
+
+# Calls that only read, so they may be retried and timed adaptively.
+READS = frozenset(["info_volume", "get_object_id", "list_volumes_by_path",
+                   "list_volumes", "list_snapshots", "info_snapshot"])
+
+# Default seconds a read or a write may take before it is abandoned; reads
+# get less once enough of them were timed, see ``BackendGuard.deadline``.
+DEFAULT_DEADLINES = {"read": 10.0, "write": 60.0}
+
+# Default number of times a failed read is tried again.
+DEFAULT_RETRIES = 2
+
+# Default seconds of the first retry backoff, doubled on every retry.
+DEFAULT_BACKOFF = 0.1
+
+# Default number of failures in a row that open the circuit, 0 never does.
+DEFAULT_BREAKER_THRESHOLD = 5
+
+# Default seconds the circuit stays open before a call may probe again.
+DEFAULT_BREAKER_RESET = 30.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BACKEND = Field.for_types(
+    u"backend", [unicode, bytes], u"The vPool configuration file.")
+STATE = Field.for_types(
+    u"state", [unicode, bytes], u"closed, open or half_open.")
+FAILURES = Field.for_types(
+    u"failures", [int], u"Failed calls in a row.")
+BREAKER_STATE = MessageType(
+    u"openvstorage:storagerouter:breaker", [BACKEND, STATE, FAILURES],
+    u"The circuit breaker of a vPool changed state.")
+
+
+class CircuitOpen(Exception):
+    """
+    The storagerouter of a vPool failed too often lately; the call was not
+    made.
+    """
+
+
+class StorageRouterTimeout(Exception):
+    """
+    A storagerouter call did not return within its deadline. It may still
+    complete in the background.
+    """
+
+
+class BackendGuard(object):
+    """
+    Health of the storagerouter of one vPool, shared by all its clients: a
+    circuit breaker and the recent latency of every read.
+
+    After ``threshold`` failed calls in a row the circuit opens and calls
+    fail fast with ``CircuitOpen``. Once ``reset`` seconds have passed one
+    call at a time is let through; its success closes the circuit again.
+
+    :param deadlines: Seconds per method name, or for every ``"read"`` or
+        ``"write"``; ``None`` or ``0`` means no deadline.
+    :param answered: Tells whether an exception is an answer of the
+        storagerouter, such as a missing object, rather than a failure.
+    """
+    # Reads timed before their deadline adapts, and again between two
+    # updates of it, and how many are kept
+    SAMPLES = 20
+    WINDOW = 128
+    # The adaptive deadline of a read is this many times its p99
+    FACTOR = 4
+    # Seconds an adaptive deadline is never below
+    FLOOR = 1.0
+
+    def __init__(self, name, deadlines=None, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset=DEFAULT_BREAKER_RESET, answered=None):
+        self.name = name
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.threshold = threshold
+        self.reset = reset
+        self.answered = answered or (lambda e: False)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._probing = False
+        self._latencies = dict()
+        self._timed = dict()
+        self._adaptive = dict()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def _set_state(self, state):
+        if state != self._state:
+            self._state = state
+            BREAKER_STATE(backend=self.name, state=state,
+                          failures=self._failures).write(_logger)
+
+    def allow(self):
+        """
+        Whether a call may be made now.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and \
+                    time.time() - self._opened >= self.reset:
+                self._set_state(HALF_OPEN)
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def succeeded(self, method, duration):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(CLOSED)
+            if method in READS:
+                samples = self._latencies.get(method)
+                if samples is None:
+                    samples = self._latencies[method] = \
+                        collections.deque(maxlen=self.WINDOW)
+                samples.append(duration)
+                timed = self._timed[method] = self._timed.get(method, 0) + 1
+                if not timed % self.SAMPLES:
+                    ordered = sorted(samples)
+                    self._adaptive[method] = ordered[
+                        min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or (self.threshold and
+                                            self._failures >= self.threshold):
+                self._opened = time.time()
+                self._set_state(OPEN)
+
+    def deadline(self, method):
+        """
+        Seconds ``method`` may take, ``None`` for no deadline. Once enough
+        reads of a method were timed its deadline shrinks to a multiple of
+        their p99, so a hanging backend is noticed long before the
+        configured one runs out.
+        """
+        kind = "read" if method in READS else "write"
+        ceiling = self.deadlines.get(method, self.deadlines.get(kind))
+        if not ceiling or kind != "read":
+            return ceiling or None
+        p99 = self._adaptive.get(method)
+        if p99 is None:
+            return ceiling
+        return min(ceiling, max(self.FLOOR, self.FACTOR * p99))
+
+
+class _Call(object):
+    """
+    One storagerouter call, settled once by whichever comes first: its
+    worker with the outcome, or the watchdog at its deadline.
+    """
+    _settle = threading.Lock()
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.outcome = None
+        self._done = threading.Lock()
+        self._done.acquire()
+
+    def settle(self, outcome):
+        with _Call._settle:
+            if self.outcome is not None:
+                return
+            self.outcome = outcome
+        self._done.release()
+
+    def expire(self):
+        self.settle((False, None))
+
+    def wait(self):
+        """
+        ``(True, result)``, ``(False, exc_info)``, or ``(False, None)`` if
+        the deadline passed first.
+        """
+        # Untimed, a timed wait polls in Python 2
+        self._done.acquire()
+        return self.outcome
+
+
+class _Watchdog(object):
+    """
+    Expires the calls that run past their deadline. A single thread checks
+    every call in flight each ``TICK`` seconds, so starting and finishing
+    a call only costs a set update.
+    """
+    TICK = 0.05
+
+    def __init__(self):
+        self._calls = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def watch(self, call):
+        with self._lock:
+            self._calls.add(call)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='openvstorage-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def forget(self, call):
+        with self._lock:
+            self._calls.discard(call)
+
+    def _run(self):
+        while not self._stopped.wait(self.TICK):
+            now = time.time()
+            with self._lock:
+                late = [call for call in self._calls if call.expires <= now]
+                self._calls.difference_update(late)
+            for call in late:
+                call.expire()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+
+WATCHDOG = _Watchdog()
+
+
+class _Worker(object):
+    """
+    The thread one client makes its calls on, so the caller can give up
+    on a call; storagerouter calls cannot be interrupted, so one that runs
+    late is left to finish in the background.
+    """
+
+    def __init__(self):
+        self._jobs = Queue.Queue()
+        thread = threading.Thread(target=self._run,
+                                  name='openvstorage-storagerouter')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            call, function, args, kwargs = job
+            try:
+                outcome = (True, function(*args, **kwargs))
+            except BaseException:
+                outcome = (False, sys.exc_info())
+            call.settle(outcome)
+
+    def call(self, name, function, args, kwargs, deadline):
+        """
+        :raises StorageRouterTimeout: If ``function`` did not return within
+            ``deadline`` seconds.
+        """
+        call = _Call(time.time() + deadline)
+        self._jobs.put((call, function, args, kwargs))
+        WATCHDOG.watch(call)
+        succeeded, value = call.wait()
+        WATCHDOG.forget(call)
+        if succeeded:
+            return value
+        if value is None:
+            raise StorageRouterTimeout("%s took more than %.1fs" %
+                                       (name, deadline))
+        raise value[0], value[1], value[2]
+
+    def stop(self):
+        """
+        Let the thread end once its current call, if any, returns.
+        """
+        self._jobs.put(None)
+
+
+class ResilientClient(object):
+    """
+    Wraps a storagerouter client: every call checks the ``BackendGuard``
+    first, runs within its deadline, and failed reads are tried again
+    after a jittered exponential backoff.
+
+    A client whose call timed out may still be busy, so it is dropped, with
+    its worker thread, and the next call connects a new one. Connecting is
+    part of that call, so it is bound by the same guard and deadline.
+
+    :param connect: Returns a new storagerouter client.
+    """
+
+    def __init__(self, connect, guard):
+        self._connect = connect
+        self._guard = guard
+        self._client = None
+        self._worker = None
+
+    def _current(self, worker=None):
+        client = self._client
+        if client is None:
+            client = self._connect()
+            # Unless the call timed out meanwhile and its worker was dropped
+            if worker is self._worker:
+                self._client = client
+        return client
+
+    def _invoke(self, worker, name, args, kwargs):
+        return getattr(self._current(worker), name)(*args, **kwargs)
+
+    def _drop(self):
+        if self._worker is not None:
+            self._worker.stop()
+        self._client = self._worker = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        return call
+
+    def _call(self, name, args, kwargs):
+        guard = self._guard
+        tries = 1 + (guard.retries if name in READS else 0)
+        for attempt in range(tries):
+            if not guard.allow():
+                raise CircuitOpen("%s: storagerouter unavailable, %s not "
+                                  "called" % (guard.name, name))
+            deadline = guard.deadline(name)
+            started = time.time()
+            try:
+                if deadline:
+                    if self._worker is None:
+                        self._worker = _Worker()
+                    result = self._worker.call(
+                        name, self._invoke,
+                        (self._worker, name, args, kwargs), {}, deadline)
+                else:
+                    result = self._invoke(self._worker, name, args, kwargs)
+            except Exception, e:
+                if guard.answered(e):
+                    guard.succeeded(name, time.time() - started)
+                    raise
+                if isinstance(e, StorageRouterTimeout):
+                    self._drop()
+                guard.failed()
+                # Once the circuit opened a retry could only fail fast,
+                # hiding what went wrong
+                if attempt + 1 == tries or guard.state == OPEN:
+                    raise
+                time.sleep(random.uniform(0, guard.backoff * 2 ** attempt))
+                continue
+            guard.succeeded(name, time.time() - started)
+            return result
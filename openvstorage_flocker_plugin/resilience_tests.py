@@ -0,0 +1,234 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.resilience``.
+"""
+import time
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin.resilience import (
+    CLOSED, HALF_OPEN, OPEN, BackendGuard, CircuitOpen, ResilientClient,
+    StorageRouterTimeout
+)
+from openvstorage_flocker_plugin.testtools import (
+    FakeStorageRouterClient, src
+)
+
+
+class BackendGuardTests(TestCase):
+    """
+    Tests for ``BackendGuard``.
+    """
+
+    def test_opens(self):
+        """
+        ``threshold`` failures in a row open the circuit; a success in
+        between starts the count again.
+        """
+        guard = BackendGuard("fake.json", threshold=2)
+        guard.failed()
+        guard.succeeded("create_volume", 0.01)
+        guard.failed()
+        self.assertEqual((CLOSED, True), (guard.state, guard.allow()))
+        guard.failed()
+        self.assertEqual((OPEN, False), (guard.state, guard.allow()))
+
+    def test_half_open_probe(self):
+        """
+        Once ``reset`` passed a single call probes; its success closes the
+        circuit.
+        """
+        guard = BackendGuard("fake.json", threshold=1, reset=0)
+        guard.failed()
+        self.assertEqual([True, False], [guard.allow(), guard.allow()])
+        self.assertEqual(HALF_OPEN, guard.state)
+        guard.succeeded("info_volume", 0.01)
+        self.assertEqual((CLOSED, True), (guard.state, guard.allow()))
+
+    def test_half_open_probe_fails(self):
+        """
+        A failed probe opens the circuit again.
+        """
+        guard = BackendGuard("fake.json", threshold=3, reset=60)
+        for _ in range(3):
+            guard.failed()
+        guard.reset = 0
+        self.assertTrue(guard.allow())
+        guard.reset = 60
+        guard.failed()
+        self.assertEqual((OPEN, False), (guard.state, guard.allow()))
+
+    def test_adaptive_deadline(self):
+        """
+        After ``SAMPLES`` reads of a method its deadline shrinks to a
+        multiple of their p99, never below ``FLOOR``; writes keep theirs.
+        """
+        guard = BackendGuard("fake.json", deadlines={"read": 10.0})
+        for _ in range(guard.SAMPLES - 1):
+            guard.succeeded("info_volume", 0.5)
+            guard.succeeded("create_volume", 0.5)
+        self.assertEqual(10.0, guard.deadline("info_volume"))
+        guard.succeeded("info_volume", 0.5)
+        guard.succeeded("create_volume", 0.5)
+        self.assertEqual(
+            (guard.FACTOR * 0.5, 10.0, 60.0),
+            (guard.deadline("info_volume"), guard.deadline("get_object_id"),
+             guard.deadline("create_volume")))
+        for _ in range(guard.WINDOW + guard.SAMPLES):
+            guard.succeeded("info_volume", 0.001)
+        self.assertEqual(guard.FLOOR, guard.deadline("info_volume"))
+
+    def test_no_deadline(self):
+        """
+        A deadline of ``0`` or ``None`` means none.
+        """
+        guard = BackendGuard("fake.json",
+                             deadlines={"read": 0, "create_volume": None})
+        self.assertEqual((None, None, 60.0),
+                         (guard.deadline("info_volume"),
+                          guard.deadline("create_volume"),
+                          guard.deadline("unlink")))
+
+
+class ResilientClientTests(TestCase):
+    """
+    Tests for ``ResilientClient`` around a ``FakeStorageRouterClient``.
+    """
+
+    def setUp(self):
+        self.fake = FakeStorageRouterClient("fake.json")
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        return self.fake
+
+    def client(self, connect=None, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        kwargs.setdefault("answered", lambda e: isinstance(
+            e, src.ObjectNotFoundException))
+        guard = BackendGuard("fake.json", **kwargs)
+        return ResilientClient(connect or self.connect, guard), guard
+
+    def test_call(self):
+        """
+        Calls go to the client connected on first use.
+        """
+        client, _ = self.client()
+        self.fake.populate(2)
+        self.assertEqual(2, len(client.list_volumes_by_path()))
+        client.list_volumes_by_path()
+        self.assertEqual(1, self.connects)
+
+    def test_read_retries(self):
+        """
+        A failed read is tried ``retries`` more times, a write only once.
+        """
+        client, _ = self.client(retries=2, threshold=0)
+        self.fake.failures["info_volume"] = RuntimeError("unreachable")
+        self.fake.failures["unlink"] = RuntimeError("unreachable")
+        self.assertRaises(RuntimeError, client.info_volume, "id")
+        self.assertRaises(RuntimeError, client.unlink, "/a.raw")
+        self.assertEqual({"info_volume": 3, "unlink": 1}, self.fake.calls)
+
+    def test_breaker(self):
+        """
+        Once the circuit is open calls fail fast without reaching the
+        client.
+        """
+        client, guard = self.client(retries=0, threshold=2)
+        self.fake.failures["unlink"] = RuntimeError("unreachable")
+        for _ in range(2):
+            self.assertRaises(RuntimeError, client.unlink, "/a.raw")
+        self.assertRaises(CircuitOpen, client.unlink, "/a.raw")
+        self.assertEqual((OPEN, {"unlink": 2}),
+                         (guard.state, self.fake.calls))
+
+    def test_opening_failure_raised(self):
+        """
+        A read whose failure opens the circuit raises that failure rather
+        than ``CircuitOpen`` from a retry.
+        """
+        client, guard = self.client(retries=2, threshold=2)
+        self.fake.failures["info_volume"] = RuntimeError("unreachable")
+        self.assertRaises(RuntimeError, client.info_volume, "id")
+        self.assertEqual((OPEN, {"info_volume": 2}),
+                         (guard.state, self.fake.calls))
+
+    def test_half_open_probe_fails(self):
+        """
+        A read failing as the half-open probe raises its failure, is not
+        tried again, and opens the circuit again.
+        """
+        client, guard = self.client(retries=2, threshold=1, reset=60)
+        guard.failed()
+        guard.reset = 0
+        self.fake.failures["info_volume"] = RuntimeError("unreachable")
+        self.assertRaises(RuntimeError, client.info_volume, "id")
+        self.assertEqual((OPEN, {"info_volume": 1}),
+                         (guard.state, self.fake.calls))
+        guard.reset = 60
+        self.assertRaises(CircuitOpen, client.info_volume, "id")
+
+    def test_answered(self):
+        """
+        Exceptions the storagerouter answers with are raised untried and
+        do not count as failures.
+        """
+        client, guard = self.client(retries=2, threshold=1)
+        for _ in range(3):
+            self.assertRaises(src.ObjectNotFoundException,
+                              client.get_object_id, "/missing.raw")
+        self.assertEqual((CLOSED, {"get_object_id": 3}),
+                         (guard.state, self.fake.calls))
+
+    def test_failed_connect(self):
+        """
+        Failed connects count as failures and open the circuit.
+        """
+        def connect():
+            self.connects += 1
+            raise RuntimeError("no storagedriver")
+        client, guard = self.client(connect, retries=0, threshold=2)
+        for _ in range(2):
+            self.assertRaises(RuntimeError, client.unlink, "/a.raw")
+        self.assertRaises(CircuitOpen, client.unlink, "/a.raw")
+        self.assertEqual((OPEN, 2), (guard.state, self.connects))
+
+    def test_timeout(self):
+        """
+        A call past its deadline raises ``StorageRouterTimeout`` and the
+        next call connects a new client.
+        """
+        client, guard = self.client(deadlines={"unlink": 0.1}, threshold=0)
+        self.fake.latency = {"unlink": 0.5}
+        self.assertRaises(StorageRouterTimeout, client.unlink, "/a.raw")
+        self.fake.latency = 0
+        self.fake.populate(1)
+        client.list_volumes_by_path()
+        self.assertEqual(2, self.connects)
+
+    def test_slow_connect(self):
+        """
+        Connecting is bound by the deadline of the call.
+        """
+        def connect():
+            self.connects += 1
+            time.sleep(0.5)
+            return self.fake
+        client, guard = self.client(connect, deadlines={"unlink": 0.1},
+                                    retries=0, threshold=1)
+        self.assertRaises(StorageRouterTimeout, client.unlink, "/a.raw")
+        self.assertEqual(OPEN, guard.state)
@@ -0,0 +1,336 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process stand-ins for the Open vStorage backend, for benchmarks and
+tests that cannot use a real vPool.
+"""
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from openvstorage_flocker_plugin import blktap, fake_tapctl
+from openvstorage_flocker_plugin.openvstorage_blockdevice import (
+    OpenvStorageBlockDeviceAPI
+)
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+SRC = "volumedriver.storagerouter.storagerouterclient"
+
+# Resolved now, test runners may change directory later
+FAKE_TAP_CTL = os.path.abspath(
+    os.path.splitext(fake_tapctl.__file__)[0] + ".py")
+
+
+class _Enum(object):
+    def __init__(self, *names):
+        for name in names:
+            setattr(self, name, name)
+
+
+class _DTLConfig(object):
+    def __init__(self, host, port, mode):
+        self.host = host
+        self.port = port
+        self.mode = mode
+
+
+class _NoStorageRouter(object):
+    def __init__(self, vpool_conf_file):
+        raise ImportError("%s is not installed, only fake storagerouter "
+                          "clients can be used" % (SRC,))
+
+
+def _stub_storagerouterclient():
+    """
+    Stand in for the storagerouter bindings, for hosts that do not have the
+    volumedriver C++ libraries: the exception and settings types the driver
+    uses, and a ``LocalStorageRouterClient`` that cannot connect.
+    """
+    module = imp.new_module(SRC)
+    module.ObjectNotFoundException = type(
+        "ObjectNotFoundException", (Exception,), {"__module__": SRC})
+    module.LocalStorageRouterClient = _NoStorageRouter
+    module.DTLConfig = _DTLConfig
+    module.DTLMode = _Enum("ASYNCHRONOUS", "SYNCHRONOUS")
+    module.ClusterCacheBehaviour = _Enum("CACHE_ON_READ", "CACHE_ON_WRITE",
+                                         "NO_CACHE")
+    parent = None
+    for depth in range(1, SRC.count(".") + 2):
+        name = ".".join(SRC.split(".")[:depth])
+        package = sys.modules.get(name)
+        if package is None:
+            package = module if name == SRC else imp.new_module(name)
+            sys.modules[name] = package
+        if parent is not None:
+            setattr(parent, name.rsplit(".", 1)[1], package)
+        parent = package
+    return module
+
+
+try:
+    import volumedriver.storagerouter.storagerouterclient as src
+except ImportError:
+    # The driver imports the bindings lazily, so it gets the stand-in too
+    src = _stub_storagerouterclient()
+
+
+class FakeVolumeInfo(object):
+    def __init__(self, volume_size):
+        self.volume_size = volume_size
+
+
+class FakeStorageRouterClient(object):
+    """
+    A dict backed stand-in for ``LocalStorageRouterClient`` that counts the
+    calls made on it.
+
+    :ivar latency: Seconds every call sleeps, either a number or a ``dict``
+        keyed by method name, to mimic the round trip to a storagedriver.
+    :ivar failures: Exceptions raised, after the latency, by the calls of
+        the method names they are keyed by.
+    """
+
+    def __init__(self, vpool_conf_file=None, latency=0):
+        self.vpool_conf_file = vpool_conf_file
+        self.latency = latency
+        self.failures = dict()
+        self.calls = dict()
+        self._paths = dict()
+        self._objects = dict()
+        self.settings = dict()
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if isinstance(self.latency, dict):
+            delay = self.latency.get(name, 0)
+        else:
+            delay = self.latency
+        if delay:
+            time.sleep(delay)
+        failure = self.failures.get(name)
+        if failure is not None:
+            raise failure
+
+    @property
+    def rpcs(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def add_volume(self, path, size):
+        with self._lock:
+            object_id = str(uuid.uuid4())
+            self._paths[path] = object_id
+            self._objects[object_id] = (path, size)
+            return object_id
+
+    def populate(self, count, flocker=0, size=1024 * 1024 * 1024):
+        """
+        Add ``count`` vdisks, ``flocker`` of which are Flocker volumes.
+        """
+        for i in xrange(count):
+            if i < flocker:
+                self.add_volume("/flocker-%s.raw" % uuid.uuid4(), size)
+            else:
+                self.add_volume("/vm-%08d.raw" % i, size)
+
+    def list_volumes_by_path(self):
+        self._count('list_volumes_by_path')
+        with self._lock:
+            return list(self._paths)
+
+    def get_object_id(self, path):
+        self._count('get_object_id')
+        with self._lock:
+            try:
+                return self._paths[path]
+            except KeyError:
+                raise src.ObjectNotFoundException(path)
+
+    def info_volume(self, object_id):
+        self._count('info_volume')
+        with self._lock:
+            try:
+                return FakeVolumeInfo(self._objects[object_id][1])
+            except KeyError:
+                raise src.ObjectNotFoundException(object_id)
+
+    def create_volume(self, path, metadata_backend_config, size, *args):
+        self._count('create_volume')
+        self.add_volume(path, self._size(size))
+
+    def _size(self, size):
+        value, unit = size.split()
+        factor = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+        return int(float(value) * factor[unit])
+
+    def create_snapshot(self, object_id, snapshot_id):
+        self._count('create_snapshot')
+        self._set(object_id, 'snapshots',
+                  self.settings.get(object_id, {}).get('snapshots', ()) +
+                  (snapshot_id,))
+
+    def _clone(self, path, parent_id, snapshot_id=None):
+        with self._lock:
+            if parent_id not in self._objects:
+                raise src.ObjectNotFoundException(parent_id)
+            snapshots = self.settings.get(parent_id, {}).get('snapshots', ())
+            if snapshot_id is not None and snapshot_id not in snapshots:
+                raise src.ObjectNotFoundException(snapshot_id)
+            size = self._objects[parent_id][1]
+        object_id = self.add_volume(path, size)
+        self._set(object_id, 'parent', (parent_id, snapshot_id))
+
+    def create_clone(self, path, metadata_backend_config, parent_id,
+                     snapshot_id, *args):
+        self._count('create_clone')
+        self._clone(path, parent_id, snapshot_id)
+
+    def create_clone_from_template(self, path, metadata_backend_config,
+                                   parent_id, *args):
+        self._count('create_clone_from_template')
+        self._clone(path, parent_id)
+
+    def resize(self, object_id, size):
+        self._count('resize')
+        with self._lock:
+            try:
+                path, _ = self._objects[object_id]
+            except KeyError:
+                raise src.ObjectNotFoundException(object_id)
+            self._objects[object_id] = (path, self._size(size))
+
+    def unlink(self, path):
+        self._count('unlink')
+        with self._lock:
+            try:
+                object_id = self._paths.pop(path)
+            except KeyError:
+                raise src.ObjectNotFoundException(path)
+            del self._objects[object_id]
+            self.settings.pop(object_id, None)
+
+    def _set(self, object_id, key, value):
+        with self._lock:
+            if object_id not in self._objects:
+                raise src.ObjectNotFoundException(object_id)
+            self.settings.setdefault(object_id, dict())[key] = value
+
+    def set_cluster_cache_behaviour(self, object_id, behaviour):
+        self._count('set_cluster_cache_behaviour')
+        self._set(object_id, 'cache_behaviour', behaviour)
+
+    def set_manual_dtl_config(self, object_id, config):
+        self._count('set_manual_dtl_config')
+        self._set(object_id, 'dtl_config', config)
+
+
+def fake_blockdevice_api(client, vpools=None, **kwargs):
+    """
+    Create an ``OpenvStorageBlockDeviceAPI`` that talks to ``client``
+    instead of a real storagerouter.
+
+    :param dict vpools: Other vPool configuration files mapped to the
+        ``FakeStorageRouterClient`` standing in for them.
+    """
+    clients = dict(vpools or {})
+    return OpenvStorageBlockDeviceAPI(
+        client.vpool_conf_file or "fake.json",
+        storagerouter_client=lambda vpool_conf_file: clients.get(
+            vpool_conf_file, client), **kwargs)
+
+
+class FakeTapCtl(object):
+    """
+    Point ``blktap.Tapdisk`` at ``fake_tapctl`` for as long as it is
+    installed, with its state in a temporary directory.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.state_file = None
+        self._saved = None
+
+    def install(self):
+        self.directory = tempfile.mkdtemp(prefix="fake-tap-ctl-")
+        self.state_file = os.path.join(self.directory, "state.json")
+        script = os.path.join(self.directory, "tap-ctl")
+        with open(script, "w") as fh:
+            fh.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' %
+                     (sys.executable, FAKE_TAP_CTL))
+        os.chmod(script, 0755)
+        self._saved = (blktap.Tapdisk.TAP_CTL,
+                       os.environ.get(fake_tapctl.STATE_ENV))
+        blktap.Tapdisk.TAP_CTL = script
+        os.environ[fake_tapctl.STATE_ENV] = self.state_file
+        fake_tapctl.save_state(self.state_file, fake_tapctl.empty_state())
+        return self
+
+    def uninstall(self):
+        tap_ctl, state_env = self._saved
+        blktap.Tapdisk.TAP_CTL = tap_ctl
+        if state_env is None:
+            os.environ.pop(fake_tapctl.STATE_ENV, None)
+        else:
+            os.environ[fake_tapctl.STATE_ENV] = state_env
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    @property
+    def state(self):
+        return fake_tapctl.load_state(self.state_file)
+
+    @property
+    def forks(self):
+        return self.state['forks']
+
+    @property
+    def tapdisks(self):
+        return self.state['tapdisks']
+
+    def seed(self, volumes):
+        """
+        Pretend ``volumes`` are already attached, without forking.
+        """
+        state = self.state
+        minor = max([t['minor'] for t in state['tapdisks']] or [-1])
+        for volume in volumes:
+            state['next_pid'] += 1
+            minor += 1
+            state['tapdisks'].append(dict(
+                pid=state['next_pid'], minor=minor, state=0,
+                args='openvstorage:%s' % volume, readonly=False,
+                reqs=0, secs=0))
+        fake_tapctl.save_state(self.state_file, state)
@@ -0,0 +1,143 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Block queue tuning of tapdevs through ``/sys/dev/block/<major>:<minor>/queue``.
+
+    "queue_tuning":
+      "read_ahead_kb": 4096
+      "nr_requests": 512
+      "scheduler": "noop"
+      "max_sectors_kb": 1024
+"""
+import os
+
+from eliot import Field, Logger, MessageType
+
+__author__ = "Chrysostomos Nanakos"
+__copyright__ = "Copyright 2015, iNuron NV"
+__version__ = "0.1"
+__maintainer__ = "Chrysostomos Nanakos"
+__email__ = "cnanakos@openvstorage.com"
+__status__ = "Development"
+
+_logger = Logger()
+
+SYS_DEV_BLOCK = '/sys/dev/block'
+
+# Queue attributes that may be tuned and how their values are parsed.
+QUEUE_SETTINGS = {
+    "read_ahead_kb": int,
+    "nr_requests": int,
+    "scheduler": str,
+    "max_sectors_kb": int,
+}
+
+DEVICE = Field.for_types(
+    u"device", [unicode, bytes], u"The tuned block device.")
+REQUESTED = Field.for_types(
+    u"requested", [dict], u"The queue settings asked for.")
+APPLIED = Field.for_types(
+    u"applied", [dict], u"The queue settings read back after writing.")
+QUEUE_TUNED = MessageType(
+    u"openvstorage:queue:tuned", [DEVICE, REQUESTED, APPLIED],
+    u"Block queue settings applied to a tapdev.")
+
+
+class InvalidQueueTuning(Exception):
+    """
+    The queue tuning in the configuration cannot be used.
+    """
+
+
+def queue_tuning_from_configuration(config):
+    """
+    Validate a ``queue_tuning`` section of agent.yml.
+
+    :raises InvalidQueueTuning: For unknown settings or values.
+    :returns: A ``dict`` of the settings, ``None`` if there are none.
+    """
+    if not config:
+        return None
+    settings = dict()
+    for key, value in dict(config).items():
+        if key not in QUEUE_SETTINGS:
+            raise InvalidQueueTuning("Unknown queue setting %s, use %s" %
+                                     (key, ", ".join(sorted(QUEUE_SETTINGS))))
+        try:
+            settings[key] = QUEUE_SETTINGS[key](value)
+        except ValueError:
+            raise InvalidQueueTuning("Invalid value %r for %s" %
+                                     (value, key))
+    return settings
+
+
+def queue_path(device):
+    """
+    The sysfs queue directory of the block device ``device``.
+    """
+    rdev = os.stat(device).st_rdev
+    return os.path.join(SYS_DEV_BLOCK, '%d:%d' % (os.major(rdev),
+                                                  os.minor(rdev)), 'queue')
+
+
+def _parse(key, text):
+    text = text.strip()
+    if key == "scheduler":
+        # "noop [deadline] cfq": the active one is between brackets
+        for name in text.split():
+            if name.startswith('[') and name.endswith(']'):
+                return name[1:-1]
+        return text
+    return QUEUE_SETTINGS[key](text)
+
+
+def read_queue(device, keys=None):
+    """
+    The current queue settings of ``device``.
+
+    :param keys: The settings to read, all of ``QUEUE_SETTINGS`` if
+        ``None``.
+    """
+    path = queue_path(device)
+    settings = dict()
+    for key in sorted(keys or QUEUE_SETTINGS):
+        try:
+            with open(os.path.join(path, key)) as fh:
+                settings[key] = _parse(key, fh.read())
+        except (IOError, ValueError):
+            settings[key] = None
+    return settings
+
+
+def tune_queue(device, settings):
+    """
+    Write ``settings`` to the queue of ``device`` and read them back.
+
+    Settings the kernel rejects are left as they were, so one bad value
+    does not fail the attach; compare the result with ``settings`` to tell.
+
+    :returns: A ``dict`` of the values read back after writing.
+    """
+    path = queue_path(device)
+    # nr_requests may be capped by the scheduler, so switch that first
+    for key in sorted(settings, key=lambda k: k != "scheduler"):
+        try:
+            with open(os.path.join(path, key), 'w') as fh:
+                fh.write('%s\n' % (settings[key],))
+        except IOError:
+            pass
+    applied = read_queue(device, settings.keys())
+    QUEUE_TUNED(device=device, requested=dict(settings),
+                applied=applied).write(_logger)
+    return applied
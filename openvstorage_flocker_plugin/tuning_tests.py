@@ -0,0 +1,127 @@
+# Copyright 2015 iNuron NV
+#
+# Licensed under the Open vStorage Modified Apache License (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.openvstorage.org/license
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for ``openvstorage_flocker_plugin.tuning``.
+"""
+import os
+
+from twisted.trial.unittest import TestCase
+
+from openvstorage_flocker_plugin import tuning
+from openvstorage_flocker_plugin.tuning import (
+    InvalidQueueTuning, queue_tuning_from_configuration, read_queue,
+    tune_queue
+)
+
+
+class QueueTuningFromConfigurationTests(TestCase):
+    """
+    Tests for ``queue_tuning_from_configuration``.
+    """
+
+    def test_empty(self):
+        """
+        No section means no tuning.
+        """
+        self.assertEqual([None, None],
+                         [queue_tuning_from_configuration(config)
+                          for config in (None, {})])
+
+    def test_parsed(self):
+        """
+        Values are parsed by the type of their setting.
+        """
+        self.assertEqual(
+            {"nr_requests": 512, "scheduler": "noop"},
+            queue_tuning_from_configuration({"nr_requests": "512",
+                                             "scheduler": "noop"}))
+
+    def test_invalid(self):
+        """
+        Unknown settings and unparsable values are refused.
+        """
+        for config in ({"rotational": 0}, {"read_ahead_kb": "lots"}):
+            self.assertRaises(InvalidQueueTuning,
+                              queue_tuning_from_configuration, config)
+
+
+class QueueTests(TestCase):
+    """
+    Tests for ``read_queue`` and ``tune_queue`` on a temporary sysfs, with
+    ``/dev/null`` standing in for a tapdev.
+    """
+
+    def setUp(self):
+        sys_dev_block = self.mktemp()
+        self.patch(tuning, "SYS_DEV_BLOCK", sys_dev_block)
+        rdev = os.stat(os.devnull).st_rdev
+        self.queue = os.path.join(sys_dev_block, "%d:%d" % (
+            os.major(rdev), os.minor(rdev)), "queue")
+        os.makedirs(self.queue)
+        self.write(read_ahead_kb="128\n", nr_requests="128\n",
+                   scheduler="noop [deadline] cfq\n")
+
+    def write(self, **files):
+        for key, text in files.items():
+            with open(os.path.join(self.queue, key), "w") as fh:
+                fh.write(text)
+
+    def read(self, key):
+        with open(os.path.join(self.queue, key)) as fh:
+            return fh.read()
+
+    def test_read(self):
+        """
+        The active scheduler is the one between brackets; settings that
+        are missing or unparsable read as ``None``.
+        """
+        self.write(max_sectors_kb="many\n")
+        self.assertEqual(
+            {"read_ahead_kb": 128, "nr_requests": 128,
+             "scheduler": "deadline", "max_sectors_kb": None},
+            read_queue(os.devnull))
+        os.remove(os.path.join(self.queue, "max_sectors_kb"))
+        self.assertEqual({"max_sectors_kb": None},
+                         read_queue(os.devnull, ["max_sectors_kb"]))
+
+    def test_tune(self):
+        """
+        The settings are written to the queue and read back.
+        """
+        applied = tune_queue(os.devnull, {"read_ahead_kb": 4096,
+                                          "scheduler": "noop"})
+        self.assertEqual(
+            ({"read_ahead_kb": 4096, "scheduler": "noop"}, "4096\n"),
+            (applied, self.read("read_ahead_kb")))
+
+    def test_rejected(self):
+        """
+        A setting the kernel rejects is left alone and the others are
+        applied.
+        """
+        # Opening a directory to write fails like a rejected write
+        os.remove(os.path.join(self.queue, "nr_requests"))
+        os.mkdir(os.path.join(self.queue, "nr_requests"))
+        applied = tune_queue(os.devnull, {"nr_requests": 512,
+                                          "read_ahead_kb": 256})
+        self.assertEqual({"nr_requests": None, "read_ahead_kb": 256},
+                         applied)
+
+    def test_no_device(self):
+        """
+        Tuning a device that is gone raises ``OSError``.
+        """
+        self.assertRaises(OSError, tune_queue,
+                          os.path.join(self.mktemp(), "tapdev0"),
+                          {"nr_requests": 512})